@@ -0,0 +1,464 @@
+"""
+asyncio implementation of server.py, for many concurrent segment requests.
+
+Every upstream fetch is multiplexed on a single event loop instead of
+blocking one OS thread each. Routes and responses match the Flask server.
+Requires aiohttp (pip install aiohttp).
+
+Run with: python server.py --async
+"""
+import asyncio
+import os
+import signal
+import time
+from urllib.parse import quote
+
+import jinja2
+import requests
+from aiohttp import web, ClientSession, ClientTimeout, ClientConnectionError, TCPConnector, TraceConfig
+
+import metrics
+import tracing
+from metrics import RequestMetrics
+from playlist import PlaylistRewriter
+from episode_store import STORE_DIR, local_media, local_playlist
+from segment_cache import SEGMENT_CONTENT_TYPE
+from singleflight import AsyncFlight, FlightRegistry
+from server import (PORT, DEFAULT_REFERER, MIN_CHUNK_SIZE, MAX_CHUNK_SIZE, HOP_BY_HOP_HEADERS,
+                    SUBTITLE_TYPES, is_playlist, prefetcher, warm_stream, choose_variants,
+                    throughput, local_info, segment_cache)
+from upstream import (POOL_SIZE, POOL_HOSTS, CONNECT_TIMEOUT, READ_TIMEOUT, USER_AGENT, RETRIES,
+                      RETRY_STATUSES, HEDGE_ENABLED, CircuitOpen, backoff, host_of, host_health)
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+# Upstream fetches in progress; separate from the Flask server's, whose
+# flights are read from threads.
+flights = FlightRegistry(AsyncFlight)
+
+templates = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(TEMPLATES_DIR),
+    autoescape=jinja2.select_autoescape(['html']),
+)
+
+def forward_headers(resp, excluded_headers):
+    return [(name, value) for (name, value) in resp.headers.items()
+            if name.lower() not in excluded_headers]
+
+async def index(request):
+    url = request.query.get('url')
+    subs = request.query.get('subs')
+    local = request.query.get('local')
+    html = templates.get_template('player.html').render(url=url, subs=subs, local=local)
+    return web.Response(text=html, content_type='text/html')
+
+async def proxy(request):
+    url = request.query.get('url')
+    referer = request.query.get('referer', DEFAULT_REFERER)
+
+    if not url:
+        return web.Response(text="Missing URL", status=400)
+
+    headers = {
+        'Referer': referer,
+        'User-Agent': USER_AGENT
+    }
+
+    m = request['metrics']
+    range_header = request.headers.get('Range')
+    flight = reader = None
+    if range_header:
+        headers['Range'] = range_header
+        headers['Accept-Encoding'] = 'identity'
+    else:
+        # The prefetcher runs on its own threads; waiting for an in-flight
+        # segment must not block the event loop.
+        started = time.perf_counter()
+        prefetched = await asyncio.get_running_loop().run_in_executor(
+            None, prefetcher.take, url, READ_TIMEOUT)
+        result = 'hit' if prefetched else 'miss'
+        metrics.PREFETCH_LOOKUPS.inc(result=result)
+        m.mark('prefetch', started, result)
+        if prefetched:
+            m.kind = 'segment'
+            body, content_type = prefetched
+            return web.Response(body=body, status=200, content_type=content_type)
+
+        # Same lookup as the Flask server; disk reads run on the executor.
+        started = time.perf_counter()
+        cached = await asyncio.get_running_loop().run_in_executor(
+            None, segment_cache.get, url, 'proxy', False)
+        if cached is not None:
+            m.kind = 'segment'
+            m.mark('cache', started, 'hit')
+            return web.Response(body=cached, status=200, content_type=SEGMENT_CONTENT_TYPE)
+
+        # Same coalescing as the Flask server.
+        if flights.enabled:
+            flight, reader, leader = flights.join(url, referer)
+            if not leader:
+                return await follow_flight(request, flight, reader, url, referer, m)
+
+    try:
+        m.upstream_started = time.perf_counter()
+        resp = await upstream_get(request.app['client'], url, headers)
+    except CircuitOpen as e:
+        return flight_error(flight, str(e), 503)
+    except asyncio.TimeoutError as e:
+        metrics.UPSTREAM_ERRORS.inc(status='timeout')
+        return flight_error(flight, f"Upstream timed out: {e}", 504)
+    except Exception as e:
+        metrics.UPSTREAM_ERRORS.inc(status='error')
+        return flight_error(flight, str(e), 500)
+
+    out = None
+    # Once the body is shared, the flight releases the upstream response.
+    owned = True
+    try:
+        first_chunk = await resp.content.read(MIN_CHUNK_SIZE)
+
+        if is_playlist(resp, first_chunk):
+            m.upstream_headers('playlist', resp.status)
+            body = first_chunk + await resp.content.read()
+            m.upstream_done(len(body))
+            content = body.decode(resp.charset or 'utf-8', errors='replace')
+            excluded_headers = HOP_BY_HOP_HEADERS + ['content-encoding', 'content-length', 'content-range', 'accept-ranges']
+            headers_list = forward_headers(resp, excluded_headers)
+            if flight is not None:
+                flight.publish({'kind': 'playlist', 'status': resp.status,
+                                'headers': headers_list, 'content': content})
+                flight.leave(reader)
+            return await playlist_response(request, url, referer, content, resp.status, headers_list, m)
+
+        # Binary/Stream pass-through, same header rules as the Flask server.
+        m.upstream_headers('segment', resp.status)
+        excluded_headers = list(HOP_BY_HOP_HEADERS)
+        if resp.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+            excluded_headers += ['content-encoding', 'content-length', 'content-range']
+        headers_list = forward_headers(resp, excluded_headers)
+
+        keep = resp.status == 200 and not range_header and segment_cache.enabled \
+            and not resp.headers.get('Content-Type', '').startswith('text/')
+        if keep:
+            segment_cache.miss('proxy')
+        chunks = [] if keep else None
+
+        source = read_body(resp, first_chunk)
+        if flight is not None:
+            flight.publish({'kind': 'segment', 'status': resp.status, 'headers': headers_list},
+                           source, resp.release)
+            owned = False
+            source = flight.stream(reader)
+
+        out = web.StreamResponse(status=resp.status, headers=headers_list)
+        await out.prepare(request)
+        num_bytes = 0
+        async for chunk in source:
+            num_bytes += len(chunk)
+            if chunks is not None:
+                chunks.append(chunk)
+            await out.write(chunk)
+        if resp.status == 200:
+            throughput.record(num_bytes, time.perf_counter() - m.upstream_started)
+        m.upstream_done(num_bytes)
+        await out.write_eof()
+        if keep:
+            await asyncio.get_running_loop().run_in_executor(
+                None, segment_cache.put, url, b"".join(chunks), 'proxy')
+        return out
+    except asyncio.TimeoutError as e:
+        metrics.UPSTREAM_ERRORS.inc(status='timeout')
+        if out is not None:
+            # Headers are already sent; dropping the connection is all we can do.
+            raise
+        return flight_error(flight, f"Upstream timed out: {e}", 504)
+    finally:
+        if flight is not None:
+            flight.leave(reader)
+        if owned:
+            resp.release()
+
+async def upstream_get(client, url, headers):
+    """
+    Same retries, hedging and circuit breaking as
+    UpstreamPool.get(hedge=True), with the shared host_health.
+    """
+    host = host_of(url)
+    for attempt in range(RETRIES + 1):
+        if attempt:
+            host_health.count(host, 'retries')
+            await asyncio.sleep(backoff(attempt - 1))
+        probe = host_health.allow(host)
+        try:
+            if HEDGE_ENABLED:
+                resp, ttfb = await hedged_get(client, host, url, headers)
+            else:
+                resp, ttfb = await timed_get(client, url, headers)
+        except (ClientConnectionError, asyncio.TimeoutError):
+            if probe or attempt == RETRIES:
+                host_health.failure(host)
+                raise
+            continue
+        if resp.status not in RETRY_STATUSES:
+            host_health.success(host, ttfb)
+            return resp
+        if attempt == RETRIES:
+            # The host answered, so it is up.
+            host_health.success(host)
+            return resp
+        resp.release()
+
+async def timed_get(client, url, headers):
+    """
+    Returns (response, seconds until its headers arrived).
+    """
+    started = time.perf_counter()
+    resp = await client.get(url, headers=headers)
+    return resp, time.perf_counter() - started
+
+async def hedged_get(client, host, url, headers):
+    first = asyncio.ensure_future(timed_get(client, url, headers))
+    tasks = [first]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=host_health.hedge_after(host))
+        if done:
+            tasks.remove(first)
+            return first.result()
+        host_health.count(host, 'hedges')
+        metrics.UPSTREAM_HEDGES.inc(result='sent')
+        second = asyncio.ensure_future(timed_get(client, url, headers))
+        tasks.append(second)
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            winners = [task for task in done if task.exception() is None]
+            if not winners:
+                error = next(iter(done)).exception()
+                continue
+            winner = first if first in winners else second
+            if winner is second:
+                host_health.count(host, 'hedges_won')
+                metrics.UPSTREAM_HEDGES.inc(result='won')
+            tasks.remove(winner)
+            return winner.result()
+        raise error
+    finally:
+        # The losing request, or both if the client went away.
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                task.result()[0].release()
+
+async def read_body(resp, first_chunk):
+    """
+    Yields the upstream body with a chunk size that doubles up to MAX_CHUNK_SIZE.
+    """
+    chunk = first_chunk
+    chunk_size = MIN_CHUNK_SIZE
+    while chunk:
+        yield chunk
+        chunk = await resp.content.read(chunk_size)
+        chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+
+async def playlist_response(request, url, referer, content, status, headers_list, m):
+    content = choose_variants(content, m)
+    rewriter = PlaylistRewriter(url, referer)
+    out = web.StreamResponse(status=status, headers=headers_list)
+    await out.prepare(request)
+    started = time.perf_counter()
+    for block in rewriter.rewrite(content):
+        await out.write(block.encode('utf-8'))
+    metrics.REWRITE_SECONDS.observe(time.perf_counter() - started)
+    if status == 200:
+        prefetcher.register(url, rewriter.segments, referer)
+    await out.write_eof()
+    return out
+
+def flight_error(flight, text, status):
+    if flight is not None:
+        flight.publish({'kind': 'error', 'status': status, 'text': text})
+    return web.Response(text=text, status=status)
+
+async def follow_flight(request, flight, reader, url, referer, m):
+    """
+    Same as server.follow_flight().
+    """
+    try:
+        started = time.perf_counter()
+        head = await flight.wait_head(CONNECT_TIMEOUT + READ_TIMEOUT)
+        if head is None:
+            return web.Response(text="Upstream timed out", status=504)
+        metrics.UPSTREAM_COALESCED.inc(kind=head['kind'])
+        m.kind = head['kind']
+        m.mark('coalesced', started, head['kind'])
+        if head['kind'] == 'error':
+            return web.Response(text=head['text'], status=head['status'])
+        if head['kind'] == 'playlist':
+            flight.leave(reader)
+            return await playlist_response(request, url, referer, head['content'],
+                                           head['status'], head['headers'], m)
+        out = web.StreamResponse(status=head['status'], headers=head['headers'])
+        await out.prepare(request)
+        async for chunk in flight.stream(reader):
+            await out.write(chunk)
+        await out.write_eof()
+        return out
+    finally:
+        flight.leave(reader)
+
+async def local(request):
+    """
+    Same routes as server.local(). FileResponse handles Range and sends the
+    file with sendfile().
+    """
+    name = request.match_info['name']
+    if '/' in name or name.startswith('.') or os.sep in name:
+        raise web.HTTPNotFound()
+    if name.endswith('.json'):
+        info = local_info(name[:-len('.json')])
+        if info is None:
+            raise web.HTTPNotFound()
+        return web.json_response(info)
+    if name.endswith('.m3u8'):
+        filename = name[:-len('.m3u8')]
+        media = local_media(STORE_DIR, filename)
+        if media is None or media['manifest'] is None:
+            raise web.HTTPNotFound()
+        return web.Response(body=local_playlist(media['manifest'], quote(filename), media['complete']).encode('utf-8'),
+                            headers={'Content-Type': 'application/vnd.apple.mpegurl',
+                                     'Cache-Control': 'no-cache'})
+    extension = os.path.splitext(name)[1]
+    if extension in SUBTITLE_TYPES:
+        path = os.path.join(STORE_DIR, name)
+        if not os.path.isfile(path):
+            raise web.HTTPNotFound()
+        return web.FileResponse(path, headers={'Content-Type': SUBTITLE_TYPES[extension]})
+    media = local_media(STORE_DIR, name)
+    if media is None:
+        raise web.HTTPNotFound()
+    # Native downloads keep the .mp4 name but hold MPEG-TS.
+    return web.FileResponse(media['path'], headers={
+        'Content-Type': 'video/mp2t' if media['manifest'] else 'video/mp4',
+        'Cache-Control': 'no-cache',
+    })
+
+async def warm(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    if not data.get('url'):
+        return web.Response(text="Missing URL", status=400)
+    # warm_stream uses the blocking upstream pool; keep it off the event loop.
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, warm_stream, data['url'], data.get('referer', DEFAULT_REFERER), data.get('subs'))
+    except requests.exceptions.Timeout as e:
+        return web.Response(text=f"Upstream timed out: {e}", status=504)
+    except requests.exceptions.HTTPError as e:
+        return web.Response(text=f"Stream not available: {e}", status=502)
+    except Exception as e:
+        return web.Response(text=str(e), status=500)
+    return web.json_response(result)
+
+async def stats(request):
+    upstream = dict(request.app['upstream_counters'], pool_size=POOL_SIZE,
+                    connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                    health=host_health.stats())
+    return web.json_response({"upstream": upstream, "prefetch": prefetcher.stats(),
+                              "throughput": throughput.stats(), "segment_cache": segment_cache.stats(),
+                              "flights": flights.stats(), "stages": tracing.tracer.stats()})
+
+async def metrics_endpoint(request):
+    return web.Response(body=metrics.REGISTRY.render().encode('utf-8'),
+                        headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+async def health(request):
+    return web.json_response({"status": "ok"})
+
+async def shutdown(request):
+    asyncio.get_running_loop().call_later(0.1, os.kill, os.getpid(), signal.SIGTERM)
+    return web.json_response({"status": "Server shutting down..."})
+
+def count_connections(app):
+    """
+    Mirrors UpstreamPool.stats(): new vs reused upstream connections.
+    """
+    counters = {'requests': 0, 'new': 0, 'reused': 0}
+
+    async def on_request_start(session, ctx, params):
+        counters['requests'] += 1
+
+    async def on_connection_create_end(session, ctx, params):
+        counters['new'] += 1
+
+    async def on_connection_reuseconn(session, ctx, params):
+        counters['reused'] += 1
+
+    trace = TraceConfig()
+    trace.on_request_start.append(on_request_start)
+    trace.on_connection_create_end.append(on_connection_create_end)
+    trace.on_connection_reuseconn.append(on_connection_reuseconn)
+    app['upstream_counters'] = counters
+    return trace
+
+async def on_startup(app):
+    trace = count_connections(app)
+    connector = TCPConnector(limit=POOL_SIZE * POOL_HOSTS, limit_per_host=POOL_SIZE)
+    timeout = ClientTimeout(sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+    app['client'] = ClientSession(connector=connector, timeout=timeout,
+                                  trace_configs=[trace], auto_decompress=True)
+
+async def on_cleanup(app):
+    await app['client'].close()
+
+@web.middleware
+async def track_metrics(request, handler):
+    resource = request.match_info.route.resource
+    m = request['metrics'] = RequestMetrics(resource.canonical if resource else 'unmatched')
+    try:
+        resp = await handler(request)
+    except web.HTTPException as e:
+        m.finish(e.status)
+        raise
+    except BaseException:
+        m.finish(500)
+        raise
+    # Streamed responses are complete here; plain ones are sent afterwards.
+    if isinstance(resp, web.Response) and isinstance(resp.body, bytes):
+        m.bytes_out = len(resp.body)
+    else:
+        m.bytes_out = resp.body_length
+    m.finish(resp.status)
+    return resp
+
+async def add_cors_headers(request, resp):
+    resp.headers.setdefault('Access-Control-Allow-Origin', '*')
+    if 'metrics' in request:
+        timing = request['metrics'].server_timing()
+        if timing:
+            resp.headers['Server-Timing'] = timing
+
+def create_app():
+    app = web.Application(middlewares=[track_metrics])
+    app.router.add_get('/', index)
+    app.router.add_get('/proxy', proxy)
+    app.router.add_get('/local/{name}', local)
+    app.router.add_post('/warm', warm)
+    app.router.add_get('/stats', stats)
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.router.add_post('/shutdown', shutdown)
+    app.on_response_prepare.append(add_cors_headers)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+def run(port=PORT):
+    print(f"Starting async server on http://localhost:{port}")
+    web.run_app(create_app(), host='127.0.0.1', port=port, print=None)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,592 @@
+"""
+Local benchmarks, run against fake_origin.py instead of the live site.
+
+    python benchmark.py proxy --mode flask --mode async --clients 8 --clients 64
+    python benchmark.py rewrite --lines 10000
+    python benchmark.py download --workers 1 --workers 8
+    python benchmark.py scrape
+    python benchmark.py cache
+    python benchmark.py startup
+    python benchmark.py catalog --titles 5000
+    python benchmark.py all --output before.json
+    python benchmark.py compare before.json after.json
+
+proxy runs server.py in each requested mode and fetches segments through
+/proxy from concurrent clients. rewrite times the playlist rewrite on a
+generated playlist. download times GogoDownloader on a fake episode.
+scrape times GogoScraper's page fetches and stream extraction. cache
+streams an episode through the proxy, then downloads it, and counts the
+segment requests that reached the origin with and without the segment cache.
+startup times a cold `import main` (see main.py --startup-profile).
+catalog crawls the fake anime list into a catalog.py index, then times
+searches (exact and misspelled titles) against it and against the site.
+Each prints one JSON result per line; --output also saves them, with the
+commit they were measured on, for compare.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urljoin, urlparse
+
+import requests
+
+from fake_origin import start_fake_origin
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Result fields compared between runs; every other field identifies the run.
+METRIC_SUFFIXES = ('_ms', '_s', '_mb_s', '_per_s', '_speedup')
+SETTING_FIELDS = ('latency_ms', 'page_latency_ms', 'budget_ms')
+
+def start_server(mode, port):
+    args = [sys.executable, os.path.join(HERE, 'server.py')]
+    if mode == 'async':
+        args.append('--async')
+    # Clients fetch distinct segments, but a warm disk cache from an
+    # earlier run would still skip the origin.
+    env = dict(os.environ, ANIME_PORT=str(port), ANIME_SEGMENT_CACHE_MB='0')
+    proc = subprocess.Popen(args, cwd=HERE, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{mode} server exited with status {proc.returncode}")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/health", timeout=1)
+            return proc
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"{mode} server did not start on port {port}")
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+def run_clients(proxy_base, origin_base, clients, segments_per_client):
+    latencies = []
+    errors = 0
+    total_bytes = 0
+    lock = threading.Lock()
+
+    def client(client_id):
+        nonlocal errors, total_bytes
+        session = requests.Session()
+        for i in range(segments_per_client):
+            target = f"{origin_base}/hls/bench/1/720/seg-{client_id}-{i}.ts"
+            start = time.perf_counter()
+            try:
+                r = session.get(f"{proxy_base}/proxy?url={quote(target)}", timeout=60)
+                size = len(r.content)
+                ok = r.status_code == 200
+            except requests.exceptions.RequestException:
+                size, ok = 0, False
+            elapsed = time.perf_counter() - start
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                    total_bytes += size
+                else:
+                    errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        list(pool.map(client, range(clients)))
+    wall = time.perf_counter() - start
+
+    return {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'wall_s': round(wall, 3),
+        'throughput_mb_s': round(total_bytes / wall / 1e6, 2),
+        'requests_per_s': round(len(latencies) / wall, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+    }
+
+def default_modes():
+    if importlib.util.find_spec('aiohttp') is None:
+        print("aiohttp is not installed; benchmarking the Flask server only.")
+        return ['flask']
+    return ['flask', 'async']
+
+def bench_proxy(args):
+    origin, origin_base = start_fake_origin(segment_kb=args.segment_kb, latency_ms=args.latency_ms)
+    results = []
+    try:
+        for mode in args.mode or default_modes():
+            proc = start_server(mode, args.port)
+            try:
+                proxy_base = f"http://127.0.0.1:{args.port}"
+                for clients in args.clients or [8, 32]:
+                    result = run_clients(proxy_base, origin_base, clients, args.segments)
+                    result.update(benchmark='proxy', mode=mode, clients=clients,
+                                  segment_kb=args.segment_kb, latency_ms=args.latency_ms)
+                    print(json.dumps(result))
+                    results.append(result)
+            finally:
+                proc.terminate()
+                proc.wait()
+    finally:
+        origin.shutdown()
+    return results
+
+def legacy_rewrite_playlist(content, url, referer):
+    """
+    The per-line rewrite loop proxy() used before playlist.py, kept as the
+    baseline for the rewrite benchmark.
+    """
+    new_lines = []
+    for line in content.splitlines():
+        if line.strip() and not line.startswith('#'):
+            target_url = line.strip()
+            full_url = urljoin(url, target_url)
+            if not target_url.startswith('http') and not target_url.startswith('/'):
+                parsed_base = urlparse(url)
+                base_path = parsed_base.path
+                check_path = base_path[1:] if base_path.startswith('/') else base_path
+                first_segment = target_url.split('/')[0]
+                if first_segment and check_path.startswith(first_segment):
+                    root_base = f"{parsed_base.scheme}://{parsed_base.netloc}/"
+                    full_url = urljoin(root_base, target_url)
+            parsed_full = urlparse(full_url)
+            parts = [p for p in parsed_full.path.split('/') if p]
+            if len(parts) >= 4:
+                for length in range(len(parts) // 2, 1, -1):
+                    if parts[:length] == parts[length:2*length]:
+                        keep = parts[:length] + parts[2*length:]
+                        full_url = f"{parsed_full.scheme}://{parsed_full.netloc}/" + "/".join(keep)
+                        break
+            base_path_only = urlparse(url.rsplit('/', 1)[0]).path
+            parsed_full = urlparse(full_url)
+            resource_path = full_url.replace(f"{parsed_full.scheme}://{parsed_full.netloc}", "")
+            if base_path_only and base_path_only in resource_path:
+                if resource_path.startswith(base_path_only + '//' + base_path_only[1:]):
+                    new_path = resource_path[len(base_path_only)+2:]
+                    full_url = f"{parsed_full.scheme}://{parsed_full.netloc}{base_path_only}/{new_path}"
+                elif resource_path.startswith(base_path_only + base_path_only):
+                    new_path = resource_path[len(base_path_only):]
+                    full_url = f"{parsed_full.scheme}://{parsed_full.netloc}{new_path}"
+            new_lines.append(f"/proxy?url={quote(full_url)}&referer={quote(referer)}")
+        else:
+            new_lines.append(line)
+    return "\n".join(new_lines)
+
+def generate_playlist(lines):
+    """
+    A media playlist in the shapes Gogoanime's CDNs produce: relative names,
+    paths missing their leading slash, and paths repeating the base path.
+    """
+    base = "videos/hls/ab12cd34/ef56gh78"
+    entries = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:10",
+               "#EXT-X-MEDIA-SEQUENCE:0"]
+    i = 0
+    while len(entries) < lines:
+        name = f"ep.1.1709912345.1080.{i}.ts"
+        style = i % 4
+        if style == 0:
+            target = name
+        elif style == 1:
+            target = f"{base}/{name}"
+        elif style == 2:
+            target = f"/{base}/{base}/{name}"
+        else:
+            target = f"https://cdn.example.com/{base}/{name}"
+        entries += ["#EXTINF:10.010000,", target]
+        i += 1
+    entries.append("#EXT-X-ENDLIST")
+    return "\n".join(entries), f"https://cdn.example.com/{base}/ep.1.1709912345.1080.m3u8"
+
+def bench_rewrite(args):
+    from playlist import PlaylistRewriter, resolve_uri, _playlist_base, _resolve_quoted
+
+    content, url = generate_playlist(args.lines)
+    referer = "https://anitaku.to/"
+
+    def best_of(fn):
+        times = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    def rewrite_cold():
+        resolve_uri.cache_clear()
+        _resolve_quoted.cache_clear()
+        _playlist_base.cache_clear()
+        return "".join(PlaylistRewriter(url, referer).rewrite(content))
+
+    def rewrite_warm():
+        return "".join(PlaylistRewriter(url, referer).rewrite(content))
+
+    legacy = legacy_rewrite_playlist(content, url, referer)
+    if rewrite_cold() != legacy:
+        raise SystemExit("playlist.py output differs from the legacy rewrite")
+
+    legacy_s = best_of(lambda: legacy_rewrite_playlist(content, url, referer))
+    cold_s = best_of(rewrite_cold)
+    warm_s = best_of(rewrite_warm)
+    result = {
+        'benchmark': 'rewrite',
+        'lines': len(content.splitlines()),
+        'legacy_ms': round(legacy_s * 1000, 2),
+        'cold_ms': round(cold_s * 1000, 2),
+        'warm_ms': round(warm_s * 1000, 2),
+        'cold_speedup': round(legacy_s / cold_s, 1),
+        'warm_speedup': round(legacy_s / warm_s, 1),
+    }
+    print(json.dumps(result))
+    return [result]
+
+def bench_download(args):
+    from downloader import GogoDownloader
+    from segment_cache import SegmentCache
+
+    # yt-dlp resolves segment URLs by the RFC, so it gets playlists without
+    # the CDN path quirks, and the native runs use the same ones.
+    origin, base = start_fake_origin(segments=args.segments, segment_kb=args.segment_kb,
+                                     latency_ms=args.latency_ms, quirks=not args.ytdlp)
+    master = f"{base}/hls/bleach/1/master.m3u8"
+    referer = f"{base}/embed/bleach/1"
+    quiet = lambda d: None
+
+    runs = [('native', workers) for workers in args.workers or [1, 4, 8, 16]]
+    if args.ytdlp:
+        runs.append(('ytdlp', None))
+    results = []
+    try:
+        for mode, workers in runs:
+            with tempfile.TemporaryDirectory() as tmp:
+                downloader = GogoDownloader(download_dir=tmp, workers=workers or 1,
+                                            cache=SegmentCache(max_mb=0))
+                path = os.path.join(tmp, 'episode.mp4')
+                start = time.perf_counter()
+                if mode == 'native':
+                    downloader.download_hls(master, referer, path, progress_hook=quiet)
+                    ok = True
+                else:
+                    ok = downloader._download_ytdlp(master, referer, path, quiet)
+                wall = time.perf_counter() - start
+                size = os.path.getsize(path) if ok and os.path.exists(path) else 0
+            result = {
+                'benchmark': 'download',
+                'mode': mode,
+                'workers': workers,
+                'segments': args.segments,
+                'segment_kb': args.segment_kb,
+                'latency_ms': args.latency_ms,
+                'quirks': not args.ytdlp,
+                'ok': ok,
+                'wall_s': round(wall, 3),
+                'throughput_mb_s': round(size / wall / 1e6, 2),
+            }
+            print(json.dumps(result))
+            results.append(result)
+    finally:
+        origin.shutdown()
+    return results
+
+def bench_scrape(args):
+    from gogo_scraper import GogoScraper
+
+    origin, base = start_fake_origin(segments=4, segment_kb=16, page_latency_ms=args.page_latency_ms)
+    scraper = GogoScraper(base_url=base)
+    episode_urls = [f"{base}/bleach-episode-{i}" for i in range(1, args.episodes + 1)]
+    results = []
+
+    def record(phase, fn, repeat):
+        times = []
+        error = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            try:
+                if not fn():
+                    error = "no result"
+            except Exception as e:
+                error = str(e)
+            times.append(time.perf_counter() - start)
+            if error:
+                break
+        result = {
+            'benchmark': 'scrape',
+            'phase': phase,
+            'page_latency_ms': args.page_latency_ms,
+            'runs': len(times),
+            'p50_ms': round(percentile(times, 50) * 1000, 1),
+            'max_ms': round(max(times) * 1000, 1),
+        }
+        if error:
+            result['error'] = error
+        print(json.dumps(result))
+        results.append(result)
+
+    try:
+        record('search', lambda: scraper.search('bleach'), args.repeat)
+        record('episode_count', lambda: scraper.get_episode_count(f"{base}/category/bleach"), args.repeat)
+        record('embed_url', lambda: scraper._find_embed_url_http(episode_urls[0]), args.repeat)
+        if not args.skip_browser:
+            # The first call includes the browser launch.
+            record('stream_url_cold', lambda: scraper.get_stream_url(episode_urls[0]), 1)
+            record('stream_url', lambda: scraper.get_stream_url(episode_urls[0]), args.repeat)
+            record(f'stream_urls_x{len(episode_urls)}',
+                   lambda: all(scraper.get_stream_urls(episode_urls, concurrency=args.concurrency).values()), 1)
+    finally:
+        scraper.close()
+        origin.shutdown()
+    return results
+
+def bench_cache(args):
+    import server
+    from downloader import GogoDownloader, parse_master_playlist
+    from segment_cache import SegmentCache
+
+    origin, base = start_fake_origin(segments=args.segments, segment_kb=args.segment_kb,
+                                     latency_ms=args.latency_ms)
+    counts = origin.RequestHandlerClass.requests
+    client = server.app.test_client()
+    results = []
+    try:
+        for episode, enabled in enumerate((False, True), 1):
+            with tempfile.TemporaryDirectory() as tmp:
+                server.segment_cache = SegmentCache(os.path.join(tmp, 'cache'), max_mb=1024 if enabled else 0)
+                master = f"{base}/hls/bleach/{episode}/master.m3u8"
+                referer = f"{base}/embed/bleach/{episode}"
+                start = time.perf_counter()
+
+                # Stream: the variant the downloader picks, every segment in order.
+                text = client.get('/proxy', query_string={'url': master, 'referer': referer}).get_data(as_text=True)
+                best = max(parse_master_playlist(text), key=lambda v: v['bandwidth'])
+                media = client.get(best['uri']).get_data(as_text=True)
+                for line in media.splitlines():
+                    if line and not line.startswith('#'):
+                        client.get(line).get_data()
+                stream_s = time.perf_counter() - start
+
+                downloader = GogoDownloader(download_dir=tmp, cache=server.segment_cache)
+                downloader.download_hls(master, referer, os.path.join(tmp, 'episode.mp4'),
+                                        progress_hook=lambda d: None)
+                wall = time.perf_counter() - start
+            requests_made = sum(n for path, n in counts.items()
+                                if path.startswith(f"/hls/bleach/{episode}/") and path.endswith('.ts'))
+            result = {
+                'benchmark': 'cache',
+                'cache': enabled,
+                'segments': args.segments,
+                'segment_kb': args.segment_kb,
+                'latency_ms': args.latency_ms,
+                'origin_segment_requests': requests_made,
+                'stream_s': round(stream_s, 3),
+                'wall_s': round(wall, 3),
+            }
+            print(json.dumps(result))
+            results.append(result)
+    finally:
+        server.prefetcher.close()
+        origin.shutdown()
+    return results
+
+def bench_startup(args):
+    import main as cli
+
+    import_ms = cli.startup_profile(runs=args.runs)
+    result = {
+        'benchmark': 'startup',
+        'budget_ms': cli.STARTUP_BUDGET_MS,
+        'import_ms': round(import_ms, 1) if import_ms is not None else None,
+        'within_budget': import_ms is not None and import_ms <= cli.STARTUP_BUDGET_MS,
+    }
+    print(json.dumps(result))
+    return [result]
+
+# Half exact, half misspelled; the site's own search only finds the first kind.
+CATALOG_QUERIES = ('bleach', 'frieren', 'naruto', 'one piece', 'naruot', 'one pice', 'freiren', 'bleech')
+
+def bench_catalog(args):
+    from catalog import Catalog
+    from gogo_scraper import GogoScraper
+
+    origin, base = start_fake_origin(segments=1, segment_kb=1, page_latency_ms=args.page_latency_ms,
+                                     extra_titles=args.titles)
+    scraper = GogoScraper(base_url=base)
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            catalog = Catalog(os.path.join(tmp, 'catalog.db'), base_url=base)
+            start = time.perf_counter()
+            catalog.refresh()
+            crawl_s = time.perf_counter() - start
+            # Every page is fresh, so a refresh only looks for new pages.
+            start = time.perf_counter()
+            catalog.refresh()
+            refresh_s = time.perf_counter() - start
+            result = {
+                'benchmark': 'catalog',
+                'phase': 'build',
+                'titles': catalog.count(),
+                'page_latency_ms': args.page_latency_ms,
+                'crawl_s': round(crawl_s, 3),
+                'refresh_s': round(refresh_s, 3),
+            }
+            print(json.dumps(result))
+            results.append(result)
+
+            for source, search in (('catalog', catalog.search), ('site', scraper.search)):
+                times = []
+                found = 0
+                for query in CATALOG_QUERIES:
+                    for _ in range(args.repeat):
+                        start = time.perf_counter()
+                        hits = search(query)
+                        times.append(time.perf_counter() - start)
+                    found += bool(hits)
+                result = {
+                    'benchmark': 'catalog',
+                    'phase': 'search',
+                    'source': source,
+                    'titles': result['titles'],
+                    'page_latency_ms': args.page_latency_ms,
+                    'found': f"{found}/{len(CATALOG_QUERIES)}",
+                    'p50_ms': round(percentile(times, 50) * 1000, 2),
+                    'max_ms': round(max(times) * 1000, 2),
+                }
+                print(json.dumps(result))
+                results.append(result)
+            catalog.close()
+    finally:
+        scraper.close()
+        origin.shutdown()
+    return results
+
+def bench_all(parser, args):
+    results = []
+    for name in ('startup', 'rewrite', 'download', 'cache', 'scrape', 'catalog', 'proxy'):
+        sub_args = parser.parse_args([name])
+        results += sub_args.func(sub_args)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def save_results(path, results):
+    with open(path, 'w') as f:
+        json.dump({
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'results': results,
+        }, f, indent=2)
+    print(f"Saved {len(results)} results to {path}")
+
+def is_metric(name, value):
+    return name.endswith(METRIC_SUFFIXES) and name not in SETTING_FIELDS and isinstance(value, (int, float))
+
+def split_result(result):
+    """
+    Returns (identifying fields, metrics) of one result.
+    """
+    key = tuple(sorted((k, str(v)) for k, v in result.items() if not is_metric(k, v)))
+    metrics = {k: v for k, v in result.items() if is_metric(k, v)}
+    return key, metrics
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"{base.get('commit')} -> {new.get('commit')}")
+    old_results = dict(split_result(r) for r in base['results'])
+    for result in new['results']:
+        key, metrics = split_result(result)
+        if key not in old_results:
+            continue
+        label = " ".join(f"{k}={v}" for k, v in key if v not in ('None', ''))
+        for name, value in metrics.items():
+            old = old_results[key].get(name)
+            if old is None:
+                continue
+            change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"{label}  {name}: {old} -> {value} ({change})")
+    return []
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for web-anime-cli")
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--output', help="Also write the results, with the commit, to this JSON file")
+
+    p = sub.add_parser('proxy', parents=[common], help="Concurrent segment fetches through /proxy")
+    p.add_argument('--mode', action='append', choices=['flask', 'async'])
+    p.add_argument('--clients', action='append', type=int)
+    p.add_argument('--segments', type=int, default=10, help="Segments fetched per client")
+    p.add_argument('--segment-kb', type=int, default=1024)
+    p.add_argument('--latency-ms', type=float, default=50)
+    p.add_argument('--port', type=int, default=5099)
+    p.set_defaults(func=bench_proxy)
+
+    p = sub.add_parser('rewrite', parents=[common], help="Playlist rewrite time, legacy loop vs playlist.py")
+    p.add_argument('--lines', type=int, default=10000)
+    p.add_argument('--repeat', type=int, default=5, help="Best of this many runs is reported")
+    p.set_defaults(func=bench_rewrite)
+
+    p = sub.add_parser('download', parents=[common], help="GogoDownloader throughput on a fake episode")
+    p.add_argument('--workers', action='append', type=int)
+    p.add_argument('--segments', type=int, default=120)
+    p.add_argument('--segment-kb', type=int, default=512)
+    p.add_argument('--latency-ms', type=float, default=50)
+    p.add_argument('--ytdlp', action='store_true', help="Also time the yt-dlp fallback")
+    p.set_defaults(func=bench_download)
+
+    p = sub.add_parser('scrape', parents=[common], help="GogoScraper page and stream extraction latency")
+    p.add_argument('--page-latency-ms', type=float, default=50)
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--episodes', type=int, default=4, help="Episodes in the batch extraction run")
+    p.add_argument('--concurrency', type=int, default=4)
+    p.add_argument('--skip-browser', action='store_true', help="Only time the plain HTTP paths")
+    p.set_defaults(func=bench_scrape)
+
+    p = sub.add_parser('cache', parents=[common], help="Origin segment requests for stream + download")
+    p.add_argument('--segments', type=int, default=40)
+    p.add_argument('--segment-kb', type=int, default=256)
+    p.add_argument('--latency-ms', type=float, default=20)
+    p.set_defaults(func=bench_cache)
+
+    p = sub.add_parser('startup', parents=[common], help="Cold import time of main.py against its budget")
+    p.add_argument('--runs', type=int, default=5, help="Best of this many runs is reported")
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser('catalog', parents=[common], help="Local catalog search vs the site's search")
+    p.add_argument('--titles', type=int, default=5000, help="Made-up series added to the fake anime list")
+    p.add_argument('--page-latency-ms', type=float, default=50)
+    p.add_argument('--repeat', type=int, default=5)
+    p.set_defaults(func=bench_catalog)
+
+    p = sub.add_parser('all', parents=[common], help="Every benchmark with its defaults")
+    p.set_defaults(func=lambda args: bench_all(parser, args))
+
+    p = sub.add_parser('compare', help="Compare two --output files")
+    p.add_argument('base')
+    p.add_argument('new')
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    results = args.func(args)
+    if getattr(args, 'output', None):
+        save_results(args.output, results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_FILE = os.environ.get('ANIME_CACHE_FILE', 'cache.db')
+CACHE_MAX_MB = float(os.environ.get('ANIME_CACHE_MAX_MB', '20'))
+
+# Seconds a result stays valid, per kind. Stream URLs are signed and expire
+# upstream, so they are only kept long enough to cover a quick retry.
+TTLS = {
+    'search': 24 * 3600,
+    'episodes': 6 * 3600,
+    'stream': 10 * 60,
+}
+# Empty results (no search hits, episode count 0, no stream) are cached
+# briefly, so a typo or a broken episode is not re-scraped on every retry.
+NEGATIVE_TTLS = {
+    'search': 10 * 60,
+    'episodes': 10 * 60,
+    'stream': 60,
+}
+
+HISTORY_LIMIT = 50
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    expires REAL NOT NULL,
+    accessed REAL NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS stats (
+    kind TEXT NOT NULL,
+    event TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (kind, event)
+);
+CREATE TABLE IF NOT EXISTS history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    title TEXT,
+    url TEXT,
+    episode INTEGER,
+    timestamp TEXT
+);
+"""
+
+class CacheStore:
+    """
+    SQLite-backed key/value cache with per-kind TTLs and a size cap.
+    Also holds the watch history, so saving an episode is a single insert
+    instead of rewriting history.json.
+    """
+    def __init__(self, path=CACHE_FILE, max_bytes=CACHE_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        # One connection shared by all threads, serialized by self._lock.
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def get(self, kind, key):
+        """
+        Returns (True, value) for a fresh entry, (False, None) otherwise.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires FROM entries WHERE kind = ? AND key = ?", (kind, key)).fetchone()
+            if row is None or row[1] < now:
+                if row is not None:
+                    self._conn.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (kind, key))
+                self._count(kind, 'misses')
+                return False, None
+            self._conn.execute(
+                "UPDATE entries SET accessed = ? WHERE kind = ? AND key = ?", (now, kind, key))
+            self._count(kind, 'hits')
+        return True, json.loads(row[0])
+
+    def put(self, kind, key, value, ttl=None):
+        if ttl is None:
+            ttl = TTLS.get(kind, 3600) if value else NEGATIVE_TTLS.get(kind, 60)
+        data = json.dumps(value)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (kind, key, value, expires, accessed, size) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, key, data, now + ttl, now, len(data)))
+            self._evict()
+
+    def delete(self, kind, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (kind, key))
+
+    def clear(self, kind=None):
+        with self._lock:
+            if kind:
+                self._conn.execute("DELETE FROM entries WHERE kind = ?", (kind,))
+            else:
+                self._conn.execute("DELETE FROM entries")
+                self._conn.execute("DELETE FROM stats")
+
+    def stats(self):
+        """
+        Returns {kind: {'hits', 'misses', 'entries', 'bytes'}}.
+        """
+        result = {}
+        with self._lock:
+            for kind, event, count in self._conn.execute("SELECT kind, event, count FROM stats"):
+                result.setdefault(kind, {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0})[event] = count
+            for kind, entries, size in self._conn.execute(
+                    "SELECT kind, COUNT(*), COALESCE(SUM(size), 0) FROM entries GROUP BY kind"):
+                info = result.setdefault(kind, {'hits': 0, 'misses': 0, 'entries': 0, 'bytes': 0})
+                info['entries'] = entries
+                info['bytes'] = size
+        return result
+
+    def add_history(self, entry):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO history (title, url, episode, timestamp) VALUES (?, ?, ?, ?)",
+                (entry['title'], entry['url'], entry['episode'], entry['timestamp']))
+            # Keep last HISTORY_LIMIT
+            self._conn.execute(
+                "DELETE FROM history WHERE id <= (SELECT MAX(id) FROM history) - ?", (HISTORY_LIMIT,))
+
+    def load_history(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT title, url, episode, timestamp FROM history ORDER BY id").fetchall()
+        return [{'title': t, 'url': u, 'episode': e, 'timestamp': ts} for t, u, e, ts in rows]
+
+    def import_history(self, history_file):
+        """
+        One-time migration of an existing history.json into the store.
+        """
+        if not os.path.exists(history_file):
+            return
+        with self._lock:
+            has_rows = self._conn.execute("SELECT 1 FROM history LIMIT 1").fetchone()
+        if has_rows:
+            return
+        try:
+            with open(history_file, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for entry in entries[-HISTORY_LIMIT:]:
+            if all(k in entry for k in ('title', 'url', 'episode', 'timestamp')):
+                self.add_history(entry)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # Internal helpers, called with self._lock held.
+
+    def _count(self, kind, event):
+        self._conn.execute(
+            "INSERT INTO stats (kind, event, count) VALUES (?, ?, 1) "
+            "ON CONFLICT (kind, event) DO UPDATE SET count = count + 1", (kind, event))
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Expired entries go first, then the least recently used ones.
+        self._conn.execute("DELETE FROM entries WHERE expires < ?", (time.time(),))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute("SELECT kind, key, size FROM entries ORDER BY accessed").fetchall()
+        for kind, key, size in rows:
+            if total <= target:
+                break
+            self._conn.execute("DELETE FROM entries WHERE kind = ? AND key = ?", (kind, key))
+            total -= size
+
+class CachedScraper:
+    """
+    Answers search, get_episode_count and get_stream_url from a CacheStore
+    while the stored result is fresh. Everything else is passed through to
+    the wrapped GogoScraper.
+    """
+    def __init__(self, scraper, store):
+        self._scraper = scraper
+        self.store = store
+
+    def __getattr__(self, name):
+        return getattr(self._scraper, name)
+
+    def search(self, query):
+        key = " ".join(query.lower().split())
+        hit, results = self.store.get('search', key)
+        if hit:
+            print(f"Searching for '{query}'... (cached)")
+            return results
+        results = self._scraper.search(query)
+        self.store.put('search', key, results)
+        return results
+
+    def get_episode_count(self, category_url):
+        hit, count = self.store.get('episodes', category_url)
+        if hit:
+            return count
+        count = self._scraper.get_episode_count(category_url)
+        self.store.put('episodes', category_url, count)
+        return count
+
+    def get_stream_url(self, episode_url):
+        hit, stream = self.store.get('stream', episode_url)
+        if hit:
+            if stream:
+                print(f"Using cached stream for {episode_url}")
+            return stream
+        stream = self._scraper.get_stream_url(episode_url)
+        self.store.put('stream', episode_url, stream)
+        return stream
+
+    def invalidate_stream(self, episode_url):
+        """
+        Drops a cached stream that turned out to be dead.
+        """
+        self.store.delete('stream', episode_url)
+
+    def get_stream_urls(self, episode_urls, **kwargs):
+        results = dict(self.iter_stream_urls(episode_urls, **kwargs))
+        return {url: results.get(url) for url in episode_urls}
+
+    def iter_stream_urls(self, episode_urls, **kwargs):
+        missing = []
+        for url in episode_urls:
+            hit, stream = self.store.get('stream', url)
+            if hit:
+                yield url, stream
+            else:
+                missing.append(url)
+        if missing:
+            for url, stream in self._scraper.iter_stream_urls(missing, **kwargs):
+                self.store.put('stream', url, stream)
+                yield url, stream
+
+    def cache_summary(self):
+        """
+        Returns printable lines with hit/miss counts per kind.
+        """
+        lines = []
+        for kind, info in sorted(self.store.stats().items()):
+            lookups = info['hits'] + info['misses']
+            rate = (info['hits'] / lookups * 100) if lookups else 0.0
+            lines.append(f"{kind:<9} hits {info['hits']:>5}  misses {info['misses']:>5}  "
+                         f"hit rate {rate:5.1f}%  entries {info['entries']:>5}  {info['bytes'] / 1024:.1f} KB")
+        return lines or ["Cache is empty."]
@@ -0,0 +1,334 @@
+"""
+Local index of the site's whole anime list, for instant, typo-tolerant search.
+
+`python main.py --build-catalog` crawls the site's anime list pages into
+catalog.db: the title and URL of every series, its episode count once it
+has been looked up, and the trigrams of each title. Searches are then
+answered from the index in milliseconds, without the network; a misspelled
+title still matches as long as most of its trigrams do. The live search is
+only used when the index has no match or is older than
+CATALOG_MAX_AGE_DAYS.
+
+Building again refreshes the index in place: pages crawled within the max
+age are skipped, so an interrupted crawl resumes where it stopped, and only
+pages whose titles changed are rewritten.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+# Tunables, overridable from the environment.
+CATALOG_FILE = os.environ.get('ANIME_CATALOG_FILE', 'catalog.db')
+CATALOG_MAX_AGE_DAYS = float(os.environ.get('ANIME_CATALOG_MAX_AGE_DAYS', '7'))
+CATALOG_WORKERS = int(os.environ.get('ANIME_CATALOG_WORKERS', '4'))  # list pages fetched at once
+
+LIST_PATH = '/anime-list.html?page={page}'
+# A title matches when it contains this share of the query's trigrams.
+MATCH_THRESHOLD = 0.5
+SEARCH_LIMIT = 20
+# Titles sharing the most trigrams with the query, scored in Python.
+CANDIDATES = 200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS titles (
+    slug TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    path TEXT NOT NULL,
+    page INTEGER,
+    episodes INTEGER,
+    grams INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS titles_page ON titles (page);
+CREATE TABLE IF NOT EXISTS grams (
+    gram TEXT NOT NULL,
+    slug TEXT NOT NULL,
+    PRIMARY KEY (gram, slug)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS grams_slug ON grams (slug);
+CREATE TABLE IF NOT EXISTS pages (
+    page INTEGER PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    crawled REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+def normalize(text):
+    """
+    Lower-case words without accents or punctuation: "Sōsō no Frieren!" -> "soso no frieren".
+    """
+    text = unicodedata.normalize('NFKD', text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.findall(r'[a-z0-9]+', text.lower()))
+
+def trigrams(text):
+    """
+    The trigrams of each word, padded like PostgreSQL's pg_trgm so that
+    word starts weigh more than word middles.
+    """
+    grams = set()
+    for word in normalize(text).split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+def slug_of(url):
+    return url.rstrip('/').split('/')[-1]
+
+class Catalog:
+    """
+    SQLite-backed, shared by all threads like CacheStore.
+    Search results have the shape of GogoScraper.search results, plus
+    'episodes' when the count is known.
+    """
+    def __init__(self, path=CATALOG_FILE, base_url=None, max_age_days=CATALOG_MAX_AGE_DAYS):
+        if base_url is None:
+            from upstream import BASE_URL as base_url
+        self.path = path
+        self.base_url = base_url.rstrip('/')
+        self.max_age = max_age_days * 86400
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def refreshed(self):
+        """
+        When the last complete crawl finished, or None.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'refreshed'").fetchone()
+        return float(row[0]) if row else None
+
+    def fresh(self):
+        refreshed = self.refreshed()
+        return refreshed is not None and time.time() - refreshed < self.max_age
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """
+        Returns the titles matching `query` best first, or [] if none does.
+        """
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+        placeholders = ",".join("?" * len(query_grams))
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT t.title, t.path, t.episodes, t.grams, c.shared FROM "
+                f"(SELECT slug, COUNT(*) AS shared FROM grams WHERE gram IN ({placeholders}) "
+                " GROUP BY slug ORDER BY shared DESC LIMIT ?) c "
+                "JOIN titles t ON t.slug = c.slug",
+                (*query_grams, CANDIDATES)).fetchall()
+        scored = []
+        for title, path, episodes, grams, shared in rows:
+            coverage = shared / len(query_grams)
+            if coverage < MATCH_THRESHOLD:
+                continue
+            # Among titles containing the whole query, the closest in length wins.
+            similarity = shared / (len(query_grams) + grams - shared)
+            scored.append((-coverage, -similarity, title, path, episodes))
+        scored.sort()
+        results = []
+        for _, _, title, path, episodes in scored[:limit]:
+            result = {'title': title, 'url': self.base_url + path}
+            if episodes is not None:
+                result['episodes'] = episodes
+            results.append(result)
+        return results
+
+    def add(self, results):
+        """
+        Adds titles found by a live search, so the next search for them is local.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for result in results:
+                    self._upsert(slug_of(result['url']), result['title'], _path_of(result['url']), None)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def set_episodes(self, category_url, count):
+        with self._lock:
+            self._conn.execute("UPDATE titles SET episodes = ? WHERE slug = ?", (count, slug_of(category_url)))
+
+    def refresh(self, workers=CATALOG_WORKERS):
+        """
+        Crawls the anime list pages until the first empty one, skipping pages
+        crawled within the max age. Returns {'pages', 'fetched', 'changed', 'titles'}.
+        Stops early (without marking the catalog refreshed) if a page fails.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from upstream import UpstreamPool
+
+        pool = UpstreamPool(pool_size=max(workers, 1))
+        stats = {'pages': 0, 'fetched': 0, 'changed': 0, 'titles': 0}
+        started = time.time()
+        page = 1
+        reported = 0
+        try:
+            with ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='catalog') as executor:
+                while True:
+                    batch = range(page, page + max(workers, 1))
+                    due = [p for p in batch if not self._page_fresh(p, started)]
+                    fetched = dict(zip(due, executor.map(lambda p: self._fetch_page(pool, p), due)))
+                    for p in batch:
+                        if p not in fetched:
+                            stats['pages'] += 1
+                            continue
+                        items = fetched[p]
+                        if items is None:
+                            print(f"Catalog refresh stopped at page {p}; run it again to resume.")
+                            return stats
+                        stats['fetched'] += 1
+                        if not items:
+                            self._finish(p, started)
+                            stats['titles'] = self.count()
+                            print(f"Catalog: {stats['titles']} titles from {stats['pages']} pages "
+                                  f"({stats['fetched']} fetched, {stats['changed']} changed) "
+                                  f"in {time.time() - started:.1f}s")
+                            return stats
+                        stats['pages'] += 1
+                        stats['changed'] += self._store_page(p, items)
+                    page += len(batch)
+                    if stats['pages'] >= reported + 20:
+                        reported = stats['pages']
+                        print(f"Catalog: {reported} pages so far...")
+        finally:
+            pool.close()
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM titles").fetchone()[0]
+
+    def summary(self):
+        """
+        Returns printable lines describing the index.
+        """
+        refreshed = self.refreshed()
+        if refreshed is None:
+            return [f"Catalog: {self.count()} titles, never fully crawled (python main.py --build-catalog)."]
+        age = (time.time() - refreshed) / 86400
+        state = "fresh" if self.fresh() else "stale, searches go to the site ('catalog refresh' updates it)"
+        with self._lock:
+            known = self._conn.execute("SELECT COUNT(*) FROM titles WHERE episodes IS NOT NULL").fetchone()[0]
+        size = sum(os.path.getsize(self.path + suffix) for suffix in ('', '-wal') if os.path.exists(self.path + suffix))
+        return [f"Catalog: {self.count()} titles ({known} with episode counts), {size / 1e6:.1f} MB",
+                f"Last crawl {age:.1f} days ago: {state}"]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # Internal helpers.
+
+    def _page_fresh(self, page, now):
+        with self._lock:
+            row = self._conn.execute("SELECT crawled FROM pages WHERE page = ?", (page,)).fetchone()
+        return row is not None and now - row[0] < self.max_age
+
+    def _fetch_page(self, pool, page):
+        """
+        Returns [(slug, title, path)] for one list page ([] past the last
+        page), or None if it could not be read.
+        """
+        import requests
+        from gogo_scraper import CHALLENGE_MARKERS
+
+        url = self.base_url + LIST_PATH.format(page=page)
+        try:
+            resp = pool.get(url, headers={'Referer': self.base_url + '/'}, stream=False)
+        except requests.exceptions.RequestException as e:
+            print(f"Catalog page {page} failed: {e}")
+            return None
+        if resp.status_code == 404:
+            return []
+        if resp.status_code != 200 or any(marker in resp.text for marker in CHALLENGE_MARKERS):
+            print(f"Catalog page {page} is protected or unavailable (HTTP {resp.status_code}).")
+            return None
+        from bs4 import BeautifulSoup
+        doc = BeautifulSoup(resp.text, "html.parser")
+        items = []
+        for link in doc.select("ul.listing li a[href]"):
+            path = _path_of(link["href"])
+            title = link.get_text().strip()
+            if path.startswith('/category/') and title:
+                items.append((slug_of(path), title, path))
+        return items
+
+    def _store_page(self, page, items):
+        """
+        Writes a crawled page. Returns True if its titles changed.
+        """
+        import hashlib
+
+        fingerprint = hashlib.sha1("\n".join(f"{slug}\t{title}" for slug, title, _ in items).encode()).hexdigest()
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT fingerprint FROM pages WHERE page = ?", (page,)).fetchone()
+            if row is not None and row[0] == fingerprint:
+                self._conn.execute("UPDATE pages SET crawled = ? WHERE page = ?", (now, page))
+                return False
+            self._conn.execute("BEGIN")
+            try:
+                slugs = {slug for slug, _, _ in items}
+                # Titles the site no longer lists on this page (they may have
+                # moved to another one, which re-adds them).
+                for (slug,) in self._conn.execute("SELECT slug FROM titles WHERE page = ?", (page,)).fetchall():
+                    if slug not in slugs:
+                        self._conn.execute("DELETE FROM grams WHERE slug = ?", (slug,))
+                        self._conn.execute("DELETE FROM titles WHERE slug = ?", (slug,))
+                for slug, title, path in items:
+                    self._upsert(slug, title, path, page)
+                self._conn.execute("INSERT OR REPLACE INTO pages (page, fingerprint, crawled) VALUES (?, ?, ?)",
+                                   (page, fingerprint, now))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return True
+
+    def _finish(self, last_page, now):
+        # The list may have shrunk since the last crawl.
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.execute("DELETE FROM grams WHERE slug IN (SELECT slug FROM titles WHERE page >= ?)",
+                               (last_page,))
+            self._conn.execute("DELETE FROM titles WHERE page >= ?", (last_page,))
+            self._conn.execute("DELETE FROM pages WHERE page >= ?", (last_page,))
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('refreshed', ?)", (str(now),))
+            self._conn.execute("COMMIT")
+            # Folds the crawl's write-ahead log back into the database file.
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def _upsert(self, slug, title, path, page):
+        # Called with self._lock held, inside a transaction. Episode counts
+        # are kept; a title learned from a live search keeps no page.
+        row = self._conn.execute("SELECT title FROM titles WHERE slug = ?", (slug,)).fetchone()
+        grams = trigrams(title)
+        self._conn.execute(
+            "INSERT INTO titles (slug, title, path, page, episodes, grams) VALUES (?, ?, ?, ?, NULL, ?) "
+            "ON CONFLICT (slug) DO UPDATE SET title = excluded.title, path = excluded.path, "
+            "page = COALESCE(excluded.page, titles.page), grams = excluded.grams",
+            (slug, title, path, page, len(grams)))
+        if row is not None:
+            if row[0] == title:
+                return
+            self._conn.execute("DELETE FROM grams WHERE slug = ?", (slug,))
+        self._conn.executemany("INSERT INTO grams (gram, slug) VALUES (?, ?)", ((gram, slug) for gram in grams))
+
+def _path_of(url):
+    """
+    The path of a site URL, so stored titles follow ANIME_BASE_URL.
+    """
+    match = re.match(r'[a-z]+://[^/]+', url)
+    return url[match.end():] if match else url
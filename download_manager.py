@@ -0,0 +1,211 @@
+import itertools
+import os
+import queue
+import threading
+import time
+
+# Tunables, overridable from the environment.
+DOWNLOAD_CONCURRENCY = int(os.environ.get('ANIME_DOWNLOAD_CONCURRENCY', '2'))  # episodes downloaded at once
+DOWNLOAD_LIMIT_KBPS = float(os.environ.get('ANIME_DOWNLOAD_LIMIT_KBPS', '0'))  # shared cap, 0 = unlimited
+
+# Lower runs first. The episode being watched jumps ahead of everything else.
+PRIORITY_CURRENT = 0
+PRIORITY_NORMAL = 10
+
+class TokenBucket:
+    """
+    Byte-rate limiter shared by every download thread.
+    Callers may overdraw it; they then sleep until the debt is paid off.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            debt = -self._tokens
+        if debt > 0:
+            time.sleep(debt / self.rate)
+
+class DownloadJob:
+    def __init__(self, job_id, label, stream_url, referer, filename, subs, priority):
+        self.id = job_id
+        self.label = label
+        self.stream_url = stream_url
+        self.referer = referer
+        self.filename = filename
+        self.subs = subs
+        self.priority = priority
+        self.status = 'queued'  # queued, downloading, done, failed, cancelled
+        self.progress = {}
+        self.downloaded_bytes = 0
+        self.cancel_event = threading.Event()
+        self.started = None
+        self.finished = None
+        self.message = None  # the downloader's latest status message
+
+    def describe(self):
+        line = f"#{self.id:<3} {self.status:<11} {self.label}"
+        if self.status == 'downloading' and self.progress:
+            p = self.progress.get('_percent_str', '0%').strip()
+            s = self.progress.get('_speed_str', 'N/A').strip()
+            e = self.progress.get('_eta_str', 'N/A').strip()
+            line += f"  {p} | {s} | ETA {e}"
+        elif self.status == 'done' and self.started:
+            line += f"  ({self.finished - self.started:.1f}s)"
+        elif self.status == 'failed' and self.message:
+            line += f"  ({self.message})"
+        return line
+
+class DownloadManager:
+    """
+    Runs GogoDownloader.download on worker threads, fed from a priority
+    queue, so the CLI returns to the prompt as soon as playback starts.
+    All workers share one TokenBucket, which keeps downloads from starving
+    the live stream.
+
+    on_finish(job), if given, is called on the worker thread once a job
+    has stopped running, whatever its final status. The downloader's
+    messages go to on_message(job, message) instead of the console, where
+    they would land on the interactive prompt; the latest one is kept in
+    job.message either way.
+    """
+    def __init__(self, downloader, concurrency=DOWNLOAD_CONCURRENCY, limit_kbps=DOWNLOAD_LIMIT_KBPS,
+                 on_finish=None, on_message=None):
+        self.downloader = downloader
+        self.on_finish = on_finish
+        self.on_message = on_message
+        self.throttle = TokenBucket(limit_kbps * 1024) if limit_kbps > 0 else None
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._ids = itertools.count(1)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._workers = []
+        for i in range(max(1, concurrency)):
+            worker = threading.Thread(target=self._work, name=f'download-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def submit(self, stream_url, referer, filename, subs=None, label=None, priority=PRIORITY_NORMAL):
+        with self._lock:
+            job = DownloadJob(next(self._ids), label or filename, stream_url, referer,
+                              filename, subs, priority)
+            self._jobs[job.id] = job
+            if priority == PRIORITY_CURRENT:
+                # Only one episode is being watched; earlier ones go back in line.
+                for other in self._jobs.values():
+                    if other is not job and other.status == 'queued' and other.priority == PRIORITY_CURRENT:
+                        self._enqueue(other, PRIORITY_NORMAL)
+            self._enqueue(job, priority)
+        return job
+
+    def cancel(self, job_id):
+        """
+        Returns True if the job was queued or running.
+        A cancelled download keeps its .part file and resumes if resubmitted.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status not in ('queued', 'downloading'):
+                return False
+            job.cancel_event.set()
+            if job.status == 'queued':
+                job.status = 'cancelled'
+        return True
+
+    def wait(self, poll=0.5):
+        """
+        Blocks until no job is queued or running.
+        """
+        while any(job.status in ('queued', 'downloading') for job in self.jobs()):
+            time.sleep(poll)
+
+    def active_files(self):
+        """
+        File names of the jobs that are queued or running.
+        """
+        return {job.filename for job in self.jobs() if job.status in ('queued', 'downloading')}
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def summary(self):
+        """
+        Returns printable lines, one per job.
+        """
+        lines = [job.describe() for job in self.jobs()]
+        return lines or ["No downloads."]
+
+    def close(self, timeout=5):
+        """
+        Cancels everything and waits briefly for the workers to stop.
+        """
+        for job in self.jobs():
+            self.cancel(job.id)
+        for _ in self._workers:
+            self._queue.put((float('inf'), next(self._seq), None))
+        deadline = time.time() + timeout
+        for worker in self._workers:
+            worker.join(max(0, deadline - time.time()))
+
+    # Internal helpers.
+
+    def _enqueue(self, job, priority):
+        # A PriorityQueue entry cannot be moved, so a new entry is added and
+        # the stale one is skipped when it comes out (see _work).
+        job.priority = priority
+        self._queue.put((priority, next(self._seq), job))
+
+    def _log(self, job, message):
+        job.message = message.strip()
+        if self.on_message is not None:
+            self.on_message(job, job.message)
+
+    def _work(self):
+        while True:
+            priority, _, job = self._queue.get()
+            if job is None:
+                return
+            with self._lock:
+                if job.status != 'queued' or job.priority != priority:
+                    continue
+                job.status = 'downloading'
+                job.started = time.time()
+
+            def hook(d, job=job):
+                job.progress = d
+                if d.get('downloaded_bytes'):
+                    job.downloaded_bytes = d['downloaded_bytes']
+
+            try:
+                ok = self.downloader.download(job.stream_url, job.referer, job.filename, subs=job.subs,
+                                              progress_hook=hook, cancel=job.cancel_event,
+                                              throttle=self.throttle,
+                                              log=lambda message, job=job: self._log(job, message))
+            except Exception as e:
+                self._log(job, f"Download failed: {e}")
+                ok = False
+
+            with self._lock:
+                job.finished = time.time()
+                if job.cancel_event.is_set():
+                    job.status = 'cancelled'
+                else:
+                    job.status = 'done' if ok else 'failed'
+
+            if self.on_finish is not None:
+                try:
+                    self.on_finish(job)
+                except Exception as e:
+                    self._log(job, f"Finish hook failed: {e}")
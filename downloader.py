@@ -1,26 +1,137 @@
-from yt_dlp import YoutubeDL
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
 import os
+import time
 import requests
+from playlist import resolve_uri
+from upstream import UpstreamPool, USER_AGENT, backoff
+from episode_store import PART_SUFFIX, MANIFEST_SUFFIX, load_manifest
+from segment_cache import shared_cache
+from variants import parse_attributes, parse_master_playlist, choose_variant, describe
+import tracing
+
+# Tunables, overridable from the environment.
+DOWNLOAD_WORKERS = int(os.environ.get('ANIME_DOWNLOAD_WORKERS', '8'))  # segments fetched in parallel
+SEGMENT_RETRIES = 4
+RETRY_BACKOFF = 0.5  # seconds, doubled after every failed attempt (with jitter)
+READ_CHUNK = 64 * 1024  # segment bodies are read (and throttled) in chunks of this size
+# Variant ceilings for downloads, independent of the ones used for streaming.
+DOWNLOAD_MAX_HEIGHT = int(os.environ.get('ANIME_DOWNLOAD_MAX_HEIGHT', '0'))  # 0 = best available
+DOWNLOAD_MAX_BANDWIDTH_KBPS = int(os.environ.get('ANIME_DOWNLOAD_MAX_BANDWIDTH_KBPS', '0'))
+
+class UnsupportedStream(Exception):
+    """
+    The native HLS engine cannot handle this playlist; yt-dlp is used instead.
+    """
+
+class DownloadCancelled(Exception):
+    """
+    Raised inside a download once its cancel event is set.
+    """
+
+class _YtdlpLogger:
+    """
+    Hands yt-dlp's output to a download's log instead of the console.
+    """
+    def __init__(self, log):
+        self.log = log
+
+    def debug(self, message):
+        # yt-dlp sends its regular output here too, without the prefix.
+        if not message.startswith('[debug] '):
+            self.log(message)
+
+    def warning(self, message):
+        self.log(message)
+
+    def error(self, message):
+        self.log(message)
+
+def parse_media_playlist(text):
+    """
+    Returns {'segments': [(duration, uri)], 'init': uri or None}.
+    Raises UnsupportedStream for features the native engine leaves to yt-dlp.
+    """
+    segments = []
+    init = None
+    duration = 0.0
+    ended = False
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('#EXTINF'):
+            try:
+                duration = float(line.split(':', 1)[1].split(',', 1)[0])
+            except ValueError:
+                duration = 0.0
+        elif line.startswith('#EXT-X-KEY'):
+            if parse_attributes(line).get('METHOD', 'NONE') != 'NONE':
+                raise UnsupportedStream("encrypted segments")
+        elif line.startswith('#EXT-X-BYTERANGE'):
+            raise UnsupportedStream("byte-range segments")
+        elif line.startswith('#EXT-X-MAP'):
+            attrs = parse_attributes(line)
+            if 'BYTERANGE' in attrs or init is not None:
+                raise UnsupportedStream("unsupported EXT-X-MAP")
+            init = attrs.get('URI')
+        elif line.startswith('#EXT-X-ENDLIST'):
+            ended = True
+        elif not line.startswith('#'):
+            segments.append((duration, line))
+            duration = 0.0
+    if not ended:
+        raise UnsupportedStream("live playlist")
+    if not segments:
+        raise UnsupportedStream("no segments")
+    return {'segments': segments, 'init': init}
+
+def format_size(num_bytes):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if num_bytes < 1024 or unit == 'GiB':
+            return f"{num_bytes:.2f}{unit}"
+        num_bytes /= 1024
 
 class GogoDownloader:
-    def __init__(self, download_dir="downloads"):
+    def __init__(self, download_dir="downloads", workers=DOWNLOAD_WORKERS,
+                 max_height=DOWNLOAD_MAX_HEIGHT, max_bandwidth_kbps=DOWNLOAD_MAX_BANDWIDTH_KBPS,
+                 cache=None):
         self.download_dir = download_dir
+        self.workers = workers
+        # Segments the proxy already fetched are read from here, and the
+        # ones fetched here are left for the proxy (see segment_cache.py).
+        self.cache = cache if cache is not None else shared_cache()
+        # Ceilings for the variant picked from a master playlist, 0 = none.
+        self.max_height = max_height
+        self.max_bandwidth = max_bandwidth_kbps * 1000
+        # _fetch_segment retries segments itself, body read included.
+        self._http = UpstreamPool(pool_size=max(workers, 4), retries=0)
         if not os.path.exists(download_dir):
             os.makedirs(download_dir)
 
-    def download(self, stream_url, referer, filename, subs=None):
+    def download(self, stream_url, referer, filename, subs=None,
+                 progress_hook=None, cancel=None, throttle=None, log=None):
         """
-        Downloads the video from the stream_url using yt-dlp.
-        Also downloads subtitles if provided.
+        Downloads the video from the stream_url.
+        HLS streams are fetched by the native engine, anything it cannot
+        handle falls back to yt-dlp. Also downloads subtitles if provided.
+
+        progress_hook replaces the default console progress line, cancel is
+        a threading.Event that aborts the download (keeping what was written
+        for a later resume) and throttle is a shared TokenBucket. log
+        replaces print for the status messages (yt-dlp's included).
         """
+        progress_hook = progress_hook or self._progress_hook
+        log = log or print
         output_path = os.path.join(self.download_dir, filename)
-        
+
         # Ensure filename ends with mp4
         if not filename.endswith(".mp4"):
             output_path += ".mp4"
 
-        print(f"Starting download: {filename}")
-        
+        log(f"Starting download: {filename}")
+
         # Download Subtitles first (or parallel)
         if subs:
             # Prefer English
@@ -28,40 +139,264 @@ class GogoDownloader:
             sub_url = target_sub['url']
             sub_ext = sub_url.split(".")[-1] # vtt usually
             sub_filename = output_path.replace(".mp4", f".{sub_ext}")
-            
-            print(f"Downloading subtitle ({target_sub['lang']}): {sub_filename}...")
+
+            log(f"Downloading subtitle ({target_sub['lang']}): {sub_filename}...")
             try:
-                r = requests.get(sub_url)
+                r = self._http.get(sub_url, stream=False)
                 if r.status_code == 200:
                     with open(sub_filename, 'wb') as f:
                         f.write(r.content)
-                    print("Subtitle downloaded.")
+                    log("Subtitle downloaded.")
                 else:
-                    print(f"Failed to download subtitle: {r.status_code}")
+                    log(f"Failed to download subtitle: {r.status_code}")
             except Exception as e:
-                print(f"Subtitle download error: {e}")
-        
+                log(f"Subtitle download error: {e}")
+
+        started = time.perf_counter()
+        ok = self._download_video(stream_url, referer, filename, output_path, progress_hook, cancel, throttle, log)
+        tracing.record('download.episode', started, filename=filename, ok=ok)
+        return ok
+
+    def _download_video(self, stream_url, referer, filename, output_path, progress_hook, cancel=None, throttle=None,
+                        log=print):
+        """
+        Natively if the stream allows it, with yt-dlp otherwise. Returns True on success.
+        """
+        try:
+            self.download_hls(stream_url, referer, output_path, progress_hook, cancel, throttle, log)
+            log("\nDownload complete!")
+            return True
+        except UnsupportedStream as e:
+            log(f"Native HLS download not possible ({e}), using yt-dlp.")
+        except DownloadCancelled:
+            log(f"\nDownload cancelled: {filename}")
+            return False
+        except Exception as e:
+            log(f"\nDownload failed: {e}")
+            return False
+
+        return self._download_ytdlp(stream_url, referer, output_path, progress_hook, cancel, throttle, log)
+
+    def _download_ytdlp(self, stream_url, referer, output_path, progress_hook, cancel=None, throttle=None,
+                        log=print):
+        def hook(d):
+            if cancel is not None and cancel.is_set():
+                raise DownloadCancelled()
+            progress_hook(d)
+
         ydl_opts = {
-            'format': 'best',
+            'format': self._ytdlp_format(),
             'outtmpl': output_path,
             'quiet': False,
             'no_warnings': True,
             'http_headers': {
                 'Referer': referer,
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+                'User-Agent': USER_AGENT
             },
-            'progress_hooks': [self._progress_hook],
+            'progress_hooks': [hook],
         }
-        
+        if throttle is not None and throttle.rate:
+            ydl_opts['ratelimit'] = throttle.rate
+        if log is not print:
+            ydl_opts['quiet'] = True
+            ydl_opts['logger'] = _YtdlpLogger(log)
+
         try:
+            # yt-dlp's extractor registry is slow to import; most downloads never need it.
+            from yt_dlp import YoutubeDL
             with YoutubeDL(ydl_opts) as ydl:
                 ydl.download([stream_url])
-            print("\nDownload complete!")
+            log("\nDownload complete!")
             return True
         except Exception as e:
-            print(f"\nDownload failed: {e}")
+            if cancel is not None and cancel.is_set():
+                log(f"\nDownload cancelled: {output_path}")
+            else:
+                log(f"\nDownload failed: {e}")
             return False
 
+    def _ytdlp_format(self):
+        filters = ""
+        if self.max_height:
+            filters += f"[height<=?{self.max_height}]"
+        if self.max_bandwidth:
+            filters += f"[tbr<=?{self.max_bandwidth // 1000}]"
+        if not filters:
+            return 'best'
+        # Fall back to the smallest stream rather than failing outright.
+        return f"best{filters}/worst"
+
+    def _get_text(self, url, referer):
+        resp = self._http.get(url, headers={'Referer': referer}, stream=False)
+        resp.raise_for_status()
+        return resp.text
+
+    def _fetch_segment(self, url, referer, cancel=None, throttle=None):
+        """
+        Fetches one segment, retrying it on its own with exponential backoff.
+        Segments in the shared cache are read from disk and not throttled.
+        """
+        started = time.perf_counter()
+        cached = self.cache.get(url, 'download')
+        if cached is not None:
+            tracing.record('download.segment', started, cached=True, bytes=len(cached))
+            return cached
+        for attempt in range(SEGMENT_RETRIES):
+            try:
+                resp = self._http.get(url, headers={'Referer': referer})
+                try:
+                    resp.raise_for_status()
+                    chunks = []
+                    for chunk in resp.iter_content(READ_CHUNK):
+                        if cancel is not None and cancel.is_set():
+                            raise DownloadCancelled()
+                        if throttle is not None:
+                            throttle.consume(len(chunk))
+                        chunks.append(chunk)
+                    body = b"".join(chunks)
+                    if resp.status_code == 200:
+                        self.cache.put(url, body, 'download')
+                    tracing.record('download.segment', started, cached=False, bytes=len(body), attempts=attempt + 1)
+                    return body
+                finally:
+                    resp.close()
+            except requests.exceptions.RequestException:
+                if attempt == SEGMENT_RETRIES - 1:
+                    raise
+                time.sleep(backoff(attempt, RETRY_BACKOFF))
+
+    def resolve_playlist(self, stream_url, referer, log=print):
+        """
+        Fetches the stream's media playlist, picking the highest-bandwidth
+        variant of a master playlist that fits max_height and max_bandwidth.
+        Returns (media playlist url, parsed playlist).
+        """
+        with tracing.span('download.playlist') as info:
+            text = self._get_text(stream_url, referer)
+            variants = parse_master_playlist(text)
+            media_url = stream_url
+            if variants:
+                best = choose_variant(variants, self.max_height, self.max_bandwidth)
+                if self.max_height or self.max_bandwidth:
+                    log(f"Downloading the {describe(best)} variant.")
+                media_url = resolve_uri(stream_url, best['uri'])
+                info['variant'] = describe(best)
+                text = self._get_text(media_url, referer)
+            return media_url, parse_media_playlist(text)
+
+    def download_hls(self, stream_url, referer, output_path, progress_hook=None, cancel=None, throttle=None,
+                     log=print):
+        """
+        Downloads an HLS stream by fetching segments on a pool of workers and
+        appending them to output_path in playlist order.
+
+        At most workers * 2 segments are held in memory. Progress is recorded
+        in a manifest after every segment, so an interrupted download resumes
+        from the last written segment instead of starting over.
+        """
+        progress_hook = progress_hook or self._progress_hook
+        media_url, parsed = self.resolve_playlist(stream_url, referer, log)
+        segments = [(duration, resolve_uri(media_url, uri)) for duration, uri in parsed['segments']]
+        init_url = resolve_uri(media_url, parsed['init']) if parsed['init'] else None
+
+        part_path = output_path + PART_SUFFIX
+        manifest_path = output_path + MANIFEST_SUFFIX
+        # Segment URLs carry expiring tokens, so match a previous attempt by
+        # the playlist's URI paths rather than the full URLs.
+        fingerprint = hashlib.sha1("\n".join(
+            uri.split('?', 1)[0] for _, uri in parsed['segments']).encode()).hexdigest()
+
+        manifest = self._load_manifest(manifest_path)
+        if manifest and manifest.get('fingerprint') == fingerprint and os.path.exists(part_path) \
+                and os.path.getsize(part_path) >= manifest['bytes']:
+            log(f"Resuming at segment {manifest['written'] + 1}/{len(segments)}.")
+        else:
+            manifest = {
+                'fingerprint': fingerprint,
+                'segments': len(segments),
+                'written': 0,
+                'bytes': 0,
+                'init_bytes': 0,
+                'durations': [],
+                'sizes': [],
+                'complete': False,
+            }
+
+        with open(part_path, 'r+b' if manifest['bytes'] else 'wb') as out:
+            # Drop anything written after the last recorded segment.
+            out.truncate(manifest['bytes'])
+            out.seek(manifest['bytes'])
+
+            if init_url and not manifest['init_bytes']:
+                data = self._fetch_segment(init_url, referer, cancel, throttle)
+                out.write(data)
+                manifest['init_bytes'] = len(data)
+                manifest['bytes'] += len(data)
+
+            start = manifest['written']
+            started = time.time()
+            window = self.workers * 2
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='segment') as pool:
+                pending = {}
+                try:
+                    for i in range(start, len(segments)):
+                        if cancel is not None and cancel.is_set():
+                            raise DownloadCancelled()
+                        # Keep the next `window` segments in flight.
+                        for j in range(i, min(i + window, len(segments))):
+                            if j not in pending:
+                                pending[j] = pool.submit(self._fetch_segment, segments[j][1], referer, cancel, throttle)
+
+                        data = pending.pop(i).result()
+                        out.write(data)
+                        out.flush()
+                        manifest['written'] = i + 1
+                        manifest['bytes'] += len(data)
+                        manifest['durations'].append(segments[i][0])
+                        manifest['sizes'].append(len(data))
+                        self._save_manifest(manifest_path, manifest)
+                        self._report_progress(progress_hook, manifest, len(segments), start, started)
+                finally:
+                    for future in pending.values():
+                        future.cancel()
+
+        os.replace(part_path, output_path)
+        manifest['complete'] = True
+        self._save_manifest(manifest_path, manifest)
+        progress_hook({'status': 'finished', 'filename': output_path})
+
+    def _report_progress(self, progress_hook, manifest, total, start, started):
+        """
+        Feeds _progress_hook with the same fields yt-dlp reports.
+        """
+        done = manifest['written']
+        elapsed = max(time.time() - started, 1e-6)
+        new_bytes = sum(manifest['sizes'][start:])
+        speed = new_bytes / elapsed
+        rate = (done - start) / elapsed
+        eta = (total - done) / rate if rate else 0
+        progress_hook({
+            'status': 'downloading',
+            'downloaded_bytes': manifest['bytes'],
+            'total_bytes_estimate': manifest['bytes'] / done * total if done else None,
+            'fragment_index': done,
+            'fragment_count': total,
+            'speed': speed,
+            'eta': eta,
+            '_percent_str': f"{done / total * 100:.1f}%",
+            '_speed_str': f"{format_size(speed)}/s",
+            '_eta_str': time.strftime('%M:%S', time.gmtime(eta)),
+        })
+
+    def _load_manifest(self, manifest_path):
+        return load_manifest(manifest_path)
+
+    def _save_manifest(self, manifest_path, manifest):
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+
     def _progress_hook(self, d):
         if d['status'] == 'downloading':
             p = d.get('_percent_str', '0%')
@@ -0,0 +1,318 @@
+"""
+Downloaded episodes, kept on disk across sessions within a byte budget.
+
+index.json in the download folder records each episode's title, number,
+size and whether the download finished. When the folder grows past the
+budget, the episodes watched least recently are deleted first.
+"""
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import time
+
+from utils import sanitize_filename
+
+# Tunables, overridable from the environment.
+STORE_DIR = os.environ.get('ANIME_STORE_DIR', 'downloads')
+STORE_BUDGET_MB = float(os.environ.get('ANIME_STORE_BUDGET_MB', '10240'))
+# The old behaviour: empty the folder when the CLI starts and exits.
+WIPE_DOWNLOADS = os.environ.get('ANIME_WIPE_DOWNLOADS', '0') == '1'
+
+INDEX_FILE = 'index.json'
+
+# Sidecar files next to a downloaded episode: the partial video, and the
+# manifest that records how far it got (and each written segment's
+# duration and size).
+PART_SUFFIX = ".part"
+MANIFEST_SUFFIX = ".hls.json"
+
+# Files written by GogoDownloader, for picking up episodes the index misses.
+EPISODE_FILE = re.compile(r'(.+) - Episode (\d+)\.mp4(?:\.part)?\Z')
+
+class EpisodeStore:
+    """
+    Index of the episodes in the download folder, with LRU eviction.
+    An episode is the .mp4 plus its sidecars (.part, .hls.json, subtitles).
+    """
+    def __init__(self, directory=STORE_DIR, budget_mb=STORE_BUDGET_MB):
+        self.directory = directory
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._entries = self._load()  # file name -> entry
+        self.reconcile()
+
+    @staticmethod
+    def filename(title, episode):
+        return f"{sanitize_filename(title)} - Episode {episode}.mp4"
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def lookup(self, title, episode):
+        """
+        Returns {'path', 'subs'} for a completely downloaded episode, else None.
+        'subs' is the subtitle file next to it, or None.
+        """
+        filename = self.filename(title, episode)
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None or not entry['complete']:
+                return None
+        path = self.path(filename)
+        if not os.path.exists(path):
+            self.refresh(filename)
+            return None
+        subs = subtitle_file(self.directory, filename)
+        return {'path': path, 'subs': self.path(subs) if subs else None}
+
+    def add(self, title, episode, series_url=None):
+        """
+        Records an episode that is about to be downloaded (or resumed) and
+        marks it watched now. Returns its file name.
+        """
+        filename = self.filename(title, episode)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.setdefault(filename, {
+                'title': title,
+                'episode': episode,
+                'series_url': series_url,
+                'size': 0,
+                'complete': False,
+                'added': now,
+            })
+            entry['watched'] = now
+            if series_url:
+                entry['series_url'] = series_url
+            self._save()
+        return filename
+
+    def touch(self, title, episode):
+        """
+        Marks a stored episode as watched now, so it is evicted last.
+        """
+        with self._lock:
+            entry = self._entries.get(self.filename(title, episode))
+            if entry is not None:
+                entry['watched'] = time.time()
+                self._save()
+
+    def refresh(self, filename):
+        """
+        Re-reads an episode's size and completeness from disk, e.g. after its
+        download finished. Entries whose files are gone are dropped.
+        """
+        size, complete, exists = self._measure(filename)
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                return
+            if exists:
+                entry['size'] = size
+                entry['complete'] = complete
+            else:
+                del self._entries[filename]
+            self._save()
+
+    def evict(self, protect=()):
+        """
+        Deletes the least recently watched episodes until the store fits the
+        budget. Episodes in `protect` (file names) are never deleted.
+        Returns the file names that were removed.
+        """
+        removed = []
+        with self._lock:
+            total = sum(entry['size'] for entry in self._entries.values())
+            if total <= self.budget_bytes:
+                return removed
+            for filename, entry in sorted(self._entries.items(), key=lambda item: item[1]['watched']):
+                if total <= self.budget_bytes:
+                    break
+                if filename in protect:
+                    continue
+                for path in self._files(filename):
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        print(f"Failed to delete {path}. Reason: {e}")
+                total -= entry['size']
+                del self._entries[filename]
+                removed.append(filename)
+            self._save()
+        for filename in removed:
+            print(f"Removed {filename} from the download folder (over the {format_mb(self.budget_bytes)} budget).")
+        return removed
+
+    def reconcile(self):
+        """
+        Brings the index in line with the folder: re-measures every entry,
+        drops the ones whose files are gone and adds episode files it has
+        no record of, as watched when they were last modified.
+        """
+        names = os.listdir(self.directory)
+        with self._lock:
+            for name in names:
+                match = EPISODE_FILE.match(name)
+                if match is None:
+                    continue
+                filename = name[:-len('.part')] if name.endswith('.part') else name
+                if filename not in self._entries:
+                    mtime = os.path.getmtime(self.path(name))
+                    self._entries[filename] = {
+                        'title': match.group(1),
+                        'episode': int(match.group(2)),
+                        'series_url': None,
+                        'size': 0,
+                        'complete': False,
+                        'added': mtime,
+                        'watched': mtime,
+                    }
+            for filename in list(self._entries):
+                size, complete, exists = self._measure(filename, names)
+                if exists:
+                    self._entries[filename].update(size=size, complete=complete)
+                else:
+                    del self._entries[filename]
+            self._save()
+
+    def wipe(self):
+        """
+        Deletes everything in the download folder, index included.
+        """
+        print("Cleaning up downloads folder...")
+        for filename in os.listdir(self.directory):
+            file_path = self.path(filename)
+            try:
+                if os.path.isfile(file_path) or os.path.islink(file_path):
+                    os.unlink(file_path)
+                elif os.path.isdir(file_path):
+                    shutil.rmtree(file_path)
+            except Exception as e:
+                print(f"Failed to delete {file_path}. Reason: {e}")
+        with self._lock:
+            self._entries = {}
+
+    def stats(self):
+        with self._lock:
+            entries = list(self._entries.values())
+        return {
+            'episodes': len(entries),
+            'complete': sum(1 for e in entries if e['complete']),
+            'bytes': sum(e['size'] for e in entries),
+            'budget_bytes': self.budget_bytes,
+        }
+
+    def summary(self):
+        """
+        Returns printable lines: one per episode, most recently watched first.
+        """
+        with self._lock:
+            entries = sorted(self._entries.values(), key=lambda e: e['watched'], reverse=True)
+        stats = self.stats()
+        lines = [f"{e['title']} - Episode {e['episode']}: {format_mb(e['size'])}"
+                 f"{'' if e['complete'] else ' (partial)'}" for e in entries]
+        lines.append(f"{stats['episodes']} episodes, {format_mb(stats['bytes'])} "
+                     f"of {format_mb(stats['budget_bytes'])} ({self.directory})")
+        return lines
+
+    # Internal helpers.
+
+    def _files(self, filename, names=None):
+        stem = filename[:-len('.mp4')] + '.'
+        names = os.listdir(self.directory) if names is None else names
+        return [self.path(name) for name in names if name.startswith(stem)]
+
+    def _measure(self, filename, names=None):
+        """
+        Returns (bytes on disk, complete, any file present) for an episode.
+        The .mp4 only appears once its download finished; until then it is
+        a .part file.
+        """
+        size = 0
+        exists = False
+        for path in self._files(filename, names):
+            try:
+                size += os.path.getsize(path)
+                exists = True
+            except OSError:
+                pass
+        return size, os.path.exists(self.path(filename)), exists
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._entries, f, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+def format_mb(num_bytes):
+    return f"{num_bytes / (1024 * 1024):.1f} MB"
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def local_media(directory, filename):
+    """
+    Describes what of a downloaded episode can be played from disk, or
+    returns None if nothing can. Keys:
+
+        path      file holding the video (.mp4, or .part while downloading)
+        size      bytes of it that are safe to serve
+        complete  the download finished
+        manifest  the native engine's manifest, None for yt-dlp downloads
+    """
+    path = os.path.join(directory, filename)
+    manifest = load_manifest(path + MANIFEST_SUFFIX)
+    if os.path.exists(path):
+        return {'path': path, 'size': os.path.getsize(path), 'complete': True, 'manifest': manifest}
+    part_path = path + PART_SUFFIX
+    if manifest is None or not manifest.get('written') or not os.path.exists(part_path):
+        return None
+    # Bytes after the last recorded segment may be a half-written one.
+    size = min(manifest['bytes'], os.path.getsize(part_path))
+    return {'path': part_path, 'size': size, 'complete': False, 'manifest': manifest}
+
+def local_playlist(manifest, uri, complete):
+    """
+    Builds a media playlist that plays the segments a manifest records
+    straight out of the downloaded file, as byte ranges of `uri`.
+    Until the download is complete the playlist has no ENDLIST, so the
+    player reloads it and picks up newly written segments.
+    """
+    durations = manifest['durations']
+    sizes = manifest['sizes']
+    target = max(1, math.ceil(max(durations))) if durations else 10
+    lines = ["#EXTM3U", "#EXT-X-VERSION:4", f"#EXT-X-TARGETDURATION:{target}",
+             "#EXT-X-MEDIA-SEQUENCE:0", f"#EXT-X-PLAYLIST-TYPE:{'VOD' if complete else 'EVENT'}"]
+    offset = manifest.get('init_bytes', 0)
+    if offset:
+        lines.append(f'#EXT-X-MAP:URI="{uri}",BYTERANGE="{offset}@0"')
+    for duration, size in zip(durations, sizes):
+        lines += [f"#EXTINF:{duration:.6f},", f"#EXT-X-BYTERANGE:{size}@{offset}", uri]
+        offset += size
+    if complete:
+        lines.append("#EXT-X-ENDLIST")
+    return "\n".join(lines) + "\n"
+
+def subtitle_file(directory, filename):
+    """
+    Returns the name of the subtitle file saved next to an episode, or None.
+    """
+    stem = filename[:-len('.mp4')] + '.'
+    return next((name for name in sorted(os.listdir(directory))
+                 if name.startswith(stem) and name.endswith(('.vtt', '.srt', '.ass'))), None)
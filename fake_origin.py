@@ -0,0 +1,252 @@
+"""
+A local stand-in for the anime site and its CDN, for benchmarks and offline runs.
+
+    python fake_origin.py --port 8080 --segments 120 --segment-kb 512 --latency-ms 50
+    ANIME_BASE_URL=http://127.0.0.1:8080 python main.py
+
+It serves the pages GogoScraper reads (search results, the paged anime list
+catalog.py crawls, category pages with #episode_page ranges, episode pages with the player iframe, embed pages whose
+script requests master.m3u8) and the HLS tree behind them: a master
+playlist with three variants and media playlists that use the same path
+quirks as Gogoanime's CDNs (missing leading slash, repeated base path).
+Segment URLs that were not de-duplicated the way proxy() does are 404s.
+--no-quirks serves plain relative segment names instead, which tools that
+resolve URLs by the RFC (e.g. yt-dlp) can follow.
+"""
+import argparse
+import hashlib
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlparse
+
+# slug -> (title, episode count)
+CATALOG = {
+    'bleach': ("Bleach", 366),
+    'bleach-thousand-year-blood-war': ("Bleach: Thousand-Year Blood War", 26),
+    'naruto': ("Naruto", 220),
+    'one-piece': ("One Piece", 1100),
+    'frieren': ("Sousou no Frieren", 28),
+}
+
+# (name, bandwidth, resolution). Listed lowest first, like most CDNs.
+VARIANTS = [
+    ('360', 800000, '640x360'),
+    ('720', 2800000, '1280x720'),
+    ('1080', 5000000, '1920x1080'),
+]
+
+SEGMENT_DURATION = 10.0
+EPISODE_RANGE = 100  # episodes per #episode_page entry, as on the real site
+LIST_PAGE_SIZE = 136  # titles per /anime-list.html page, as on the real site
+
+# Words for the made-up titles added with start_fake_origin(extra_titles=...).
+TITLE_WORDS = ("blade", "sky", "spirit", "academy", "dragon", "moon", "hero", "shadow", "star",
+               "kingdom", "summer", "ghost", "magic", "ocean", "iron", "sword", "garden", "storm")
+
+SEGMENT_PATH = re.compile(r'/hls/([\w-]+)/(\d+)/(\d+)/seg-([\w-]+)\.ts\Z')
+
+class FakeOriginHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are separate writes; without this, delayed ACKs add
+    # about 40 ms to every response.
+    disable_nagle_algorithm = True
+    # Set per server by start_fake_origin().
+    segments = 120
+    quirks = True
+    segment_blob = b''
+    catalog = CATALOG
+    latency = 0.0
+    page_latency = 0.0
+    requests = None  # path -> count
+    lock = None
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def base(self):
+        return f"http://{self.headers.get('Host') or '%s:%d' % self.server.server_address[:2]}"
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        path = parsed.path
+        with self.lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+        if path == '/search.html':
+            return self.search(parse_qs(parsed.query).get('keyword', [''])[0])
+        if path == '/anime-list.html':
+            return self.anime_list(int(parse_qs(parsed.query).get('page', ['1'])[0]))
+        if path.startswith('/category/'):
+            return self.category(path[len('/category/'):])
+        if path.startswith('/embed/'):
+            return self.embed(path)
+        if path.startswith('/subs/'):
+            return self.send('WEBVTT\n\n00:00:01.000 --> 00:00:04.000\nFake subtitle\n', 'text/vtt')
+        if path.startswith('/hls/'):
+            return self.hls(path)
+        match = re.match(r'/([\w-]+)-episode-(\d+)\Z', path)
+        if match:
+            return self.episode(match.group(1), int(match.group(2)))
+        self.send('Not found', 'text/plain', 404)
+
+    # Site pages
+
+    def search(self, keyword):
+        time.sleep(self.page_latency)
+        items = "".join(
+            f'<li><p class="name"><a href="/category/{slug}" title="{title}">{title}</a></p></li>'
+            for slug, (title, _) in self.catalog.items() if keyword.lower() in title.lower())
+        self.send(f'<html><body><ul class="items">{items}</ul></body></html>', 'text/html')
+
+    def anime_list(self, page):
+        time.sleep(self.page_latency)
+        # Sorted by title like the real list; past the last page it is empty.
+        titles = sorted(self.catalog.items(), key=lambda item: item[1][0].lower())
+        start = (page - 1) * LIST_PAGE_SIZE
+        items = "".join(f'<li title="{title}"><a href="/category/{slug}">{title}</a></li>'
+                        for slug, (title, _) in titles[start:start + LIST_PAGE_SIZE] if page >= 1)
+        self.send(f'<html><body><ul class="listing">{items}</ul></body></html>', 'text/html')
+
+    def category(self, slug):
+        time.sleep(self.page_latency)
+        if slug not in self.catalog:
+            return self.send('Not found', 'text/html', 404)
+        title, count = self.catalog[slug]
+        ranges = "".join(
+            f'<li><a href="#" ep_start="{start}" ep_end="{min(start + EPISODE_RANGE, count)}">'
+            f'{start}-{min(start + EPISODE_RANGE, count)}</a></li>'
+            for start in range(0, count, EPISODE_RANGE))
+        self.send(f'<html><body><h1>{title}</h1><ul id="episode_page">{ranges}</ul></body></html>', 'text/html')
+
+    def episode(self, slug, number):
+        time.sleep(self.page_latency)
+        if slug not in self.catalog or not 1 <= number <= self.catalog[slug][1]:
+            return self.send('Not found', 'text/html', 404)
+        subs = quote(f"{self.base}/subs/{slug}/{number}.vtt", safe='')
+        src = f"{self.base}/embed/{slug}/{number}?caption_1={subs}&sub_1=English"
+        self.send(f'<html><body><iframe src="{src}" allowfullscreen></iframe></body></html>', 'text/html')
+
+    def embed(self, path):
+        time.sleep(self.page_latency)
+        parts = path.strip('/').split('/')
+        if len(parts) != 3:
+            return self.send('Not found', 'text/html', 404)
+        _, slug, number = parts
+        master = f"/hls/{slug}/{number}/master.m3u8"
+        self.send(f'<html><body><div id="player"></div>'
+                  f'<script>fetch("{master}").then(r => r.text());</script></body></html>', 'text/html')
+
+    # HLS
+
+    def hls(self, path):
+        time.sleep(self.latency)
+        parts = path.strip('/').split('/')
+        if len(parts) == 4 and parts[3] == 'master.m3u8':
+            return self.master(parts[1], parts[2])
+        if len(parts) == 4 and parts[3].endswith('.m3u8'):
+            return self.media(parts[1], parts[2], parts[3][:-len('.m3u8')])
+        match = SEGMENT_PATH.match(path)
+        if match:
+            # The same blob for every segment, made unique by its first bytes.
+            body = hashlib.md5(path.encode()).digest() + self.segment_blob[16:]
+            return self.send(body, 'video/mp2t')
+        self.send('Not found', 'text/plain', 404)
+
+    def master(self, slug, number):
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+        for name, bandwidth, resolution in VARIANTS:
+            lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={resolution}")
+            if self.quirks:
+                # No leading slash, but starting with the playlist's first
+                # path part, so proxy() resolves it against the site root.
+                lines.append(f"hls/{slug}/{number}/{name}.m3u8")
+            else:
+                lines.append(f"{name}.m3u8")
+        self.send("\n".join(lines) + "\n", 'application/vnd.apple.mpegurl')
+
+    def media(self, slug, number, variant):
+        base = f"hls/{slug}/{number}/{variant}"
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{int(SEGMENT_DURATION)}",
+                 "#EXT-X-MEDIA-SEQUENCE:0", "#EXT-X-PLAYLIST-TYPE:VOD"]
+        for i in range(self.segments):
+            name = f"seg-{i}.ts"
+            style = i % 4 if self.quirks else 0
+            if style == 0:
+                target = f"{variant}/{name}"          # plain relative
+            elif style == 1:
+                target = f"{base}/{name}"             # missing leading slash
+            elif style == 2:
+                target = f"/{base}/{base}/{name}"     # base path repeated
+            else:
+                target = f"{self.base}/{base}/{name}"  # absolute
+            lines += [f"#EXTINF:{SEGMENT_DURATION:.6f},", target]
+        lines.append("#EXT-X-ENDLIST")
+        self.send("\n".join(lines) + "\n", 'application/vnd.apple.mpegurl')
+
+    def send(self, body, content_type, status=200):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def make_titles(count):
+    """
+    `count` made-up series, e.g. {'moon-dragon-7': ("Moon Dragon 7", 12)}.
+    """
+    titles = {}
+    for i in range(count):
+        words = (TITLE_WORDS[i % len(TITLE_WORDS)], TITLE_WORDS[(i // len(TITLE_WORDS)) % len(TITLE_WORDS)])
+        title = f"{words[0].title()} {words[1].title()} {i // len(TITLE_WORDS) ** 2 + 1}"
+        titles["-".join(re.findall(r'[a-z0-9]+', title.lower()))] = (title, 12 + i % 14)
+    return titles
+
+def start_fake_origin(port=0, segments=120, segment_kb=512, latency_ms=0, page_latency_ms=0, quirks=True,
+                      extra_titles=0):
+    """
+    Starts the fake origin on a background thread.
+    Returns (server, base url); server.RequestHandlerClass.requests counts hits per path.
+    extra_titles adds made-up series to the catalog, for the anime list.
+    """
+    handler = type('FakeOrigin', (FakeOriginHandler,), {
+        'catalog': dict(CATALOG, **make_titles(extra_titles)),
+        'segments': segments,
+        'quirks': quirks,
+        'segment_blob': os.urandom(max(segment_kb * 1024, 16)),
+        'latency': latency_ms / 1000,
+        'page_latency': page_latency_ms / 1000,
+        'requests': {},
+        'lock': threading.Lock(),
+    })
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd, f"http://127.0.0.1:{httpd.server_address[1]}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the anime site and its CDN")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--segments', type=int, default=120, help="Segments per media playlist")
+    parser.add_argument('--segment-kb', type=int, default=512)
+    parser.add_argument('--latency-ms', type=float, default=0, help="Delay before playlists and segments")
+    parser.add_argument('--page-latency-ms', type=float, default=0, help="Delay before HTML pages")
+    parser.add_argument('--no-quirks', action='store_true', help="Plain relative segment URLs")
+    args = parser.parse_args()
+
+    httpd, base_url = start_fake_origin(args.port, args.segments, args.segment_kb,
+                                        args.latency_ms, args.page_latency_ms, not args.no_quirks)
+    print(f"Fake origin on {base_url} (ANIME_BASE_URL={base_url})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        httpd.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,204 @@
-from playwright.sync_api import sync_playwright
+# Playwright and BeautifulSoup are imported where they are used; together
+# they take longer to import than the rest of the CLI.
+import requests
+import asyncio
+import queue
+import threading
 import time
 import urllib.parse
 import re
+from upstream import UpstreamPool, BASE_URL
+import tracing
+
+# Markers of an anti-bot interstitial. When one shows up, the plain HTTP
+# fast path gives up and the page is loaded in the browser instead.
+CHALLENGE_MARKERS = ('cf-browser-verification', 'cf_chl_', 'challenge-platform',
+                     '<title>Just a moment...</title>', 'DDoS-Guard')
+
+# Requests aborted while a page loads in the browser.
+BLOCKED_RESOURCE_TYPES = ('image', 'font', 'media')
+BLOCKED_HOSTS = ('doubleclick.net', 'googlesyndication.com', 'google-analytics.com',
+                 'googletagmanager.com', 'googleadservices.com', 'adservice.google.com',
+                 'histats.com', 'disqus.com', 'facebook.net', 'addthis.com',
+                 'popads.net', 'popcash.net', 'propellerads.com', 'adsterra.com',
+                 'exoclick.com', 'juicyads.com', 'mgid.com', 'taboola.com')
+
+# How long to wait for the player to request the master playlist.
+STREAM_TIMEOUT_MS = 10000
+
+# Defaults for get_stream_urls(): parallel browser contexts, and the time one
+# episode may take before it is given up.
+BATCH_CONCURRENCY = 4
+BATCH_EPISODE_TIMEOUT = 45
+
+def is_master_request(req):
+    return "master.txt" in req.url or "master.m3u8" in req.url
+
+def is_blocked_request(req):
+    """
+    Requests the stream extraction does not need: images, fonts, media and
+    known ad/tracker hosts. Scripts and XHR still go through, since the
+    player has to run to request the master playlist.
+    """
+    host = urllib.parse.urlparse(req.url).hostname or ""
+    return req.resource_type in BLOCKED_RESOURCE_TYPES or host.endswith(BLOCKED_HOSTS)
+
+def normalize_embed_url(src):
+    # Ensure protocol
+    if src.startswith("//"):
+        src = "https:" + src
+    return src
+
+def parse_subtitles(src, log=print):
+    """
+    Reads caption_N / sub_N query params of an embed URL.
+    Returns a list of {'url': str, 'lang': str}.
+    """
+    subtitles = []
+    try:
+        parsed = urllib.parse.urlparse(src)
+        params = urllib.parse.parse_qs(parsed.query)
+        # Check for caption_1, caption_2, etc.
+        # Usually caption_1 and sub_1
+        for i in range(1, 10):
+            cap_key = f"caption_{i}"
+            sub_key = f"sub_{i}"
+            if cap_key in params:
+                sub_url = params[cap_key][0]
+                sub_lang = params.get(sub_key, ["English"])[0]
+                subtitles.append({"url": sub_url, "lang": sub_lang})
+    except Exception as e:
+        log(f"Subtitle extraction failed: {e}")
+    return subtitles
+
+def parse_episode_end(ep_end, data_val):
+    """
+    Gogoanime lists ranges. Check 'ep_end' first, then 'data-value' (e.g. "301-366").
+    """
+    if ep_end:
+        try:
+            return int(ep_end)
+        except ValueError:
+            pass
+    if data_val and "-" in data_val:
+        try:
+            return int(data_val.split("-")[-1])
+        except ValueError:
+            pass
+    return None
 
 class GogoScraper:
-    def __init__(self, headless=True):
+    def __init__(self, headless=True, base_url=BASE_URL):
         self.headless = headless
-        self.base_url = "https://anitaku.to"
+        self.base_url = base_url.rstrip("/")
         self._playwright = None
         self._browser = None
         self._page = None
+        # The batch API's browser, on an event loop of its own thread.
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        self._async_playwright = None
+        self._async_launch = None
+        self._http = UpstreamPool()
+        # How often the HTTP fast path had to fall back to Playwright.
+        # Updated from whichever thread fetched the page.
+        self.fast_path_stats = {'http': 0, 'fallback': 0}
+        self._stats_lock = threading.Lock()
+        self.last_timings = {}
 
     def start(self):
         """Starts the Playwright browser."""
         if not self._playwright:
-            self._playwright = sync_playwright().start()
-            self._browser = self._playwright.chromium.launch(headless=self.headless)
-            self._page = self._browser.new_page()
+            with tracing.span('scraper.browser_start'):
+                from playwright.sync_api import sync_playwright
+                self._playwright = sync_playwright().start()
+                self._browser = self._playwright.chromium.launch(headless=self.headless)
+                self._page = self._browser.new_page()
+                self._page.route("**/*", self._filter_route)
 
     def close(self):
-        """Closes the Playwright browser."""
+        """Closes the Playwright browsers."""
         if self._browser:
             self._browser.close()
             self._browser = None
         if self._playwright:
             self._playwright.stop()
             self._playwright = None
+        with self._loop_lock:
+            loop, self._loop = self._loop, None
+        if loop is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(self._close_async_browser(), loop).result(10)
+            except Exception as e:
+                print(f"Closing the batch browser failed: {e}")
+            loop.call_soon_threadsafe(loop.stop)
+        self._http.close()
+
+    def _fetch_html(self, url, log=print):
+        """
+        Fetches a page without the browser.
+        Returns a BeautifulSoup document, or None if the page is protected or unreachable.
+        """
+        try:
+            resp = self._http.get(url, headers={'Referer': self.base_url + '/'}, stream=False, timeout=(5, 10))
+        except requests.exceptions.RequestException as e:
+            log(f"HTTP fetch failed ({e}), using browser.")
+            return None
+        if resp.status_code != 200 or any(marker in resp.text for marker in CHALLENGE_MARKERS):
+            log(f"Page is protected (HTTP {resp.status_code}), using browser.")
+            return None
+        from bs4 import BeautifulSoup
+        return BeautifulSoup(resp.text, "html.parser")
+
+    def _record_fast_path(self, used_http):
+        with self._stats_lock:
+            self.fast_path_stats['http' if used_http else 'fallback'] += 1
+
+    def fast_path_summary(self):
+        """
+        Returns a one-line summary of how often the HTTP fast path worked.
+        """
+        with self._stats_lock:
+            http = self.fast_path_stats['http']
+            fallback = self.fast_path_stats['fallback']
+        total = http + fallback
+        rate = (fallback / total * 100) if total else 0.0
+        return f"HTTP fast path: {http}/{total} pages, browser fallback rate {rate:.0f}%"
 
     def search(self, query):
         """
         Searches for anime.
         Returns a list of dicts: {'title': str, 'url': str}
         """
-        self.start()
         print(f"Searching for '{query}'...")
+        started = time.perf_counter()
         search_url = f"{self.base_url}/search.html?keyword={urllib.parse.quote(query)}"
-        
+
+        doc = self._fetch_html(search_url)
+        # A missing result list means the markup is not what we expect
+        # (e.g. rendered by script), so let the browser handle it.
+        if doc is not None and doc.select_one(".items") is not None:
+            self._record_fast_path(True)
+            results = []
+            for elem in doc.select(".items li"):
+                name_tag = elem.select_one(".name a")
+                if name_tag and name_tag.get("href"):
+                    title = name_tag.get_text().strip()
+                    href = name_tag["href"]
+                    # Ensure full URL
+                    if href.startswith("/"):
+                        href = self.base_url + href
+                    results.append({"title": title, "url": href})
+            tracing.record('scraper.search', started, via='http', results=len(results))
+            return results
+
+        self._record_fast_path(False)
+        results = self._search_browser(search_url)
+        tracing.record('scraper.search', started, via='browser', results=len(results))
+        return results
+
+    def _search_browser(self, search_url):
+        self.start()
         try:
             self._page.goto(search_url, wait_until="domcontentloaded")
             self._page.wait_for_selector(".items li", timeout=10000)
@@ -62,28 +225,38 @@ class GogoScraper:
         """
         Gets the total number of episodes for an anime.
         """
-        self.start()
         print(f"Fetching episode count from {category_url}...")
+        started = time.perf_counter()
+
+        doc = self._fetch_html(category_url)
+        if doc is not None and doc.select_one("#episode_page") is not None:
+            self._record_fast_path(True)
+            count = 0
+            ep_ranges = doc.select("#episode_page li a")
+            if ep_ranges:
+                last_elem = ep_ranges[-1]
+                count = parse_episode_end(last_elem.get("ep_end"), last_elem.get("data-value")) or 0
+            tracing.record('scraper.episode_count', started, via='http', count=count)
+            return count
+
+        self._record_fast_path(False)
+        count = self._get_episode_count_browser(category_url)
+        tracing.record('scraper.episode_count', started, via='browser', count=count)
+        return count
+
+    def _get_episode_count_browser(self, category_url):
+        self.start()
         try:
             self._page.goto(category_url, wait_until="domcontentloaded")
             self._page.wait_for_selector("#episode_page", timeout=10000)
             
-            # Gogoanime lists ranges. Check 'ep_end' first, then 'data-value'.
             ep_ranges = self._page.query_selector_all("#episode_page li a")
             if ep_ranges:
                 last_elem = ep_ranges[-1]
-                ep_end = last_elem.get_attribute("ep_end")
-                if ep_end:
-                    return int(ep_end)
-                
-                # Fallback: parse data-value="301-366"
-                data_val = last_elem.get_attribute("data-value") # e.g. "301-366"
-                if data_val and "-" in data_val:
-                    try:
-                        end_val = data_val.split("-")[-1]
-                        return int(end_val)
-                    except:
-                        pass
+                count = parse_episode_end(last_elem.get_attribute("ep_end"),
+                                          last_elem.get_attribute("data-value"))
+                if count is not None:
+                    return count
             
             # If no ranges found or failed, check for single page execution?
             # Or maybe check the episode list itself #episode_related li
@@ -94,97 +267,269 @@ class GogoScraper:
             print(f"Failed to get episode count: {e}")
             return 0
 
+    def _filter_route(self, route):
+        if is_blocked_request(route.request):
+            route.abort()
+        else:
+            route.continue_()
+
+    def _find_embed_url_http(self, episode_url, log=print):
+        """
+        Reads the player iframe URL from the static episode page.
+        Returns None if the browser is needed.
+        """
+        doc = self._fetch_html(episode_url, log)
+        iframe = doc.select_one("iframe[src]") if doc is not None else None
+        self._record_fast_path(iframe is not None)
+        return iframe["src"] if iframe else None
+
+    def _find_embed_url(self, episode_url):
+        """
+        Finds the player iframe URL of an episode page.
+        Returns (embed url or None, how it was found).
+        """
+        src = self._find_embed_url_http(episode_url)
+        if src:
+            return src, "http"
+
+        self.start()
+        self._page.goto(episode_url, wait_until="domcontentloaded")
+        iframe = self._page.query_selector("iframe")
+        if not iframe:
+            return None, "browser"
+        return iframe.get_attribute("src"), "browser"
+
     def get_stream_url(self, episode_url):
         """
         Extracts the HLS stream URL (master.txt/m3u8) for an episode.
         Returns: {'url': str, 'referer': str} or None
+        Per-phase timings of the last call are kept in self.last_timings.
         """
-        self.start()
         print(f"Extracting stream from {episode_url}...")
+        started = time.perf_counter()
+        self.last_timings = {}
         
-        # 1. Go to episode page
         try:
-            self._page.goto(episode_url, wait_until="domcontentloaded")
-            
-            # 2. Find iframe
-            iframe = self._page.query_selector("iframe")
-            if not iframe:
+            # 1. Find the embed URL. The iframe is in the static HTML, so a
+            # plain request is enough unless the page is protected.
+            src, via = self._find_embed_url(episode_url)
+            self.last_timings['episode_page'] = time.perf_counter() - started
+            self.last_timings['episode_page_via'] = via
+            tracing.record('scraper.episode_page', started, via=via, found=src is not None)
+            if not src:
                 print("No video iframe found.")
                 return None
             
-            src = iframe.get_attribute("src")
-            # Ensure protocol
-            if src.startswith("//"):
-                src = "https:" + src
-            
+            src = normalize_embed_url(src)
             print(f"Found embed source: {src}")
             
             # Extract subtitles from URL params
-            subtitles = []
-            try:
-                parsed = urllib.parse.urlparse(src)
-                params = urllib.parse.parse_qs(parsed.query)
-                # Check for caption_1, caption_2, etc.
-                # Usually caption_1 and sub_1
-                for i in range(1, 10):
-                    cap_key = f"caption_{i}"
-                    sub_key = f"sub_{i}"
-                    if cap_key in params:
-                        sub_url = params[cap_key][0]
-                        sub_lang = params.get(sub_key, ["English"])[0]
-                        subtitles.append({"url": sub_url, "lang": sub_lang})
-                
-                if subtitles:
-                    print(f"Found subtitles: {len(subtitles)}")
-            except Exception as e:
-                print(f"Subtitle extraction failed: {e}")
+            subtitles = parse_subtitles(src)
+            if subtitles:
+                print(f"Found subtitles: {len(subtitles)}")
             
-            # 3. Intercept Network
+            # 2. Visit Embed Page with Referer and wait for the master
+            # playlist request itself, instead of polling for it.
+            self.start()
+            from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+            embed_started = time.perf_counter()
+            self._page.set_extra_http_headers({"Referer": self.base_url})
             master_url = None
-            
-            def handle_request(req):
-                nonlocal master_url
-                if not master_url and ("master.txt" in req.url or "master.m3u8" in req.url):
-                    master_url = req.url
-                    # print(f"Captured: {master_url}") 
-
-            # Listen
-            self._page.on("request", handle_request)
-            
             try:
-                # 4. Visit Embed Page with Referer
-                self._page.set_extra_http_headers({"Referer": self.base_url})
-                self._page.goto(src, wait_until="domcontentloaded")
-                
-                # Wait a bit for the player to load and request the manifest
-                try:
-                    self._page.wait_for_selector("video", timeout=5000)
-                except:
-                    pass 
-                
-                # Extra wait for network
-                start_time = time.time()
-                while not master_url and time.time() - start_time < 5:
-                    self._page.wait_for_timeout(500)
-                
-                if master_url:
-                    print(f"Successfully extracted HLS URL: {master_url}")
-                    return {"url": master_url, "referer": src, "subs": subtitles}
-                else:
-                    print("Failed to capture master URL.")
-                    return None
+                with self._page.expect_request(is_master_request, timeout=STREAM_TIMEOUT_MS) as request_info:
+                    self._page.goto(src, wait_until="commit")
+                master_url = request_info.value.url
+            except PlaywrightTimeoutError:
+                pass
             finally:
-                # Cleanup listener
-                self._page.remove_listener("request", handle_request)
+                self.last_timings['embed'] = time.perf_counter() - embed_started
+                self.last_timings['total'] = time.perf_counter() - started
+                tracing.record('scraper.embed', embed_started, found=master_url is not None)
+                print(self.timing_summary())
 
-        except Exception as e:
-            print(f"Stream extraction failed: {e}")
-            return None
+            if master_url:
+                print(f"Successfully extracted HLS URL: {master_url}")
+                return {"url": master_url, "referer": src, "subs": subtitles}
+            else:
+                print("Failed to capture master URL.")
+                return None
 
         except Exception as e:
             print(f"Stream extraction failed: {e}")
             return None
 
+    def get_stream_urls(self, episode_urls, concurrency=BATCH_CONCURRENCY, timeout=BATCH_EPISODE_TIMEOUT,
+                        log=print):
+        """
+        Extracts stream URLs for many episodes in parallel.
+        Returns a dict {episode_url: result}, in the order given, where result
+        is what get_stream_url returns (None for failed or timed out episodes).
+        """
+        results = dict(self.iter_stream_urls(episode_urls, concurrency, timeout, log))
+        return {url: results.get(url) for url in episode_urls}
+
+    def iter_stream_urls(self, episode_urls, concurrency=BATCH_CONCURRENCY, timeout=BATCH_EPISODE_TIMEOUT,
+                         log=print):
+        """
+        Like get_stream_urls, but yields (episode_url, result) as each episode
+        finishes, so callers can start on early episodes right away.
+
+        Each episode runs in its own isolated browser context, at most
+        `concurrency` at a time, and is abandoned after `timeout` seconds.
+        The Playwright sync API is bound to the thread that started it, so
+        batches run the async API on a background thread with a second
+        browser. It is launched by the first batch and kept until close(),
+        so later batches (and the one-episode preloads) skip the launch.
+        Progress and errors go to log, which callers on a background thread
+        use to keep them off the interactive prompt.
+        """
+        episode_urls = list(episode_urls)
+        finished = queue.Queue()
+        done = object()
+
+        def batch_done(future):
+            if not future.cancelled() and future.exception() is not None:
+                log(f"Batch extraction failed: {future.exception()}")
+            finished.put(done)
+
+        asyncio.run_coroutine_threadsafe(
+            self._extract_batch(episode_urls, concurrency, timeout, finished.put, log),
+            self._background_loop()).add_done_callback(batch_done)
+
+        pending = set(episode_urls)
+        while True:
+            item = finished.get()
+            if item is done:
+                break
+            pending.discard(item[0])
+            yield item
+        # Episodes the batch never reached (e.g. the browser failed to launch).
+        for url in episode_urls:
+            if url in pending:
+                yield url, None
+
+    def _background_loop(self):
+        """
+        Returns the event loop the batch browser runs on, starting its
+        thread on first use.
+        """
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name="stream-batch", daemon=True).start()
+            return self._loop
+
+    async def _batch_browser(self):
+        # Runs on the background loop; concurrent batches wait for the same launch.
+        if self._async_launch is None:
+            self._async_launch = asyncio.ensure_future(self._launch_async_browser())
+        launch = self._async_launch
+        try:
+            browser = await asyncio.shield(launch)
+        except Exception:
+            if self._async_launch is launch:
+                self._async_launch = None
+            raise
+        if not browser.is_connected():
+            # Crashed or killed: launch another one.
+            if self._async_launch is launch:
+                self._async_launch = None
+            return await self._batch_browser()
+        return browser
+
+    async def _launch_async_browser(self):
+        with tracing.span('scraper.batch_browser_start'):
+            if self._async_playwright is None:
+                from playwright.async_api import async_playwright
+                self._async_playwright = await async_playwright().start()
+            return await self._async_playwright.chromium.launch(headless=self.headless)
+
+    async def _close_async_browser(self):
+        launch, self._async_launch = self._async_launch, None
+        if launch is not None:
+            try:
+                await (await launch).close()
+            except Exception:
+                pass
+        if self._async_playwright is not None:
+            await self._async_playwright.stop()
+            self._async_playwright = None
+
+    async def _extract_batch(self, episode_urls, concurrency, timeout, emit, log=print):
+        pending = asyncio.Queue()
+        for url in episode_urls:
+            pending.put_nowait(url)
+        browser = await self._batch_browser()
+
+        async def worker():
+            while not pending.empty():
+                episode_url = pending.get_nowait()
+                started = time.perf_counter()
+                try:
+                    result = await asyncio.wait_for(self._extract_in_context(browser, episode_url, log), timeout)
+                except asyncio.TimeoutError:
+                    log(f"Timed out extracting {episode_url}")
+                    result = None
+                except Exception as e:
+                    log(f"Stream extraction failed for {episode_url}: {e}")
+                    result = None
+                status = "ok" if result else "failed"
+                tracing.record('scraper.batch_episode', started, found=bool(result))
+                log(f"[{status}] {episode_url} ({time.perf_counter() - started:.2f}s)")
+                emit((episode_url, result))
+
+        await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(episode_urls))))))
+
+    async def _extract_in_context(self, browser, episode_url, log=print):
+        """
+        get_stream_url for one episode, in a fresh browser context.
+        """
+        src = await asyncio.to_thread(self._find_embed_url_http, episode_url, log)
+
+        context = await browser.new_context()
+        try:
+            page = await context.new_page()
+
+            async def filter_route(route):
+                if is_blocked_request(route.request):
+                    await route.abort()
+                else:
+                    await route.continue_()
+
+            await page.route("**/*", filter_route)
+
+            if not src:
+                await page.goto(episode_url, wait_until="domcontentloaded")
+                iframe = await page.query_selector("iframe")
+                src = await iframe.get_attribute("src") if iframe else None
+                if not src:
+                    return None
+
+            src = normalize_embed_url(src)
+            subtitles = parse_subtitles(src, log)
+
+            await page.set_extra_http_headers({"Referer": self.base_url})
+            async with page.expect_request(is_master_request, timeout=STREAM_TIMEOUT_MS) as request_info:
+                await page.goto(src, wait_until="commit")
+            master = await request_info.value
+            return {"url": master.url, "referer": src, "subs": subtitles}
+        finally:
+            await context.close()
+
+    def timing_summary(self):
+        """
+        Formats self.last_timings, e.g. "episode page 0.21s (http), embed 0.63s, total 0.84s".
+        """
+        t = self.last_timings
+        parts = []
+        if 'episode_page' in t:
+            parts.append(f"episode page {t['episode_page']:.2f}s ({t.get('episode_page_via', '?')})")
+        if 'embed' in t:
+            parts.append(f"embed {t['embed']:.2f}s")
+        if 'total' in t:
+            parts.append(f"total {t['total']:.2f}s")
+        return "Timing: " + ", ".join(parts)
+
     def __enter__(self):
         self.start()
         return self
@@ -207,6 +552,7 @@ if __name__ == "__main__":
             
             count = scraper.get_episode_count(target['url'])
             print(f"Episode count: {count}")
+            print(scraper.fast_path_summary())
             
             if count > 0:
                 # Construct ep 1 url
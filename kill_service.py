@@ -1,7 +1,12 @@
-import requests
+import os
 import sys
 
-def kill_server(port=5001):
+# Port of the streaming proxy. Kept here, away from Flask, so the CLI can
+# know it without importing the server.
+PORT = int(os.environ.get('ANIME_PORT', '5001'))
+
+def kill_server(port=PORT):
+    import requests
     try:
         print(f"Sending shutdown signal to localhost:{port}...")
         requests.post(f"http://localhost:{port}/shutdown", timeout=2)
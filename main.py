@@ -1,74 +1,133 @@
-import sys
-from gogo_scraper import GogoScraper
-from downloader import GogoDownloader
-from utils import sanitize_filename
-import subprocess
+import argparse
+import contextlib
+# The scraper (Playwright), the downloader (yt-dlp) and the server (Flask)
+# are imported when first used, so commands such as 'history' start fast.
+# `python main.py --startup-profile` shows what importing this file costs.
+from download_manager import DownloadManager, PRIORITY_CURRENT, DOWNLOAD_CONCURRENCY
+from cache import CacheStore, CachedScraper
+from catalog import Catalog, CATALOG_FILE
+from preload import Preloader
+from episode_store import EpisodeStore, STORE_DIR, WIPE_DOWNLOADS
+from kill_service import PORT as SERVER_PORT
+from utils import Lazy, BASE_URL
+import tracing
 import webbrowser
 import time
 import os
-import shutil
-import json
+import subprocess
+import sys
 import urllib.parse
 
 HISTORY_FILE = "history.json"
+SERVER_URL = f"http://localhost:{SERVER_PORT}"
 
-def load_history():
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, 'r') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
-
-def save_history(entry):
-    history = load_history()
+# Cold-start budget for importing this file, checked by --startup-profile.
+STARTUP_BUDGET_MS = float(os.environ.get('ANIME_STARTUP_BUDGET_MS', '75'))
+
+def load_history(store):
+    return store.load_history()
+
+def save_history(store, entry):
     # Add timestamp
     entry['timestamp'] = time.ctime()
-    history.append(entry)
-    # Keep last 50
-    if len(history) > 50:
-        history = history[-50:]
-    
-    with open(HISTORY_FILE, 'w') as f:
-        json.dump(history, f, indent=4)
-
-def cleanup_downloads():
-    download_dir = "downloads"
-    if os.path.exists(download_dir):
-        print("Cleaning up downloads folder...")
-        for filename in os.listdir(download_dir):
-            file_path = os.path.join(download_dir, filename)
-            try:
-                if os.path.isfile(file_path) or os.path.islink(file_path):
-                    os.unlink(file_path)
-                elif os.path.isdir(file_path):
-                    shutil.rmtree(file_path)
-            except Exception as e:
-                print(f"Failed to delete {file_path}. Reason: {e}")
+    store.add_history(entry)
+
+def start_streaming_server():
+    """
+    Starts the proxy on a background thread of this process, once per session.
+    Returns the BackgroundServer, or None if it could not be started.
+    """
+    print("Starting local streaming server...")
+    started = time.perf_counter()
+    from server import BackgroundServer
+    from kill_service import kill_server
+    deadline = time.time() + 5
+    asked_to_stop = False
+    while True:
+        try:
+            server = BackgroundServer(SERVER_PORT).start()
+            break
+        except OSError as e:
+            # The port is usually held by a server.py from an older session.
+            if not asked_to_stop:
+                print("Stopping any existing server...")
+                kill_server(SERVER_PORT)
+                asked_to_stop = True
+            if time.time() > deadline:
+                print(f"Server failed to start: {e}")
+                return None
+            time.sleep(0.1)
+
+    ready = server.wait_ready()
+    tracing.record('cli.server_start', started, ready=ready)
+    if not ready:
+        print("Server did not become ready.")
+        server.shutdown()
+        return None
+    print(f"Server ready on {server.url}")
+    return server
+
+def open_local(path):
+    """
+    Opens a downloaded episode in the system's video player, which also
+    picks up the subtitle file next to it.
+    """
+    path = os.path.abspath(path)
+    if sys.platform.startswith('win'):
+        os.startfile(path)
+    elif sys.platform == 'darwin':
+        subprocess.Popen(['open', path])
+    else:
+        subprocess.Popen(['xdg-open', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def make_scraper():
+    from gogo_scraper import GogoScraper
+    return GogoScraper(headless=True)
+
+def make_downloader(**kwargs):
+    from downloader import GogoDownloader
+    return GogoDownloader(download_dir=STORE_DIR, **kwargs)
 
 def main():
     print("Initializing Anime Downloader (Stream & Download Edition)...")
-    scraper = GogoScraper(headless=True)
-    downloader = GogoDownloader(download_dir="downloads")
-    server_process = None
+    store = CacheStore()
+    # history.json is only read once, to carry it over into the store.
+    store.import_history(HISTORY_FILE)
+    # Built on first use: cached lookups and local commands need neither.
+    scraper = CachedScraper(Lazy(make_scraper), store)
+    episodes = EpisodeStore(STORE_DIR)
+    downloader = Lazy(make_downloader)
+    # Searched before the site once built (see catalog.py).
+    catalog = Lazy(Catalog) if os.path.exists(CATALOG_FILE) else None
+
+    def download_finished(job):
+        episodes.refresh(job.filename)
+        episodes.evict(protect=downloads.active_files())
+
+    downloads = DownloadManager(downloader, on_finish=download_finished)
+    preloader = Preloader(scraper, SERVER_URL)
+    server = None
     
     # State for 'next' command
     last_watched = None # {'title': str, 'url': str, 'episode': int}
     
-    # Cleanup on start? User said "accumulate over time", so clean on exit is critical. 
-    # Clean on start is also good practice for temp files.
-    cleanup_downloads()
+    # Downloads are kept between sessions (see episode_store.py) unless
+    # ANIME_WIPE_DOWNLOADS=1 asks for the old clean slate.
+    if WIPE_DOWNLOADS:
+        episodes.wipe()
+    else:
+        episodes.evict()
 
     try:
         while True:
             # RESET STATE for new iteration
             selected = None
             ep_num = None
+            count = None
             
             # 1. Search / Command Loop
             while not selected:
-                query = input("\nSearch anime, 'history', 'next' (or 'q' to quit): ").strip()
+                query = input("\nSearch anime, 'history', 'next', 'queue', 'cancel <id>', 'library', 'stats', 'cache', 'catalog' (or 'q' to quit): ").strip()
                 if query.lower() == 'q':
                     raise KeyboardInterrupt
                 
@@ -76,12 +135,67 @@ def main():
                     continue
                 
                 if query.lower() == 'history':
-                    hist = load_history()
+                    hist = load_history(store)
                     print("\n--- Recent History ---")
                     for h in reversed(hist[-10:]):
                         print(f"[{h['timestamp']}] {h['title']} - Episode {h['episode']}")
                     continue
                 
+                if query.lower() == 'queue':
+                    print("\n--- Downloads ---")
+                    for line in downloads.summary():
+                        print(line)
+                    continue
+                
+                if query.lower() == 'library':
+                    print("\n--- Downloaded Episodes ---")
+                    for line in episodes.summary():
+                        print(line)
+                    continue
+                
+                if query.lower().startswith('cancel '):
+                    job_id = query.split(None, 1)[1].lstrip('#')
+                    if job_id.isdigit() and downloads.cancel(int(job_id)):
+                        print(f"Cancelled download #{job_id}.")
+                    else:
+                        print(f"No active download #{job_id}.")
+                    continue
+                
+                if query.lower() == 'stats':
+                    print("\n--- Session Stats ---")
+                    print(scraper.fast_path_summary())
+                    print(preloader.summary())
+                    from segment_cache import shared_cache
+                    print(shared_cache().summary())
+                    print("\n--- Stage Latencies (recent) ---")
+                    for line in tracing.tracer.summary():
+                        print(line)
+                    continue
+                
+                if query.lower() in ('cache', 'cache clear'):
+                    if query.lower() == 'cache clear':
+                        store.clear()
+                        print("Cache cleared.")
+                    print("\n--- Cache Stats ---")
+                    for line in scraper.cache_summary():
+                        print(line)
+                    continue
+                
+                if query.lower() in ('catalog', 'catalog refresh'):
+                    if query.lower() == 'catalog refresh':
+                        catalog = catalog or Lazy(Catalog)
+                        try:
+                            catalog.refresh()
+                        except KeyboardInterrupt:
+                            print("\nCatalog refresh interrupted; 'catalog refresh' resumes it.")
+                    if catalog is None:
+                        print("No local catalog yet; 'catalog refresh' crawls the site's anime list.")
+                        continue
+                    print("\n--- Catalog ---")
+                    for line in catalog.summary():
+                        print(line)
+                    continue
+                
                 if query.lower() == 'next':
                     if last_watched:
                         print(f"Loading next episode for: {last_watched['title']}")
@@ -94,19 +208,30 @@ def main():
                         continue
                 
                 if query.lower() == 'clean':
-                    cleanup_downloads()
-                    print("Downloads folder accepted.")
+                    episodes.wipe()
+                    print("Downloads folder cleared.")
                     continue
                 
                 # Normal Search
-                results = scraper.search(query)
+                with tracing.span('cli.search', query=query) as info:
+                    # The site is only asked when the catalog is stale or has no match.
+                    results = catalog.search(query) if catalog is not None and catalog.fresh() else []
+                    info['via'] = 'catalog' if results else 'site'
+                    if results:
+                        print(f"Searching for '{query}'... (local catalog)")
+                    else:
+                        results = scraper.search(query)
+                        if results and catalog is not None:
+                            catalog.add(results)
+                    info['results'] = len(results or [])
                 if not results:
                     print("No results found.")
                     continue
                 
                 print(f"\nFound {len(results)} results:")
                 for i, res in enumerate(results):
-                    print(f"{i+1}. {res['title']}")
+                    episode_count = f" ({res['episodes']} episodes)" if res.get('episodes') else ""
+                    print(f"{i+1}. {res['title']}{episode_count}")
                 
                 # Select Anime
                 try:
@@ -128,7 +253,10 @@ def main():
             
             # 2. Episode Selection (If not set by 'next')
             if ep_num is None:
-                count = scraper.get_episode_count(selected['url'])
+                with tracing.span('cli.episode_count', url=selected['url']):
+                    count = scraper.get_episode_count(selected['url'])
+                if count and catalog is not None:
+                    catalog.set_episodes(selected['url'], count)
                 if count == 0:
                     print("Could not retrieve episode count. The Series might be a Movie or unreleased.")
                     retry = input("Try Episode 1 anyway? (y/n): ").lower()
@@ -153,11 +281,42 @@ def main():
             # 3. Process Episode
             # Construct Episode URL
             slug = selected['url'].split("/")[-1]
-            ep_url = f"{scraper.base_url}/{slug}-episode-{ep_num}"
+            ep_url = f"{BASE_URL}/{slug}-episode-{ep_num}"
             
-            # Extract Stream
-            print(f"Fetching stream for Episode {ep_num}...")
-            stream_data = scraper.get_stream_url(ep_url)
+            # Already downloaded: play the file, no extraction or download.
+            local = episodes.lookup(selected['title'], ep_num)
+            if local:
+                print(f"\nPlaying {selected['title']} - Episode {ep_num} from {local['path']}")
+                preloader.discard()
+                if server is None or not server.running():
+                    server = start_streaming_server()
+                if server is not None:
+                    # The player reads the file through /local, with seeking.
+                    filename = os.path.basename(local['path'])
+                    webbrowser.open(f"{SERVER_URL}/?local={urllib.parse.quote(filename)}")
+                else:
+                    open_local(local['path'])
+                episodes.touch(selected['title'], ep_num)
+                last_watched = {
+                    'title': selected['title'],
+                    'url': selected['url'],
+                    'episode': ep_num
+                }
+                save_history(store, last_watched)
+                print("History updated. Type 'next' to play the next episode.")
+                if count is None or ep_num < count:
+                    preloader.start(selected['url'], ep_num + 1, f"{BASE_URL}/{slug}-episode-{ep_num + 1}")
+                continue
+            
+            # Extract Stream (the preload for 'next' may already have it)
+            with tracing.span('cli.stream_url', episode=ep_num) as info:
+                stream_data = preloader.take(selected['url'], ep_num)
+                info['preloaded'] = bool(stream_data)
+                if stream_data:
+                    print(f"Using preloaded stream for Episode {ep_num}.")
+                else:
+                    print(f"Fetching stream for Episode {ep_num}...")
+                    stream_data = scraper.get_stream_url(ep_url)
             
             if not stream_data:
                 print("Could not find a playable stream for this episode.")
@@ -172,57 +331,49 @@ def main():
             print(f"\nReady: {selected['title']} - Episode {ep_num}")
             
             # --- AUTO STREAM LOGIC (Replaces Action Selection) ---
-            filename = f"{sanitize_filename(selected['title'])} - Episode {ep_num}.mp4"
-            
-            print("Starting local streaming server...")
-            if os.path.exists("server.py"):
-                 try:
-                    print("Stopping any existing server...")
-                    subprocess.run([sys.executable, "kill_service.py"], check=False)
-                    time.sleep(1) # Wait for port release
-                 except: 
-                     pass
-                 
-                 print(f"Launching server with: {sys.executable} server.py")
-                 server_process = subprocess.Popen([sys.executable, "server.py"])
-                 time.sleep(2) # Wait for startup
-                 
-                 if server_process.poll() is not None:
-                     print(f"Server failed to start! Exit code: {server_process.returncode}")
-                     # Try to read stderr if possible, but Popen defaults didn't capture it.
-                     print("Cannot stream without server. Aborting.")
-                     continue
-                 else:
-                     print("Server seems to be running.")
-                 
-                 # Prepare URL
-                 sub_url = ""
-                 if subs:
-                      target_sub = next((s for s in subs if "English" in s['lang']), subs[0])
-                      sub_url = target_sub['url']
-                 
-                 safe_url = urllib.parse.quote(stream_url)
-                 safe_sub = urllib.parse.quote(sub_url)
-                 
-                 play_link = f"http://localhost:5001/?url={safe_url}&subs={safe_sub}"
-                 print(f"Opening browser to: {play_link}")
-                 webbrowser.open(play_link)
-            else:
-                print("Error: server.py not found. Downloading only.")
+            filename = episodes.add(selected['title'], ep_num, selected['url'])
             
-            print(f"Starting background download to: {filename}")
-            success = downloader.download(stream_url, referer, filename, subs=subs)
+            # One server per session: switching episodes only opens a new
+            # player URL, and the connection pool and prefetch cache stay warm.
+            if server is None or not server.running():
+                server = start_streaming_server()
+                if server is None:
+                    print("Cannot stream without server. Aborting.")
+                    continue
             
-            if success:
-                print("Download completed!")
-                # Update History & Last Watched ONLY on success (or partial success)
-                last_watched = {
-                    'title': selected['title'], 
-                    'url': selected['url'], 
-                    'episode': ep_num
-                }
-                save_history(last_watched)
-                print("History updated. Type 'next' to play the next episode.")
+            # Prepare URL
+            sub_url = ""
+            if subs:
+                 target_sub = next((s for s in subs if "English" in s['lang']), subs[0])
+                 sub_url = target_sub['url']
+            
+            safe_url = urllib.parse.quote(stream_url)
+            safe_sub = urllib.parse.quote(sub_url)
+            
+            # The player switches to the downloaded file once enough of it is on disk.
+            play_link = f"{SERVER_URL}/?url={safe_url}&subs={safe_sub}&local={urllib.parse.quote(filename)}"
+            print(f"Opening browser to: {play_link}")
+            # The player's requests show up as proxy.* spans from here on.
+            with tracing.span('cli.open_player', episode=ep_num):
+                webbrowser.open(play_link)
+            
+            job = downloads.submit(stream_url, referer, filename, subs=subs,
+                                   label=f"{selected['title']} - Episode {ep_num}",
+                                   priority=PRIORITY_CURRENT)
+            print(f"Queued background download #{job.id} to: {filename} (type 'queue' for progress)")
+            
+            # Playback has started, so this counts as watched.
+            last_watched = {
+                'title': selected['title'], 
+                'url': selected['url'], 
+                'episode': ep_num
+            }
+            save_history(store, last_watched)
+            print("History updated. Type 'next' to play the next episode.")
+            
+            # Get the next episode ready while this one plays.
+            if count is None or ep_num < count:
+                preloader.start(selected['url'], ep_num + 1, f"{BASE_URL}/{slug}-episode-{ep_num + 1}")
             
     except KeyboardInterrupt:
         print("\nExiting...")
@@ -232,11 +383,224 @@ def main():
         traceback.print_exc()
     finally:
         print("Cleaning up...")
-        if server_process:
-             subprocess.run([sys.executable, "kill_service.py"], check=False)
+        preloader.discard()
+        downloads.close()
+        if server and server.running():
+            server.shutdown()
         
-        cleanup_downloads() 
+        if WIPE_DOWNLOADS:
+            episodes.wipe()
         scraper.close()
+        store.close()
+        if catalog is not None:
+            catalog.close()
+
+def parse_episodes(spec):
+    """
+    Parses an episode list such as "1-24" or "1,3,5-7".
+    """
+    episodes = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            episodes.extend(range(int(first), int(last) + 1))
+        else:
+            episodes.append(int(part))
+    return sorted(set(e for e in episodes if e >= 1))
+
+def batch_download(series_url, episodes=None, title=None,
+                   extract_concurrency=None, download_concurrency=DOWNLOAD_CONCURRENCY,
+                   max_height=None):
+    """
+    Downloads a range of episodes without the interactive loop.
+
+    Stream extraction and downloading run as a pipeline: each episode is
+    queued for download as soon as its stream is found, while later
+    episodes are still being extracted. Each stage has its own concurrency.
+    extract_concurrency and max_height default to BATCH_CONCURRENCY and
+    DOWNLOAD_MAX_HEIGHT.
+    """
+    from gogo_scraper import BATCH_CONCURRENCY
+    from downloader import DOWNLOAD_MAX_HEIGHT
+    if extract_concurrency is None:
+        extract_concurrency = BATCH_CONCURRENCY
+    if max_height is None:
+        max_height = DOWNLOAD_MAX_HEIGHT
+    store = CacheStore()
+    scraper = CachedScraper(make_scraper(), store)
+    library = EpisodeStore(STORE_DIR)
+    downloader = make_downloader(max_height=max_height)
+
+    def download_finished(job):
+        library.refresh(job.filename)
+        library.evict(protect=downloads.active_files())
+
+    # No prompt to keep clear here, so the downloads report as they go.
+    downloads = DownloadManager(downloader, concurrency=download_concurrency, on_finish=download_finished,
+                                on_message=lambda job, message: print(f"[#{job.id}] {message}"))
+
+    slug = series_url.rstrip("/").split("/")[-1]
+    title = title or slug.replace("-", " ").title()
+    results = {}
+    started = time.time()
+
+    try:
+        if not episodes:
+            count = scraper.get_episode_count(series_url)
+            if count == 0:
+                print("Could not retrieve episode count. Pass --episodes explicitly.")
+                return results
+            episodes = list(range(1, count + 1))
+
+        stored = [ep for ep in episodes if library.lookup(title, ep)]
+        if stored:
+            print(f"Skipping {len(stored)} episodes that are already downloaded.")
+            episodes = [ep for ep in episodes if ep not in stored]
+
+        print(f"Batch: {title}, {len(episodes)} episodes "
+              f"({extract_concurrency} extracting, {download_concurrency} downloading)")
+        urls = {f"{BASE_URL}/{slug}-episode-{ep}": ep for ep in episodes}
+
+        for ep_url, stream_data in scraper.iter_stream_urls(list(urls), concurrency=extract_concurrency):
+            ep = urls[ep_url]
+            results[ep] = {'extract_s': time.time() - started, 'job': None}
+            if not stream_data:
+                continue
+            results[ep]['job'] = downloads.submit(
+                stream_data['url'], stream_data['referer'], library.add(title, ep, series_url),
+                subs=stream_data.get('subs', []), label=f"{title} - Episode {ep}")
+
+        downloads.wait()
+        total = time.time() - started
+    except KeyboardInterrupt:
+        print("\nInterrupted, cancelling downloads...")
+        total = time.time() - started
+    finally:
+        downloads.close()
+        scraper.close()
+        store.close()
+
+    print_batch_summary(results, total)
+    return results
+
+def print_batch_summary(results, total):
+    print("\n--- Batch Summary ---")
+    print(f"{'Episode':>7}  {'Stream at':>9}  {'Download':>8}  {'Size':>9}  {'Speed':>12}  Status")
+    total_bytes = 0
+    for ep, result in sorted(results.items()):
+        job = result['job']
+        if job is None:
+            print(f"{ep:>7}  {result['extract_s']:>8.1f}s  {'-':>8}  {'-':>9}  {'-':>12}  no stream")
+            continue
+        if job.started and job.finished:
+            elapsed = job.finished - job.started
+            speed = f"{job.downloaded_bytes / max(elapsed, 1e-6) / 1e6:.2f} MB/s"
+            elapsed = f"{elapsed:.1f}s"
+        else:
+            elapsed, speed = '-', '-'
+        total_bytes += job.downloaded_bytes if job.status == 'done' else 0
+        print(f"{ep:>7}  {result['extract_s']:>8.1f}s  {elapsed:>8}  "
+              f"{job.downloaded_bytes / 1e6:>6.1f} MB  {speed:>12}  {job.status}")
+    done = sum(1 for r in results.values() if r['job'] is not None and r['job'].status == 'done')
+    print(f"{done}/{len(results)} episodes in {total:.1f}s, "
+          f"{total_bytes / 1e6:.1f} MB ({total_bytes / max(total, 1e-6) / 1e6:.2f} MB/s overall)")
+
+def startup_profile(runs=3, top=12):
+    """
+    Imports this file in fresh interpreters with -X importtime and prints
+    the modules that cost the most. Returns the fastest total in ms, or
+    None if the import failed.
+    """
+    best = None
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            print(result.stderr)
+            return None
+        # Lines look like "import time:   self [us] | cumulative | name",
+        # with the name indented by nesting depth.
+        entries = []
+        for line in result.stderr.splitlines():
+            fields = line[len('import time:'):].split('|')
+            if not line.startswith('import time:') or len(fields) != 3 or not fields[0].strip().isdigit():
+                continue
+            name = fields[2].rstrip()
+            depth = (len(name) - len(name.lstrip())) // 2
+            entries.append((int(fields[0]), int(fields[1]), name.strip(), depth))
+        total = next((cumulative for _, cumulative, name, depth in entries if name == 'main' and depth == 0), 0)
+        if best is None or total < best[0]:
+            best = (total, entries)
+
+    total, entries = best
+    # A module is listed after its own imports, so main.py's are the
+    # entries between it and the previous top-level import.
+    end = next(i for i, entry in enumerate(entries) if entry[2] == 'main' and entry[3] == 0)
+    start = end
+    while start > 0 and entries[start - 1][3] > 0:
+        start -= 1
+    entries = entries[start:end]
+    direct = [(cumulative, name) for _, cumulative, name, depth in entries if depth == 1]
+    packages = {}
+    for self_us, _, name, _ in entries:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+
+    print(f"import main: {total / 1000:.1f} ms (best of {runs}, budget {STARTUP_BUDGET_MS:.0f} ms)")
+    print("\nImported by main.py (cumulative):")
+    for cumulative, name in sorted(direct, reverse=True)[:top]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+    print("\nPackages (own import time):")
+    for package, self_us in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]:
+        print(f"  {self_us / 1000:8.1f} ms  {package}")
+    return total / 1000
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Stream and download anime from the terminal.")
+    parser.add_argument('--series', help="Category URL of a series, e.g. https://anitaku.to/category/bleach")
+    parser.add_argument('--episodes', help="Episodes to fetch, e.g. 1-24 or 1,3,5-7 (default: all)")
+    parser.add_argument('--title', help="Title used for file names (default: from the URL)")
+    parser.add_argument('--download-only', action='store_true',
+                        help="Download --series without the interactive player")
+    parser.add_argument('--extract-concurrency', type=int)
+    parser.add_argument('--download-concurrency', type=int, default=DOWNLOAD_CONCURRENCY)
+    parser.add_argument('--max-height', type=int,
+                        help="Highest resolution to download, e.g. 720 (default: best)")
+    parser.add_argument('--startup-profile', action='store_true',
+                        help="Show what importing the CLI costs; exits 1 if over ANIME_STARTUP_BUDGET_MS")
+    parser.add_argument('--build-catalog', action='store_true',
+                        help="Crawl the site's anime list into the local search catalog (resumes and refreshes)")
+    parser.add_argument('--trace', nargs='?', const='', metavar='FILE',
+                        help="Write the session's stage timings as a Chrome trace "
+                             "(default: traces/session-<time>.json)")
+    parser.add_argument('--profile', nargs='?', const='', metavar='FILE',
+                        help="Run the session under cProfile and save it (default: traces/profile-<time>.prof)")
+    args = parser.parse_args()
+
+    if args.startup_profile:
+        elapsed = startup_profile()
+        sys.exit(0 if elapsed is not None and elapsed <= STARTUP_BUDGET_MS else 1)
+    if (args.series or args.download_only) and not (args.series and args.download_only):
+        parser.error("batch mode needs both --series and --download-only")
+
+    profile_file = args.profile or tracing.session_file('profile', 'prof')
+    try:
+        with tracing.profiled(profile_file) if args.profile is not None else contextlib.nullcontext():
+            if args.build_catalog:
+                catalog = Catalog()
+                catalog.refresh()
+                catalog.close()
+            elif args.series:
+                batch_download(args.series, parse_episodes(args.episodes) if args.episodes else None, args.title,
+                               args.extract_concurrency, args.download_concurrency, args.max_height)
+            else:
+                main()
+    finally:
+        if args.trace is not None:
+            trace_file = args.trace or tracing.session_file('session', 'json')
+            print(f"Trace: {tracing.tracer.write(trace_file)} spans written to {trace_file} "
+                  "(open in chrome://tracing or ui.perfetto.dev)")
@@ -0,0 +1,221 @@
+"""
+Process-wide metrics for the streaming proxy, rendered in the Prometheus
+text format at /metrics.
+"""
+import bisect
+import threading
+import time
+
+import tracing
+
+# Histogram upper bounds in seconds (+Inf is implied).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def _format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+                for key, value in items]
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = _format_labels(self.labels, key, [('le', _format_value(bound))])
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    'anime_requests_total', "Requests handled, by route and response status.", ('route', 'status'))
+ACTIVE_REQUESTS = REGISTRY.gauge(
+    'anime_active_requests', "Requests currently being handled or streamed.", ('route',))
+REQUEST_SECONDS = REGISTRY.histogram(
+    'anime_request_seconds', "Time from request to the last byte sent.", ('route',))
+BYTES_OUT = REGISTRY.counter(
+    'anime_response_bytes_total', "Body bytes sent to clients.", ('route',))
+BYTES_IN = REGISTRY.counter(
+    'anime_upstream_bytes_total', "Body bytes read from upstream, by kind (playlist, segment, prefetch).", ('kind',))
+UPSTREAM_TTFB_SECONDS = REGISTRY.histogram(
+    'anime_upstream_ttfb_seconds', "Time until the upstream response headers arrived.", ('kind',))
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    'anime_upstream_seconds', "Time until the upstream body was fully read.", ('kind',))
+UPSTREAM_ERRORS = REGISTRY.counter(
+    'anime_upstream_errors_total', "Failed upstream requests, by HTTP status or 'timeout'/'error'.", ('status',))
+REWRITE_SECONDS = REGISTRY.histogram(
+    'anime_playlist_rewrite_seconds', "Time spent rewriting playlists.")
+UPSTREAM_HEDGES = REGISTRY.counter(
+    'anime_upstream_hedges_total', "Duplicate requests sent for slow upstream responses (sent), and how often the duplicate answered first (won).", ('result',))
+PREFETCH_LOOKUPS = REGISTRY.counter(
+    'anime_prefetch_lookups_total', "/proxy requests answered from the read-ahead cache (hit) or not (miss).", ('result',))
+SEGMENT_CACHE_EVENTS = REGISTRY.counter(
+    'anime_segment_cache_total', "Shared segment cache hits, misses and stores, by consumer.", ('consumer', 'event'))
+UPSTREAM_COALESCED = REGISTRY.counter(
+    'anime_upstream_coalesced_total', "Upstream fetches saved by joining an identical request already in flight, by kind.", ('kind',))
+VARIANT_SELECTIONS = REGISTRY.counter(
+    'anime_variant_selections_total', "Master playlists forwarded, by the variant listed first.", ('variant',))
+
+class RequestMetrics:
+    """
+    Measurements for one request. Phases marked with mark() become the
+    Server-Timing header; finish() updates the registry exactly once.
+    """
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.bytes_out = 0
+        self.kind = None
+        self.upstream_started = None
+        self._timings = []
+        self._finished = False
+        ACTIVE_REQUESTS.inc(route=route)
+
+    def mark(self, name, since, desc=None):
+        """
+        Records the phase `name` as lasting from `since` until now.
+        Returns the duration in seconds.
+        """
+        elapsed = time.perf_counter() - since
+        self._timings.append((name, elapsed, desc))
+        return elapsed
+
+    def upstream_headers(self, kind, status):
+        """
+        Called once the upstream response headers are in and its kind is known.
+        """
+        self.kind = kind
+        UPSTREAM_TTFB_SECONDS.observe(self.mark('upstream', self.upstream_started), kind=kind)
+        tracing.record(f"upstream.{kind}", self.upstream_started, status=status)
+        if status >= 400:
+            UPSTREAM_ERRORS.inc(status=status)
+
+    def upstream_done(self, num_bytes):
+        if self.upstream_started is None or self.kind is None:
+            return
+        BYTES_IN.inc(num_bytes, kind=self.kind)
+        UPSTREAM_SECONDS.observe(time.perf_counter() - self.upstream_started, kind=self.kind)
+        self.upstream_started = None
+
+    def server_timing(self):
+        entries = []
+        for name, elapsed, desc in self._timings:
+            entry = f"{name};dur={elapsed * 1000:.1f}"
+            if desc:
+                entry += f';desc="{desc}"'
+            entries.append(entry)
+        return ", ".join(entries)
+
+    def count(self, body):
+        """
+        Wraps a streamed body so the bytes sent are counted.
+        """
+        for chunk in body:
+            self.bytes_out += len(chunk)
+            yield chunk
+
+    def finish(self, status):
+        if self._finished:
+            return
+        self._finished = True
+        ACTIVE_REQUESTS.dec(route=self.route)
+        REQUESTS.inc(route=self.route, status=status)
+        REQUEST_SECONDS.observe(time.perf_counter() - self.started, route=self.route)
+        BYTES_OUT.inc(self.bytes_out, route=self.route)
+        # Stage names drop the route's parameters: "/local/<path:name>" and
+        # "/local/{name}" are both "server.local".
+        stage = self.route.strip('/').split('/')[0] or 'index'
+        if stage == 'proxy' and self.kind:
+            stage = f"proxy.{self.kind}"
+        else:
+            stage = f"server.{stage}"
+        tracing.record(stage, self.started, status=status, bytes=self.bytes_out, phases=self.server_timing())
@@ -0,0 +1,188 @@
+import re
+from functools import lru_cache
+from urllib.parse import quote, urljoin, urlparse
+
+# Tags whose URI="..." attribute points at another resource (keys, init
+# segments, alternate renditions...). They are rewritten like URI lines.
+URI_TAGS = ('#EXT-X-KEY', '#EXT-X-SESSION-KEY', '#EXT-X-MAP', '#EXT-X-MEDIA',
+            '#EXT-X-I-FRAME-STREAM-INF', '#EXT-X-PART', '#EXT-X-PRELOAD-HINT',
+            '#EXT-X-RENDITION-REPORT', '#EXT-X-SESSION-DATA')
+URI_ATTRIBUTE = re.compile(r'URI="([^"]*)"')
+
+# Rewritten lines are emitted in blocks of about this many characters, so a
+# long playlist is not written to the socket one line at a time.
+OUTPUT_BLOCK_SIZE = 32 * 1024
+
+# A relative reference made only of these characters, with no '.', '..' or
+# empty path segments, resolves to a plain concatenation, so urljoin and the
+# re-parse of its result can be skipped. Anything else takes the slow path.
+SIMPLE_REFERENCE = re.compile(r'[A-Za-z0-9_~%+\-/][A-Za-z0-9_.~%+\-/]*(?:\?[^#]*)?\Z')
+
+@lru_cache(maxsize=256)
+def _playlist_base(url):
+    """
+    Values the path heuristics need that only depend on the playlist URL.
+    """
+    parsed_base = urlparse(url)
+    base_path = parsed_base.path
+    # Remove leading slash for comparison
+    check_path = base_path[1:] if base_path.startswith('/') else base_path
+    origin = f"{parsed_base.scheme}://{parsed_base.netloc}"
+    root_base = origin + "/"
+
+    # Directory of the playlist, for the concatenation fast path. Only used
+    # if urljoin agrees with it (no dot segments or '//' in the base path).
+    base_dir = base_path.rsplit('/', 1)[0] + '/'
+    if urljoin(url, 'x') != origin + base_dir + 'x':
+        base_dir = None
+
+    base_path_only = urlparse(url.rsplit('/', 1)[0]).path
+    check_double_slash = base_path_only + '//' + base_path_only[1:]
+    return check_path, origin, root_base, base_dir, base_path_only, check_double_slash
+
+def _join(origin, base_dir, target_url):
+    """
+    urljoin() for the common case, returning (full url, path).
+    Returns None when the reference needs the general algorithm.
+    """
+    if base_dir is None or not SIMPLE_REFERENCE.match(target_url):
+        return None
+    path = target_url.split('?', 1)[0]
+    if '//' in path or '/./' in path or '/../' in path or path.startswith(('./', '../')) \
+            or path.endswith(('/.', '/..')) or path in ('.', '..'):
+        return None
+    if not path.startswith('/'):
+        path = base_dir + path
+        target_url = base_dir + target_url
+    return origin + target_url, path
+
+def _dedupe_mid_split(parts):
+    """
+    Finds the longest run of path parts that is immediately repeated,
+    e.g. a/b/a/b/seg.ts. Returns the parts with one copy removed, or None.
+    """
+    if len(parts) < 4: # Need reasonable length to suspect duplication
+        return None
+    first = parts[0]
+    for length in range(len(parts) // 2, 1, -1):
+        # A repeat has to start with the first part again; checking that
+        # first skips the slice comparisons for almost every length.
+        if parts[length] == first and parts[:length] == parts[length:2*length]:
+            return parts[:length] + parts[2*length:]
+    return None
+
+@lru_cache(maxsize=65536)
+def resolve_uri(url, target_url):
+    """
+    Resolves a playlist entry against the playlist URL.
+    Results are cached, so refreshes of a live playlist only resolve new entries.
+    """
+    check_path, origin, root_base, base_dir, base_path_only, check_double_slash = _playlist_base(url)
+
+    # Logic to handle Gogoanime's weird relative paths that duplicate the full path
+    # e.g. Base: /path/to/master.txt, Target: path/to/segment.ts (no leading slash)
+    # Standard urljoin would make it /path/to/path/to/segment.ts
+
+    # 1. Standard Resolution
+    base = url
+    # 2. Heuristic for Gogoanime's missing leading slash
+    if not target_url.startswith('http') and not target_url.startswith('/'):
+        first_segment = target_url.split('/')[0]
+        if first_segment and check_path.startswith(first_segment):
+            base = root_base
+
+    joined = _join(origin, base_dir if base is url else '/', target_url)
+    if joined:
+        full_url, path = joined
+    else:
+        full_url = urljoin(base, target_url)
+        parsed_full = urlparse(full_url)
+        origin = f"{parsed_full.scheme}://{parsed_full.netloc}"
+        path = parsed_full.path
+
+    # 3. Final Safety Net: Check for double path duplication
+    # This handles cases where different heuristics fail.
+
+    # A. Generic Deduplication (Mid-split)
+    keep = _dedupe_mid_split([p for p in path.split('/') if p])
+    if keep is not None:
+        full_url = origin + "/" + "/".join(keep)
+
+    # B. Specific Check for Base Path Duplication with '//'
+    resource_path = full_url.replace(origin, "")
+
+    if base_path_only and base_path_only in resource_path:
+        # Check for /path//path Pattern
+        if resource_path.startswith(check_double_slash):
+            new_path = resource_path[len(base_path_only)+2:] # Skip /path//
+            full_url = f"{origin}{base_path_only}/{new_path}"
+
+        # Check for /path/path Pattern (Standard)
+        elif resource_path.startswith(base_path_only + base_path_only):
+            new_path = resource_path[len(base_path_only):]
+            full_url = f"{origin}{new_path}"
+
+    return full_url
+
+@lru_cache(maxsize=65536)
+def _resolve_quoted(url, target_url):
+    full_url = resolve_uri(url, target_url)
+    return full_url, quote(full_url)
+
+class PlaylistRewriter:
+    """
+    Rewrites an m3u8 playlist so every URI, including the ones inside tags
+    such as EXT-X-KEY and EXT-X-MAP, goes through /proxy.
+
+    After rewrite() has been consumed, segments holds the resolved media
+    segment URLs (the lines after #EXTINF) in playlist order.
+    """
+    def __init__(self, url, referer, proxy_path='/proxy'):
+        self.url = url
+        self._prefix = f"{proxy_path}?url="
+        self._suffix = f"&referer={quote(referer)}"
+        self.segments = []
+
+    def proxied(self, target_url):
+        """
+        Returns (resolved upstream URL, /proxy URL for it).
+        """
+        full_url, quoted = _resolve_quoted(self.url, target_url)
+        return full_url, self._prefix + quoted + self._suffix
+
+    def _rewrite_tag(self, line):
+        return URI_ATTRIBUTE.sub(lambda m: f'URI="{self.proxied(m.group(1))[1]}"', line)
+
+    def rewrite(self, content):
+        """
+        Yields the rewritten playlist in blocks of about OUTPUT_BLOCK_SIZE characters.
+        """
+        block = []
+        block_size = 0
+        after_extinf = False
+        first = True
+
+        for line in content.splitlines():
+            if line.startswith('#'):
+                if line.startswith('#EXTINF'):
+                    after_extinf = True
+                elif line.startswith(URI_TAGS) and 'URI="' in line:
+                    line = self._rewrite_tag(line)
+            elif line.strip():
+                full_url, line = self.proxied(line.strip())
+                if after_extinf:
+                    self.segments.append(full_url)
+                after_extinf = False
+
+            if not first:
+                line = "\n" + line
+            first = False
+            block.append(line)
+            block_size += len(line)
+            if block_size >= OUTPUT_BLOCK_SIZE:
+                yield "".join(block)
+                block = []
+                block_size = 0
+
+        if block:
+            yield "".join(block)
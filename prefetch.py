@@ -0,0 +1,182 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Tunables, overridable from the environment.
+PREFETCH_SEGMENTS = int(os.environ.get('ANIME_PREFETCH_SEGMENTS', '4'))     # read-ahead window
+PREFETCH_BUDGET_MB = int(os.environ.get('ANIME_PREFETCH_BUDGET_MB', '128'))  # bytes held in memory
+PREFETCH_WORKERS = int(os.environ.get('ANIME_PREFETCH_WORKERS', '4'))
+PREFETCH_PLAYLISTS = 4   # media playlists tracked at once (e.g. a second tab)
+
+class _Playlist:
+    def __init__(self, referer):
+        self.referer = referer
+        self.segments = []
+        self.position = -1     # index of the segment the player asked for last
+
+class Prefetcher:
+    """
+    Keeps the next few segments of each media playlist downloaded ahead of
+    the player, so upstream stalls are absorbed before playback reaches them.
+
+    register() is called when a media playlist is rewritten, take() when the
+    player requests a segment. A request that does not follow the previous one
+    is treated as a seek: the old window is dropped and a new one is started
+    from the requested position.
+    """
+    def __init__(self, fetch, window=PREFETCH_SEGMENTS, budget_bytes=PREFETCH_BUDGET_MB * 1024 * 1024,
+                 workers=PREFETCH_WORKERS, max_playlists=PREFETCH_PLAYLISTS):
+        # fetch(url, referer) -> (body bytes, content type); raises on failure.
+        self._fetch = fetch
+        self.window = window
+        self.budget_bytes = budget_bytes
+        self.max_playlists = max_playlists
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+        self._lock = threading.Lock()
+        self._playlists = OrderedDict()  # playlist url -> _Playlist
+        self._segment_index = {}         # segment url -> (playlist url, index)
+        self._store = {}                 # segment url -> (body, content type)
+        self._inflight = {}              # segment url -> Future
+        self._bytes = 0
+        self._stats = {'hits': 0, 'waited': 0, 'misses': 0, 'fetched': 0,
+                       'failed': 0, 'discarded': 0, 'seeks': 0}
+
+    def register(self, playlist_url, segment_urls, referer):
+        """
+        Records the segment order of a media playlist and starts warming the
+        first window. Live playlists re-register on every refresh and keep
+        their position.
+        """
+        if self.window <= 0 or not segment_urls:
+            return
+        with self._lock:
+            playlist = self._playlists.get(playlist_url)
+            if playlist is None:
+                playlist = _Playlist(referer)
+                self._playlists[playlist_url] = playlist
+                while len(self._playlists) > self.max_playlists:
+                    old_url, _ = self._playlists.popitem(last=False)
+                    self._forget_playlist(old_url)
+            self._playlists.move_to_end(playlist_url)
+
+            current = playlist.segments[playlist.position] if 0 <= playlist.position < len(playlist.segments) else None
+            playlist.segments = list(segment_urls)
+            playlist.referer = referer
+            playlist.position = playlist.segments.index(current) if current in playlist.segments else -1
+            for index, url in enumerate(playlist.segments):
+                self._segment_index[url] = (playlist_url, index)
+            self._fill_window(playlist)
+
+    def take(self, url, timeout=None):
+        """
+        Called for every segment the player requests.
+        Returns (body, content type) if the segment was prefetched, else None.
+        Waits for a prefetch that is already in flight instead of fetching twice.
+        """
+        with self._lock:
+            location = self._segment_index.get(url)
+            if location is None:
+                return None
+            playlist_url, index = location
+            playlist = self._playlists.get(playlist_url)
+            if playlist is None:
+                return None
+
+            if index not in (playlist.position, playlist.position + 1):
+                self._seek(playlist, index)
+            playlist.position = index
+            self._playlists.move_to_end(playlist_url)
+
+            entry = self._pop(url)
+            future = None if entry else self._inflight.get(url)
+            self._fill_window(playlist)
+
+            if entry:
+                self._stats['hits'] += 1
+                return entry
+            if future is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['waited'] += 1
+
+        try:
+            future.result(timeout=timeout)
+        except Exception:
+            return None
+        with self._lock:
+            return self._pop(url)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, window=self.window, budget_bytes=self.budget_bytes,
+                        stored_bytes=self._bytes, stored_segments=len(self._store),
+                        inflight=len(self._inflight), playlists=len(self._playlists))
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    # Internal helpers, called with self._lock held.
+
+    def _fill_window(self, playlist):
+        start = playlist.position + 1
+        for index in range(start, min(start + self.window, len(playlist.segments))):
+            url = playlist.segments[index]
+            if url in self._store or url in self._inflight:
+                continue
+            if self._bytes >= self.budget_bytes:
+                break
+            self._inflight[url] = self._executor.submit(self._run, url, playlist.referer)
+
+    def _wanted(self, url):
+        location = self._segment_index.get(url)
+        if location is None:
+            return False
+        playlist = self._playlists.get(location[0])
+        return playlist is not None and playlist.position <= location[1] <= playlist.position + self.window
+
+    def _run(self, url, referer):
+        try:
+            body, content_type = self._fetch(url, referer)
+        except Exception:
+            with self._lock:
+                self._inflight.pop(url, None)
+                self._stats['failed'] += 1
+            raise
+        with self._lock:
+            self._inflight.pop(url, None)
+            self._stats['fetched'] += 1
+            if not self._wanted(url) or self._bytes + len(body) > self.budget_bytes:
+                # The player seeked away (or the budget is full) while this was downloading.
+                self._stats['discarded'] += 1
+                return
+            self._store[url] = (body, content_type)
+            self._bytes += len(body)
+
+    def _seek(self, playlist, index):
+        self._stats['seeks'] += 1
+        keep = set(playlist.segments[index:index + self.window + 1])
+        for url in playlist.segments:
+            if url in keep:
+                continue
+            future = self._inflight.pop(url, None)
+            if future is not None:
+                future.cancel()
+            if self._pop(url):
+                self._stats['discarded'] += 1
+
+    def _forget_playlist(self, playlist_url):
+        for url, (owner, _) in list(self._segment_index.items()):
+            if owner != playlist_url:
+                continue
+            del self._segment_index[url]
+            future = self._inflight.pop(url, None)
+            if future is not None:
+                future.cancel()
+            self._pop(url)
+
+    def _pop(self, url):
+        entry = self._store.pop(url, None)
+        if entry:
+            self._bytes -= len(entry[0])
+        return entry
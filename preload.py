@@ -0,0 +1,147 @@
+import os
+import threading
+
+PRELOAD_ENABLED = os.environ.get('ANIME_PRELOAD', '1') != '0'
+# How long 'next' waits for a preload that is still running before giving
+# up on it; starting a second extraction would not be faster.
+PRELOAD_WAIT = 60
+WARM_TIMEOUT = 15
+
+class _Preload:
+    def __init__(self, series_url, episode, episode_url):
+        self.series_url = series_url
+        self.episode = episode
+        self.episode_url = episode_url
+        self.stream = None
+        self.warmed = False
+        self.cancelled = False
+        self.done = threading.Event()
+
+class Preloader:
+    """
+    While an episode plays, extracts the next episode's stream in the
+    background and asks the proxy to warm it (playlist, first segments and
+    subtitles), so 'next' can start playback right away.
+
+    Only one preload is kept. Playing any other episode discards it.
+
+    Preloads run while the prompt is waiting for input, so their messages
+    go to on_message(message) instead of the console; the latest one is
+    kept in self.message either way and shown by summary().
+    """
+    def __init__(self, scraper, server_url, enabled=PRELOAD_ENABLED, on_message=None):
+        self.scraper = scraper
+        self.server_url = server_url
+        self.enabled = enabled
+        self.on_message = on_message
+        self.message = None
+        self._current = None
+        self._lock = threading.Lock()
+        self._stats = {'started': 0, 'used': 0, 'discarded': 0, 'failed': 0}
+
+    def start(self, series_url, episode, episode_url):
+        if not self.enabled:
+            return
+        self.discard()
+        pending = _Preload(series_url, episode, episode_url)
+        with self._lock:
+            self._current = pending
+            self._stats['started'] += 1
+        threading.Thread(target=self._run, args=(pending,), name='preload', daemon=True).start()
+
+    def take(self, series_url, episode, timeout=PRELOAD_WAIT):
+        """
+        Returns the preloaded stream data for this episode, or None.
+        Any other preload is discarded.
+        """
+        with self._lock:
+            pending = self._current
+            self._current = None
+        if pending is None:
+            return None
+        if (pending.series_url, pending.episode) != (series_url, episode):
+            self._cancel(pending)
+            return None
+        if not pending.done.is_set():
+            print("Waiting for the preload to finish...")
+        pending.done.wait(timeout)
+        if not pending.stream:
+            return None
+        with self._lock:
+            self._stats['used'] += 1
+        return pending.stream
+
+    def discard(self):
+        with self._lock:
+            pending = self._current
+            self._current = None
+        if pending is not None:
+            self._cancel(pending)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, enabled=self.enabled)
+
+    def summary(self):
+        stats = self.stats()
+        if not stats['enabled']:
+            return "Preload: disabled (ANIME_PRELOAD=0)"
+        rate = (stats['used'] / stats['started'] * 100) if stats['started'] else 0.0
+        line = (f"Preload: used {stats['used']} of {stats['started']} ({rate:.1f}%), "
+                f"{stats['discarded']} discarded, {stats['failed']} failed")
+        if self.message:
+            line += f"  (last: {self.message})"
+        return line
+
+    def _cancel(self, pending):
+        pending.cancelled = True
+        with self._lock:
+            self._stats['discarded'] += 1
+
+    def _log(self, message):
+        self.message = message.strip()
+        if self.on_message is not None:
+            self.on_message(self.message)
+
+    def _run(self, pending):
+        try:
+            # The sync Playwright API belongs to the main thread; the batch
+            # API shares the scraper's background browser, so only the
+            # first preload (or batch) of the session launches one.
+            stream = None
+            for _, stream in self.scraper.iter_stream_urls([pending.episode_url], concurrency=1,
+                                                          log=self._log):
+                pass
+            if not stream or pending.cancelled:
+                return
+            import requests
+            try:
+                r = requests.post(f"{self.server_url}/warm", timeout=WARM_TIMEOUT, json={
+                    'url': stream['url'],
+                    'referer': stream['referer'],
+                    'subs': self._subtitle_url(stream),
+                })
+            except requests.exceptions.RequestException:
+                # No server to warm; the stream itself is still good.
+                pending.stream = stream
+                return
+            if r.status_code == 502:
+                # The playlist could not be fetched, so the stream is dead.
+                if hasattr(self.scraper, 'invalidate_stream'):
+                    self.scraper.invalidate_stream(pending.episode_url)
+                return
+            pending.warmed = r.status_code == 200
+            pending.stream = stream
+        except Exception as e:
+            self._log(f"Preload failed: {e}")
+        finally:
+            if not pending.stream and not pending.cancelled:
+                with self._lock:
+                    self._stats['failed'] += 1
+            pending.done.set()
+
+    def _subtitle_url(self, stream):
+        subs = stream.get('subs') or []
+        if not subs:
+            return None
+        return next((s for s in subs if "English" in s['lang']), subs[0])['url']
@@ -0,0 +1,217 @@
+"""
+Disk cache of HLS segments shared by the streaming proxy and the downloader.
+
+Segments are stored under the SHA-1 of their normalized upstream URL,
+query included, so whichever of the two reaches a segment first pays for
+the fetch and the other reads it from disk. The cache has a size cap; the
+least recently used segments are deleted first.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from upstream import normalize_url
+
+# Tunables, overridable from the environment.
+SEGMENT_CACHE_DIR = os.environ.get('ANIME_SEGMENT_CACHE_DIR', '.segment-cache')
+SEGMENT_CACHE_MB = float(os.environ.get('ANIME_SEGMENT_CACHE_MB', '1024'))  # 0 disables the cache
+
+# Segments smaller than this are not worth a file (and are probably errors).
+MIN_SEGMENT_BYTES = 1024
+
+# Sent for cached segments; the original Content-Type is not kept.
+SEGMENT_CONTENT_TYPE = 'video/mp2t'
+
+class SegmentCache:
+    """
+    Thread-safe; several processes may share the directory. Each process
+    tracks the size of what it has seen and evicts from that, so the cap
+    is approximate when they do.
+    """
+    def __init__(self, directory=SEGMENT_CACHE_DIR, max_mb=SEGMENT_CACHE_MB):
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size, least recently used first
+        self._bytes = 0
+        self._stats = {}  # consumer -> {'hits', 'misses', 'stores', 'hit_bytes'}
+        self._evicted = 0
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._scan()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, url):
+        # The query is kept: some hosts name segments only by it
+        # (seg.php?n=1, seg.php?n=2). A segment signed with a new token is
+        # then fetched again rather than risking another segment's bytes.
+        return hashlib.sha1(normalize_url(url, keep_query=True).encode('utf-8')).hexdigest()
+
+    def get(self, url, consumer, count_miss=True):
+        """
+        Returns the cached body of a segment, or None.
+        `consumer` ('proxy', 'prefetch', 'download') labels the hit ratio.
+        Callers that do not know yet whether `url` is a segment pass
+        count_miss=False and call miss() once they do.
+        """
+        if not self.enabled:
+            return None
+        key = self.key(url)
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                body = f.read()
+        except OSError:
+            if count_miss:
+                self._count(consumer, 'misses')
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            else:
+                # Written by another process.
+                self._entries[key] = len(body)
+                self._bytes += len(body)
+        try:
+            # Keeps the LRU order across restarts (see _scan).
+            os.utime(path)
+        except OSError:
+            pass
+        self._count(consumer, 'hits', len(body))
+        return body
+
+    def miss(self, consumer):
+        if self.enabled:
+            self._count(consumer, 'misses')
+
+    def put(self, url, body, consumer):
+        """
+        Stores a complete segment body. Only call this with 200 responses.
+        """
+        if not self.enabled or len(body) < MIN_SEGMENT_BYTES or len(body) > self.max_bytes:
+            return
+        key = self.key(url)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Segment cache write failed: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = len(body)
+                self._bytes += len(body)
+            self._evict()
+        self._count(consumer, 'stores')
+
+    def stats(self):
+        with self._lock:
+            consumers = {name: dict(counts) for name, counts in self._stats.items()}
+            stored_bytes, entries, evicted = self._bytes, len(self._entries), self._evicted
+        for counts in consumers.values():
+            lookups = counts['hits'] + counts['misses']
+            counts['hit_ratio'] = round(counts['hits'] / lookups, 3) if lookups else None
+        hits = sum(c['hits'] for c in consumers.values())
+        lookups = hits + sum(c['misses'] for c in consumers.values())
+        return {
+            'enabled': self.enabled,
+            'max_bytes': self.max_bytes,
+            'stored_bytes': stored_bytes,
+            'segments': entries,
+            'evicted': evicted,
+            'hit_ratio': round(hits / lookups, 3) if lookups else None,
+            'saved_bytes': sum(c['hit_bytes'] for c in consumers.values()),
+            'consumers': consumers,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        if not stats['enabled']:
+            return "Segment cache: disabled (ANIME_SEGMENT_CACHE_MB=0)"
+        ratios = ", ".join(f"{name} {counts['hits']}/{counts['hits'] + counts['misses']}"
+                           for name, counts in sorted(stats['consumers'].items())
+                           if counts['hits'] + counts['misses'])
+        return (f"Segment cache: {stats['segments']} segments, "
+                f"{stats['stored_bytes'] / 1e6:.1f} of {stats['max_bytes'] / 1e6:.0f} MB, "
+                f"{stats['saved_bytes'] / 1e6:.1f} MB not re-fetched"
+                + (f" (hits: {ratios})" if ratios else ""))
+
+    # Internal helpers.
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _count(self, consumer, event, num_bytes=0):
+        metrics.SEGMENT_CACHE_EVENTS.inc(consumer=consumer, event=event)
+        with self._lock:
+            counts = self._stats.setdefault(consumer, {'hits': 0, 'misses': 0, 'stores': 0, 'hit_bytes': 0})
+            counts[event] += 1
+            counts['hit_bytes'] += num_bytes
+
+    def _scan(self):
+        """
+        Loads what is already on disk, oldest access first.
+        """
+        found = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    # Left over from a crash mid-write.
+                    try:
+                        if time.time() - os.path.getmtime(path) > 3600:
+                            os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found.append((st.st_mtime, name, st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._bytes += size
+        self._evict()
+
+    def _evict(self):
+        # Called with self._lock held (or before the cache is shared).
+        while self._bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._evicted += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+_shared = None
+_shared_lock = threading.Lock()
+
+def shared_cache():
+    """
+    The SegmentCache used by the proxy and the downloader in this process.
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = SegmentCache()
+        return _shared
@@ -1,156 +1,575 @@
-from flask import Flask, request, Response, render_template, jsonify
+from flask import Flask, request, Response, render_template, jsonify, g, abort
 from flask_cors import CORS
+from werkzeug.security import safe_join
+from werkzeug.serving import make_server, WSGIRequestHandler
 import requests
 import os
 import signal
+import sys
+import threading
+import time
+from urllib.parse import quote
+from playlist import PlaylistRewriter, resolve_uri
+from upstream import UpstreamPool, CircuitOpen, USER_AGENT, CONNECT_TIMEOUT, READ_TIMEOUT, BASE_URL
+from prefetch import Prefetcher
+from variants import ThroughputMeter, parse_master_playlist, select_variants, describe
+from episode_store import STORE_DIR, local_media, local_playlist, subtitle_file
+from segment_cache import shared_cache, SEGMENT_CONTENT_TYPE
+from singleflight import Flight, FlightRegistry
+import metrics
+import tracing
+from metrics import RequestMetrics
+from kill_service import PORT
 
 app = Flask(__name__)
 CORS(app)
 
-PORT = 5001
+# Seconds BackgroundServer.wait_ready() polls /health before giving up.
+HEALTH_TIMEOUT = 10
+
+# Referer sent upstream when the player does not pass one (e.g. subtitles).
+DEFAULT_REFERER = BASE_URL + '/'
+
+# Shared by all request threads so segment fetches reuse upstream connections.
+upstream = UpstreamPool()
+
+# Upstream segment transfer rates, used to pick the variant a master
+# playlist starts on (see variants.select_variants).
+throughput = ThroughputMeter()
+
+# Segments on disk, shared with the downloader in this process.
+segment_cache = shared_cache()
+
+# Upstream fetches in progress, joined by identical requests.
+flights = FlightRegistry(Flight)
+
+def fetch_segment(url, referer):
+    cached = segment_cache.get(url, 'prefetch')
+    if cached is not None:
+        return cached, SEGMENT_CONTENT_TYPE
+    started = time.perf_counter()
+    resp = upstream.get(url, headers={'Referer': referer}, stream=False)
+    if resp.status_code >= 400:
+        metrics.UPSTREAM_ERRORS.inc(status=resp.status_code)
+    resp.raise_for_status()
+    throughput.record(len(resp.content), time.perf_counter() - started)
+    metrics.BYTES_IN.inc(len(resp.content), kind='prefetch')
+    content_type = resp.headers.get('Content-Type', 'video/mp2t')
+    # Same rule as /proxy: the cache serves everything as a segment, so
+    # subtitles and other text stay out of it.
+    if resp.status_code == 200 and not content_type.startswith('text/'):
+        segment_cache.put(url, resp.content, 'prefetch')
+    return resp.content, content_type
+
+# Downloads the next segments of each media playlist ahead of the player.
+prefetcher = Prefetcher(fetch_segment)
+
+@app.before_request
+def start_metrics():
+    rule = request.url_rule
+    g.metrics = RequestMetrics(rule.rule if rule else 'unmatched')
+
+@app.after_request
+def finish_metrics(response):
+    m = g.metrics
+    timing = m.server_timing()
+    if timing:
+        response.headers['Server-Timing'] = timing
+    if response.is_streamed:
+        # Streamed bodies are only complete once the response is closed.
+        # Streamed routes must not set direct_passthrough: werkzeug hands
+        # such bodies to the server as they are and never calls close().
+        response.response = m.count(response.response)
+    else:
+        m.bytes_out = response.content_length or 0
+    response.call_on_close(lambda: m.finish(response.status_code))
+    g.metrics_scheduled = True
+    return response
+
+@app.teardown_request
+def abandon_metrics(exc):
+    # A request that never produced a response still leaves the gauges.
+    if 'metrics' in g and not g.get('metrics_scheduled'):
+        g.metrics.finish(500)
 
 @app.route('/')
 def index():
     url = request.args.get('url')
     subs = request.args.get('subs')
-    return render_template('player.html', url=url, subs=subs)
+    local = request.args.get('local')
+    return render_template('player.html', url=url, subs=subs, local=local)
+
+# Segments are forwarded as they arrive. Chunks start small so the first
+# bytes reach the player quickly, then grow so large segments are copied
+# with few iterations while memory per request stays bounded.
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 512 * 1024
+
+# Headers that describe the upstream connection, not the payload.
+HOP_BY_HOP_HEADERS = ['connection', 'keep-alive', 'transfer-encoding', 'te', 'trailer', 'upgrade']
+
+def iter_body(resp, first_chunk=b''):
+    """
+    Yields the upstream body with a chunk size that doubles up to MAX_CHUNK_SIZE.
+    Always releases the upstream connection, even if the client disconnects.
+    """
+    try:
+        if first_chunk:
+            yield first_chunk
+        chunk_size = MIN_CHUNK_SIZE
+        while True:
+            chunk = resp.raw.read(chunk_size, decode_content=True)
+            if not chunk:
+                break
+            yield chunk
+            chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+    finally:
+        resp.close()
+
+def is_playlist(resp, first_chunk):
+    """
+    Detects an HLS playlist from the Content-Type or the first bytes of the body.
+    Gogoanime serves playlists as master.txt or with query params, so the
+    extension alone is not reliable.
+    """
+    content_type = resp.headers.get('Content-Type', '').lower()
+    if 'mpegurl' in content_type:
+        return True
+    return first_chunk.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'#EXTM3U')
 
 @app.route('/proxy')
 def proxy():
     url = request.args.get('url')
-    referer = request.args.get('referer', 'https://anitaku.to/')
+    referer = request.args.get('referer', DEFAULT_REFERER)
     
     if not url:
         return "Missing URL", 400
 
     headers = {
         'Referer': referer,
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+        'User-Agent': USER_AGENT
     }
 
+    # Forward byte ranges so the player can seek inside large files.
+    # Ranges refer to the encoded bytes, so ask for an unencoded body.
+    m = g.metrics
+    range_header = request.headers.get('Range')
+    flight = reader = None
+    if range_header:
+        headers['Range'] = range_header
+        headers['Accept-Encoding'] = 'identity'
+    else:
+        # Segments read ahead by the prefetcher are served from memory.
+        started = time.perf_counter()
+        prefetched = prefetcher.take(url, timeout=READ_TIMEOUT)
+        result = 'hit' if prefetched else 'miss'
+        metrics.PREFETCH_LOOKUPS.inc(result=result)
+        m.mark('prefetch', started, result)
+        if prefetched:
+            m.kind = 'segment'
+            body, content_type = prefetched
+            return Response(body, status=200, content_type=content_type)
+
+        # Segments the downloader (or an earlier session) already fetched.
+        # Whether url is a segment is only known once upstream answers,
+        # so a miss is counted below.
+        started = time.perf_counter()
+        cached = segment_cache.get(url, 'proxy', count_miss=False)
+        if cached is not None:
+            m.kind = 'segment'
+            m.mark('cache', started, 'hit')
+            return Response(cached, status=200, content_type=SEGMENT_CONTENT_TYPE)
+
+        # The same URL may already be on its way from upstream.
+        if flights.enabled:
+            flight, reader, leader = flights.join(url, referer)
+            if not leader:
+                return follow_flight(flight, reader, url, referer, m)
+
     try:
-        resp = requests.get(url, headers=headers, stream=True)
-        
-        # Check if it's a playlist (m3u8) by content sniffing
-        # Gogoanime URLs might have query params preventing endswith check
-        # Checking first few bytes for #EXTM3U is safest
-        
-        content_sample = resp.content[:10].decode('utf-8', errors='ignore')
-        is_m3u8 = '#EXTM3U' in content_sample
-
-        if is_m3u8:
-            content = resp.text
-            # Rewrite URLs in the m3u8 content
-            # M3U8 lines that are not comments (#) are URIs.
-            # We need to wrap them in our proxy.
-            
-            # Helper to encode
-            from urllib.parse import quote, urljoin, urlparse
-            
-            new_lines = []
-            
-            for line in content.splitlines():
-                if line.strip() and not line.startswith('#'):
-                    # It's a URL
-                    target_url = line.strip()
-                    
-                    # Logic to handle Gogoanime's weird relative paths that duplicate the full path
-                    # e.g. Base: /path/to/master.txt, Target: path/to/segment.ts (no leading slash)
-                    # Standard urljoin would make it /path/to/path/to/segment.ts
-                    
-                    # 1. Standard Resolution
-                    full_url = urljoin(url, target_url)
-                    
-                    # 2. Heuristic for Gogoanime's missing leading slash
-                    if not target_url.startswith('http') and not target_url.startswith('/'):
-                        parsed_base = urlparse(url)
-                        base_path = parsed_base.path
-                        # Remove leading slash for comparison
-                        check_path = base_path[1:] if base_path.startswith('/') else base_path
-                        
-                        first_segment = target_url.split('/')[0]
-                        if first_segment and check_path.startswith(first_segment):
-                             root_base = f"{parsed_base.scheme}://{parsed_base.netloc}/"
-                             full_url = urljoin(root_base, target_url)
-
-                    # 3. Final Safety Net: Check for double path duplication
-                    # This handles cases where different heuristics fail.
-                    parsed_full = urlparse(full_url)
-                    path = parsed_full.path
-                    
-                    # A. Generic Deduplication (Mid-split)
-                    # Split by slash, remove empty strings
-                    parts = [p for p in path.split('/') if p]
-                    if len(parts) >= 4: # Need reasonable length to suspect duplication
-                         mid = len(parts) // 2
-                         # Check if the first half equals the second half (roughly)
-                         # We iterate to find the longest repeating sequence
-                         for length in range(mid, 1, -1):
-                             chunk1 = parts[:length]
-                             chunk2 = parts[length:2*length]
-                             if chunk1 == chunk2:
-                                 # Duplication detected!
-                                 # Keep one copy and the rest
-                                 keep = parts[:length] + parts[2*length:]
-                                 new_path = "/" + "/".join(keep)
-                                 full_url = f"{parsed_full.scheme}://{parsed_full.netloc}{new_path}"
-                                 break
-
-                    # B. Specific Check for Base Path Duplication with '//'
-                    base_dir = url.rsplit('/', 1)[0]
-                    base_path_only = urlparse(base_dir).path
-                    
-                    # Refresh parsed_full in case A changed it
-                    parsed_full = urlparse(full_url)
-                    resource_path = full_url.replace(f"{parsed_full.scheme}://{parsed_full.netloc}", "")
-                    
-                    if base_path_only and base_path_only in resource_path:
-                        # Check for /path//path Pattern
-                        check_double_slash = base_path_only + '//' + base_path_only[1:]
-                        if resource_path.startswith(check_double_slash):
-                             new_path = resource_path[len(base_path_only)+2:] # Skip /path//
-                             full_url = f"{parsed_full.scheme}://{parsed_full.netloc}{base_path_only}/{new_path}"
-                        
-                        # Check for /path/path Pattern (Standard)
-                        elif resource_path.startswith(base_path_only + base_path_only):
-                             new_path = resource_path[len(base_path_only):]
-                             full_url = f"{parsed_full.scheme}://{parsed_full.netloc}{new_path}"
-
-
-                    # Encode for proxy
-                    safe_url = quote(full_url)
-                    safe_referer = quote(referer)
-                    new_line = f"/proxy?url={safe_url}&referer={safe_referer}"
-                    new_lines.append(new_line)
-                else:
-                    new_lines.append(line)
-            
-            new_content = "\n".join(new_lines)
-            
-            # Return rewriten content
-            excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
+        m.upstream_started = time.perf_counter()
+        # The player waits on this one: hedge slow answers.
+        resp = upstream.get(url, headers=headers, stream=True, hedge=True)
+
+        # Only the first chunk is read before deciding how to forward the body.
+        first_chunk = resp.raw.read(MIN_CHUNK_SIZE, decode_content=True)
+
+        if is_playlist(resp, first_chunk):
+            m.upstream_headers('playlist', resp.status_code)
+            try:
+                body = first_chunk + resp.raw.read(decode_content=True)
+            finally:
+                resp.close()
+            m.upstream_done(len(body))
+            content = body.decode(resp.encoding or 'utf-8', errors='replace')
+            excluded_headers = HOP_BY_HOP_HEADERS + ['content-encoding', 'content-length', 'content-range', 'accept-ranges']
             headers_list = [(name, value) for (name, value) in resp.raw.headers.items()
                        if name.lower() not in excluded_headers]
-            
-            return Response(new_content, status=resp.status_code, headers=headers_list)
+            if flight is not None:
+                flight.publish({'kind': 'playlist', 'status': resp.status_code,
+                                'headers': headers_list, 'content': content})
+                flight.leave(reader)
+            return playlist_response(url, referer, content, resp.status_code, headers_list, m)
 
         else:
+            m.upstream_headers('segment', resp.status_code)
             # Binary/Stream pass-through
-            excluded_headers = ['content-encoding', 'content-length', 'transfer-encoding', 'connection']
+            # The body is decoded while streaming, so length headers only stay
+            # valid when the upstream did not compress it.
+            excluded_headers = list(HOP_BY_HOP_HEADERS)
+            if resp.headers.get('Content-Encoding', 'identity').lower() != 'identity':
+                excluded_headers += ['content-encoding', 'content-length', 'content-range']
             headers = [(name, value) for (name, value) in resp.raw.headers.items()
                        if name.lower() not in excluded_headers]
 
-            return Response(resp.iter_content(chunk_size=1024),
-                            status=resp.status_code,
-                            headers=headers)
+            started = m.upstream_started
+            ok = resp.status_code == 200
+            # Whole segments are kept for the downloader; ranges are not.
+            keep = ok and not range_header and segment_cache.enabled \
+                and not resp.headers.get('Content-Type', '').startswith('text/')
+            if keep:
+                segment_cache.miss('proxy')
+
+            source = iter_body(resp, first_chunk)
+            if flight is not None:
+                # Requests for the same URL that arrive meanwhile read along.
+                flight.publish({'kind': 'segment', 'status': resp.status_code, 'headers': headers},
+                               source, resp.close)
+                source = flight.stream(reader)
+
+            def counted():
+                num_bytes = 0
+                chunks = [] if keep else None
+                for chunk in source:
+                    num_bytes += len(chunk)
+                    if chunks is not None:
+                        chunks.append(chunk)
+                    yield chunk
+                m.upstream_done(num_bytes)
+                if ok:
+                    throughput.record(num_bytes, time.perf_counter() - started)
+                if keep:
+                    segment_cache.put(url, b"".join(chunks), 'proxy')
+
+            response = Response(counted(),
+                                status=resp.status_code,
+                                headers=headers)
+            if flight is not None:
+                response.call_on_close(lambda: flight.leave(reader))
+            return response
+    except CircuitOpen as e:
+        # Counted by HostHealth.allow().
+        return flight_error(flight, str(e), 503)
+    except requests.exceptions.Timeout as e:
+        metrics.UPSTREAM_ERRORS.inc(status='timeout')
+        return flight_error(flight, f"Upstream timed out: {e}", 504)
+    except Exception as e:
+        metrics.UPSTREAM_ERRORS.inc(status='error')
+        return flight_error(flight, str(e), 500)
+
+def playlist_response(url, referer, content, status, headers_list, m):
+    """
+    Applies the variant policy to a playlist and streams it rewritten.
+    """
+    content = choose_variants(content, m)
+    rewriter = PlaylistRewriter(url, referer)
+
+    def rewritten():
+        started = time.perf_counter()
+        yield from rewriter.rewrite(content)
+        metrics.REWRITE_SECONDS.observe(time.perf_counter() - started)
+        if status == 200:
+            prefetcher.register(url, rewriter.segments, referer)
+
+    return Response(rewritten(), status=status, headers=headers_list)
+
+def flight_error(flight, text, status):
+    # Requests waiting on this fetch get the same answer.
+    if flight is not None:
+        flight.publish({'kind': 'error', 'status': status, 'text': text})
+    return text, status
+
+def follow_flight(flight, reader, url, referer, m):
+    """
+    Answers a request that joined another request's upstream fetch of the
+    same URL: playlists are rewritten from the shared body, segments are
+    streamed from the shared buffer.
+    """
+    started = time.perf_counter()
+    head = flight.wait_head(CONNECT_TIMEOUT + READ_TIMEOUT)
+    if head is None:
+        flight.leave(reader)
+        return "Upstream timed out", 504
+    metrics.UPSTREAM_COALESCED.inc(kind=head['kind'])
+    m.kind = head['kind']
+    m.mark('coalesced', started, head['kind'])
+    if head['kind'] != 'segment':
+        flight.leave(reader)
+        if head['kind'] == 'error':
+            return head['text'], head['status']
+        return playlist_response(url, referer, head['content'], head['status'], head['headers'], m)
+    response = Response(flight.stream(reader), status=head['status'], headers=head['headers'])
+    response.call_on_close(lambda: flight.leave(reader))
+    return response
+
+def choose_variants(content, m=None):
+    """
+    Applies ANIME_VARIANT_POLICY to a master playlist, using the measured
+    throughput. Media playlists are returned unchanged. With m, the choice
+    is counted and shows up in Server-Timing.
+    """
+    started = time.perf_counter()
+    content, chosen = select_variants(content, throughput=throughput.estimate())
+    if chosen is not None and m is not None:
+        metrics.VARIANT_SELECTIONS.inc(variant=describe(chosen))
+        m.mark('variants', started, describe(chosen))
+    return content
+
+# Downloaded episodes are sent in blocks of this size when the server
+# cannot hand the file to the kernel (see send_local_file).
+LOCAL_BLOCK_SIZE = 1024 * 1024
+
+def local_info(filename):
+    """
+    What the player needs to know to play a downloaded episode from /local,
+    or None if nothing of it is on disk yet.
+    """
+    media = local_media(STORE_DIR, filename)
+    if media is None:
+        return None
+    manifest = media['manifest']
+    return {
+        'complete': media['complete'],
+        # Native downloads are MPEG-TS, which browsers only play through
+        # hls.js; yt-dlp downloads are plain MP4 files.
+        'playlist': manifest is not None,
+        'duration': sum(manifest['durations']) if manifest else None,
+        'segments': manifest['written'] if manifest else None,
+        'total_segments': manifest['segments'] if manifest else None,
+        'subs': subtitle_file(STORE_DIR, filename),
+    }
+
+SUBTITLE_TYPES = {'.vtt': 'text/vtt', '.srt': 'application/x-subrip', '.ass': 'text/x-ssa'}
+
+def send_local_file(path, size, content_type):
+    """
+    Returns a Response for the first `size` bytes of a file, honouring a
+    single Range. Under BackgroundServer the bytes go out with sendfile(),
+    without passing through Python; elsewhere they are read in blocks.
+    """
+    status = 200
+    start, end = 0, size
+    headers = {'Accept-Ranges': 'bytes', 'Cache-Control': 'no-cache'}
+    if request.range is not None:
+        span = request.range.range_for_length(size)
+        if span is None:
+            return Response(status=416, headers={'Content-Range': f"bytes */{size}"})
+        start, end = span
+        status = 206
+        headers['Content-Range'] = f"bytes {start}-{end - 1}/{size}"
+    headers['Content-Length'] = str(end - start)
+
+    sock = request.environ.get('anime.socket')
+    m = g.metrics
+
+    def body():
+        with open(path, 'rb') as f:
+            if sock is not None:
+                # An empty chunk makes werkzeug send the headers first.
+                yield b''
+                sent = sock.sendfile(f, start, end - start)
+                m.bytes_out += sent
+                return
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(LOCAL_BLOCK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    return Response(body(), status=status, headers=headers, content_type=content_type)
+
+@app.route('/local/<path:name>')
+def local(name):
+    """
+    Serves downloaded episodes from the download folder:
+
+        /local/<episode>.mp4.json  what is on disk (see local_info)
+        /local/<episode>.mp4.m3u8  playlist of the written segments, as byte ranges
+        /local/<episode>.mp4       the video, with Range support; while the
+                                   download runs, its completed prefix
+        /local/<subtitles>         a subtitle file
+    """
+    if '/' in name or safe_join(STORE_DIR, name) is None:
+        abort(404)
+    if name.endswith('.json'):
+        info = local_info(name[:-len('.json')])
+        if info is None:
+            abort(404)
+        return jsonify(info)
+    if name.endswith('.m3u8'):
+        filename = name[:-len('.m3u8')]
+        media = local_media(STORE_DIR, filename)
+        if media is None or media['manifest'] is None:
+            abort(404)
+        return Response(local_playlist(media['manifest'], quote(filename), media['complete']),
+                        content_type='application/vnd.apple.mpegurl',
+                        headers={'Cache-Control': 'no-cache'})
+    extension = os.path.splitext(name)[1]
+    if extension in SUBTITLE_TYPES:
+        path = os.path.join(STORE_DIR, name)
+        if not os.path.isfile(path):
+            abort(404)
+        return send_local_file(path, os.path.getsize(path), SUBTITLE_TYPES[extension])
+    media = local_media(STORE_DIR, name)
+    if media is None:
+        abort(404)
+    # Native downloads keep the .mp4 name but hold MPEG-TS.
+    return send_local_file(media['path'], media['size'],
+                           'video/mp2t' if media['manifest'] else 'video/mp4')
+
+def warm_stream(url, referer, subs=None):
+    """
+    Prepares a stream before the player opens it: fetches its media playlist
+    (for a master playlist, the variant hls.js will start on) and
+    hands its segments and the subtitle file to the prefetcher.
+    Raises if the playlist cannot be fetched, i.e. the stream is not usable.
+    """
+    def fetch_playlist(playlist_url):
+        resp = upstream.get(playlist_url, headers={'Referer': referer}, stream=False)
+        resp.raise_for_status()
+        rewriter = PlaylistRewriter(playlist_url, referer)
+        content = resp.text
+        for _ in rewriter.rewrite(content):
+            pass
+        return content, rewriter
+
+    playlist_url = url
+    content, rewriter = fetch_playlist(url)
+    if not rewriter.segments:
+        variants = parse_master_playlist(choose_variants(content))
+        if variants:
+            playlist_url = resolve_uri(url, variants[0]['uri'])
+            content, rewriter = fetch_playlist(playlist_url)
+
+    prefetcher.register(playlist_url, rewriter.segments, referer)
+    if subs:
+        # The player loads subtitles through /proxy without a referer.
+        prefetcher.register(subs, [subs], DEFAULT_REFERER)
+    return {"playlist": playlist_url, "segments": len(rewriter.segments), "subs": bool(subs)}
+
+@app.route('/warm', methods=['POST'])
+def warm():
+    data = request.get_json(silent=True) or {}
+    if not data.get('url'):
+        return "Missing URL", 400
+    try:
+        return jsonify(warm_stream(data['url'], data.get('referer', DEFAULT_REFERER), data.get('subs')))
+    except requests.exceptions.Timeout as e:
+        return f"Upstream timed out: {e}", 504
+    except requests.exceptions.HTTPError as e:
+        return f"Stream not available: {e}", 502
     except Exception as e:
         return str(e), 500
 
+@app.route('/stats')
+def stats():
+    return jsonify({"upstream": upstream.stats(), "prefetch": prefetcher.stats(),
+                    "throughput": throughput.stats(), "segment_cache": segment_cache.stats(),
+                    "flights": flights.stats(), "stages": tracing.tracer.stats()})
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), content_type='text/plain; version=0.0.4')
+
+@app.route('/health')
+def health():
+    return jsonify({"status": "ok"})
+
 @app.route('/shutdown', methods=['POST'])
 def shutdown():
-    os.kill(os.getpid(), signal.SIGTERM)
+    if background is not None:
+        # Running inside the CLI: stop the server, not the whole process.
+        threading.Thread(target=background.shutdown, daemon=True).start()
+    else:
+        os.kill(os.getpid(), signal.SIGTERM)
     return jsonify({"status": "Server shutting down..."})
 
+class _QuietRequestHandler(WSGIRequestHandler):
+    # Request lines would be printed over the CLI prompt.
+    def log_request(self, *args, **kwargs):
+        pass
+
+    def make_environ(self):
+        # Lets /local hand files to the kernel with sendfile().
+        environ = super().make_environ()
+        environ['anime.socket'] = self.connection
+        return environ
+
+# The BackgroundServer running in this process, if any.
+background = None
+
+class BackgroundServer:
+    """
+    Runs the Flask app on a daemon thread inside the calling process.
+    The CLI starts it once per session, so the upstream pool and the
+    prefetcher stay warm across episodes.
+    Raises OSError if the port is already taken.
+    """
+    def __init__(self, port=PORT):
+        self.port = port
+        self.url = f"http://localhost:{port}"
+        try:
+            self._server = make_server('127.0.0.1', port, app, threaded=True,
+                                       request_handler=_QuietRequestHandler)
+        except SystemExit:
+            # werkzeug prints the bind error and exits instead of raising.
+            raise OSError(f"Port {port} is in use")
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='proxy-server', daemon=True)
+
+    def start(self):
+        global background
+        background = self
+        self._thread.start()
+        return self
+
+    def wait_ready(self, timeout=HEALTH_TIMEOUT):
+        """
+        Polls /health until the server answers. Returns True once it does.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            try:
+                if requests.get(f"{self.url}/health", timeout=1).status_code == 200:
+                    return True
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.05)
+        return False
+
+    def running(self):
+        return self._thread.is_alive()
+
+    def shutdown(self):
+        global background
+        self._server.shutdown()
+        self._server.server_close()
+        if background is self:
+            background = None
+
 if __name__ == '__main__':
-    print(f"Starting server v2 (Fix Applied) on http://localhost:{PORT}")
-    app.run(port=PORT, debug=False, threaded=True)
+    if '--async' in sys.argv:
+        # asyncio mode: one event loop multiplexes every upstream fetch.
+        try:
+            import async_server
+        except ImportError as e:
+            if e.name != 'aiohttp':
+                raise
+            sys.exit("--async needs aiohttp, which is not installed: pip install aiohttp")
+        async_server.run(PORT)
+    else:
+        print(f"Starting server v2 (Fix Applied) on http://localhost:{PORT}")
+        app.run(port=PORT, debug=False, threaded=True)
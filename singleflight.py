@@ -0,0 +1,410 @@
+"""
+Coalescing of identical in-flight upstream requests.
+
+When several requests for the same URL (and referer) reach the proxy at
+once, e.g. a player retry racing the original or two tabs on one episode,
+only the first goes upstream. The others attach to its response: a
+playlist is handed over whole, a segment body is fanned out chunk by chunk
+as it arrives. Each client reads at its own pace; chunks are kept until the
+slowest one has them, within FLIGHT_BUFFER_MB per flight.
+"""
+import asyncio
+import os
+import threading
+import time
+
+from upstream import normalize_url
+
+# Tunables, overridable from the environment.
+COALESCE_ENABLED = os.environ.get('ANIME_COALESCE', '1') != '0'
+FLIGHT_BUFFER_MB = float(os.environ.get('ANIME_FLIGHT_BUFFER_MB', '16'))
+
+# Seconds the other readers wait for the slowest one to make room in a full
+# buffer before it is cut off.
+SLOW_READER_TIMEOUT = 10
+
+class FlightDropped(Exception):
+    """
+    Raised in a reader that can no longer follow its flight: it fell more
+    than the buffer behind, or the upstream body failed midway.
+    """
+
+class _FlightState:
+    """
+    The buffered body of a flight and where each reader is in it.
+    Positions count chunks from the start of the body. Not thread-safe;
+    Flight and AsyncFlight serialize access.
+    """
+    def __init__(self, buffer_bytes):
+        self.buffer_bytes = buffer_bytes
+        self.head = None
+        self.chunks = []
+        self.base = 0         # position of chunks[0]
+        self.retained = 0
+        self.done = False
+        self.error = None
+        self.closed = False   # every reader left before the body was read
+        self.readers = {}     # reader id -> position of its next chunk
+        self.dropped = set()
+        self._next_reader = 0
+
+    @property
+    def finished(self):
+        return self.done or self.closed or self.error is not None
+
+    def joinable(self):
+        # A new reader starts at the first chunk, so nothing may be trimmed yet.
+        return self.base == 0 and not self.closed and self.error is None
+
+    def add_reader(self):
+        reader = self._next_reader
+        self._next_reader += 1
+        self.readers[reader] = self.base
+        return reader
+
+    def remove_reader(self, reader):
+        """
+        Returns True if this was the last reader and the body is unfinished,
+        i.e. the upstream response should be closed.
+        """
+        self.dropped.discard(reader)
+        if self.readers.pop(reader, None) is None:
+            return False
+        self.trim()
+        if not self.readers and not self.finished:
+            self.closed = True
+            return True
+        return False
+
+    def take(self, reader):
+        """
+        Returns the reader's next chunk and moves it on, or None if that
+        chunk has not arrived yet.
+        """
+        index = self.readers[reader] - self.base
+        if index >= len(self.chunks):
+            return None
+        chunk = self.chunks[index]
+        self.readers[reader] += 1
+        self.trim()
+        return chunk
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+        self.retained += len(chunk)
+        self.trim()
+
+    def trim(self):
+        # Chunks stay while they fit, so late requests can still join.
+        slowest = min(self.readers.values(), default=self.base + len(self.chunks))
+        while self.retained > self.buffer_bytes and self.base < slowest:
+            self.retained -= len(self.chunks.pop(0))
+            self.base += 1
+
+    def full(self):
+        return self.retained > self.buffer_bytes
+
+    def drop_slowest(self):
+        reader = min(self.readers, key=self.readers.get)
+        del self.readers[reader]
+        self.dropped.add(reader)
+        self.trim()
+
+class Flight:
+    """
+    One upstream response shared by the threaded server's requests for
+    the same URL. The leader calls publish() once the response headers are
+    in; every reader, the leader included, then reads the body with
+    stream(). Whichever reader is furthest ahead pulls the next chunk from
+    upstream.
+    """
+    def __init__(self, buffer_bytes, registry=None, key=None):
+        self._state = _FlightState(buffer_bytes)
+        self._cond = threading.Condition()
+        self._registry = registry
+        self._key = key
+        self._source = None
+        self._close = None
+        self._pulling = False
+        self._finished = False
+
+    def attach(self):
+        """
+        Returns a new reader id, or None if the flight can no longer be joined.
+        """
+        with self._cond:
+            if not self._state.joinable():
+                return None
+            return self._state.add_reader()
+
+    def publish(self, head, source=None, close=None):
+        """
+        Hands the response to the readers. `head` describes it (status,
+        headers...); `source` yields the body and `close` releases the
+        upstream response once no reader needs it. Without a source the
+        flight is complete. Only the first call counts.
+        """
+        with self._cond:
+            if self._state.head is not None:
+                return
+            self._state.head = head
+            self._source = source
+            self._close = close
+            self._state.done = source is None
+            self._cond.notify_all()
+        if source is None:
+            self._finish()
+
+    def wait_head(self, timeout):
+        """
+        Returns the published head, or None if the leader took longer than `timeout`.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._state.head is not None, timeout)
+            return self._state.head
+
+    def stream(self, reader):
+        state = self._state
+        try:
+            while True:
+                pull = False
+                deadline = None
+                with self._cond:
+                    while True:
+                        if reader in state.dropped:
+                            raise FlightDropped("fell too far behind the other clients")
+                        chunk = state.take(reader)
+                        if chunk is not None:
+                            self._cond.notify_all()
+                            break
+                        if state.error is not None:
+                            raise FlightDropped(f"upstream failed: {state.error}")
+                        if state.done:
+                            return
+                        if state.full():
+                            now = time.monotonic()
+                            deadline = deadline or now + SLOW_READER_TIMEOUT
+                            if now >= deadline:
+                                state.drop_slowest()
+                                self._dropped()
+                                deadline = None
+                                self._cond.notify_all()
+                                continue
+                            self._cond.wait(deadline - now)
+                        elif not self._pulling:
+                            self._pulling = pull = True
+                            break
+                        else:
+                            deadline = None
+                            self._cond.wait()
+                if pull:
+                    self._pull()
+                    continue
+                yield chunk
+        finally:
+            self.leave(reader)
+
+    def leave(self, reader):
+        """
+        Detaches a reader. Safe to call more than once.
+        """
+        with self._cond:
+            closing = self._state.remove_reader(reader)
+            self._cond.notify_all()
+        if closing:
+            self._finish()
+
+    def _pull(self):
+        # Runs outside the lock; self._pulling keeps it to one thread at a time.
+        chunk = error = None
+        try:
+            chunk = next(self._source, None)
+        except Exception as e:
+            error = e
+        with self._cond:
+            self._pulling = False
+            state = self._state
+            if error is not None:
+                state.error = error
+            elif chunk is None:
+                state.done = True
+            else:
+                state.append(chunk)
+            self._cond.notify_all()
+            finished = state.finished
+        if finished:
+            self._finish()
+
+    def _dropped(self):
+        if self._registry is not None:
+            self._registry.count('dropped')
+
+    def _finish(self):
+        with self._cond:
+            if self._finished:
+                return
+            self._finished = True
+        if self._close is not None:
+            self._close()
+        if self._registry is not None:
+            self._registry.forget(self._key, self)
+
+class AsyncFlight(Flight):
+    """
+    Flight for the asyncio server: `source` is an async iterator, and the
+    upstream reads run as tasks of their own, so a reader that disconnects
+    mid-read does not cut the others off. All methods must be called from
+    the event loop.
+    """
+    def __init__(self, buffer_bytes, registry=None, key=None):
+        super().__init__(buffer_bytes, registry, key)
+        self._changed = asyncio.Event()
+        self._task = None
+
+    def publish(self, head, source=None, close=None):
+        super().publish(head, source, close)
+        self._notify()
+
+    async def wait_head(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self._state.head is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return self._state.head
+
+    async def stream(self, reader):
+        state = self._state
+        deadline = None
+        try:
+            while True:
+                if reader in state.dropped:
+                    raise FlightDropped("fell too far behind the other clients")
+                chunk = state.take(reader)
+                if chunk is not None:
+                    deadline = None
+                    self._notify()
+                    yield chunk
+                    continue
+                if state.error is not None:
+                    raise FlightDropped(f"upstream failed: {state.error}")
+                if state.done:
+                    return
+                changed = self._changed
+                timeout = None
+                if state.full():
+                    now = time.monotonic()
+                    deadline = deadline or now + SLOW_READER_TIMEOUT
+                    if now >= deadline:
+                        state.drop_slowest()
+                        self._dropped()
+                        deadline = None
+                        self._notify()
+                        continue
+                    timeout = deadline - now
+                else:
+                    deadline = None
+                    self._start_pull()
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.leave(reader)
+
+    def leave(self, reader):
+        super().leave(reader)
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _start_pull(self):
+        if self._task is None and self._source is not None:
+            self._task = asyncio.ensure_future(self._read())
+            self._task.add_done_callback(self._pulled)
+
+    async def _read(self):
+        return await self._source.__anext__()
+
+    def _pulled(self, task):
+        self._task = None
+        state = self._state
+        if task.cancelled():
+            if not state.finished:
+                state.error = 'cancelled'
+        else:
+            error = task.exception()
+            if isinstance(error, StopAsyncIteration):
+                state.done = True
+            elif error is not None:
+                state.error = error
+            else:
+                state.append(task.result())
+        self._notify()
+        if state.finished:
+            self._finish()
+
+    def _finish(self):
+        if self._task is not None:
+            # The last reader left mid-read.
+            self._task.cancel()
+        super()._finish()
+
+class FlightRegistry:
+    """
+    The flights in progress, keyed by normalized URL and referer.
+    """
+    def __init__(self, flight_class=Flight, buffer_mb=FLIGHT_BUFFER_MB, enabled=COALESCE_ENABLED):
+        self.flight_class = flight_class
+        self.buffer_bytes = int(buffer_mb * 1024 * 1024)
+        self.enabled = enabled
+        self._flights = {}
+        self._lock = threading.Lock()
+        # Separate lock: flights count drops while holding their own lock.
+        self._stats_lock = threading.Lock()
+        self._stats = {'leaders': 0, 'followers': 0, 'dropped': 0}
+
+    def join(self, url, referer):
+        """
+        Returns (flight, reader id, leader). The leader fetches `url` and
+        publishes the response; the others wait for it with wait_head().
+        """
+        key = (normalize_url(url, keep_query=True), referer)
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                reader = flight.attach()
+                if reader is not None:
+                    self.count('followers')
+                    return flight, reader, False
+            flight = self.flight_class(self.buffer_bytes, self, key)
+            self._flights[key] = flight
+            reader = flight.attach()
+        self.count('leaders')
+        return flight, reader, True
+
+    def forget(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def count(self, event):
+        with self._stats_lock:
+            self._stats[event] += 1
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._flights)
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update(enabled=self.enabled, in_flight=in_flight, buffer_bytes=self.buffer_bytes)
+        # Every follower is an upstream fetch that did not happen.
+        stats['saved'] = stats['followers']
+        return stats
@@ -0,0 +1,39 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+# The modules live at the top of the repository, not in a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Segments the tests proxy must not land in the user's cache.
+os.environ.setdefault('ANIME_SEGMENT_CACHE_DIR', tempfile.mkdtemp(prefix='anime-test-cache-'))
+
+@pytest.fixture
+def proxy():
+    """
+    The proxy app on a real threaded server, so streamed responses are
+    closed the way they are in production.
+    """
+    from werkzeug.serving import make_server
+
+    import server
+
+    httpd = make_server('127.0.0.1', 0, server.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+@pytest.fixture
+def wait_for():
+    def wait(condition, timeout=5):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.02)
+        return True
+    return wait
@@ -0,0 +1,24 @@
+"""
+`server.py --async` without aiohttp installed.
+"""
+import os
+import subprocess
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs server.py as a script with aiohttp made unimportable.
+WITHOUT_AIOHTTP = """
+import runpy, sys
+sys.modules['aiohttp'] = None
+sys.argv = ['server.py', '--async']
+runpy.run_path('server.py', run_name='__main__')
+"""
+
+def test_missing_aiohttp_is_explained():
+    result = subprocess.run([sys.executable, '-c', WITHOUT_AIOHTTP], cwd=REPO,
+                            capture_output=True, text=True, timeout=60)
+
+    assert result.returncode == 1
+    assert result.stderr.strip() == "--async needs aiohttp, which is not installed: pip install aiohttp"
+    assert 'Traceback' not in result.stderr
@@ -0,0 +1,77 @@
+"""
+DownloadManager workers keep the console clear for the interactive prompt.
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from download_manager import DownloadManager
+from downloader import GogoDownloader
+
+SEGMENTS = 4
+
+class Origin(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/ep.m3u8':
+            lines = ["#EXTM3U", "#EXT-X-TARGETDURATION:4"]
+            for i in range(SEGMENTS):
+                lines += ["#EXTINF:4.0,", f"seg{i}.ts"]
+            lines.append("#EXT-X-ENDLIST")
+            body, content_type = "\n".join(lines).encode(), 'application/vnd.apple.mpegurl'
+        elif self.path.startswith('/seg'):
+            body, content_type = b"\x47" * 4096, 'video/mp2t'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def origin():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Origin)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+@pytest.fixture
+def messages():
+    return []
+
+@pytest.fixture
+def downloads(tmp_path, messages):
+    manager = DownloadManager(GogoDownloader(download_dir=str(tmp_path), workers=2), concurrency=1,
+                              on_message=lambda job, message: messages.append((job.id, message)))
+    yield manager
+    manager.close()
+
+def wait_for(job, timeout=10):
+    deadline = time.time() + timeout
+    while job.status in ('queued', 'downloading') and time.time() < deadline:
+        time.sleep(0.05)
+
+def test_progress_goes_to_the_job_not_the_console(origin, downloads, messages, tmp_path, capsys):
+    job = downloads.submit(f"{origin}/ep.m3u8", origin, 'ep.mp4')
+    wait_for(job)
+
+    assert job.status == 'done'
+    assert (tmp_path / 'ep.mp4').exists()
+    assert capsys.readouterr().out == ''
+    assert messages[0] == (job.id, "Starting download: ep.mp4")
+    assert job.message == "Download complete!"
+
+def test_failures_show_in_the_queue(origin, downloads, capsys):
+    job = downloads.submit(f"{origin}/missing.m3u8", origin, 'ep.mp4')
+    wait_for(job)
+
+    assert job.status == 'failed'
+    assert capsys.readouterr().out == ''
+    assert job.message.startswith("Download failed: 404")
+    assert job.message in job.describe()
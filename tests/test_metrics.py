@@ -0,0 +1,62 @@
+"""
+Request metrics of the streamed routes, measured through a real server.
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import metrics
+import server
+
+SEGMENT = b'\x47' * 300000
+
+class Origin(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp2t')
+        self.send_header('Content-Length', str(len(SEGMENT)))
+        self.end_headers()
+        self.wfile.write(SEGMENT)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def origin():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Origin)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+def test_streamed_segments_finish_their_request(origin, proxy, wait_for):
+    requests_before = metrics.REQUESTS.value(route='/proxy', status=200)
+    bytes_before = metrics.BYTES_OUT.value(route='/proxy')
+    for i in range(3):
+        resp = requests.get(f"{proxy}/proxy", params={'url': f"{origin}/seg-{i}.ts"})
+        assert resp.content == SEGMENT
+
+    assert wait_for(lambda: metrics.REQUESTS.value(route='/proxy', status=200) == requests_before + 3)
+    assert metrics.ACTIVE_REQUESTS.value(route='/proxy') == 0
+    assert metrics.BYTES_OUT.value(route='/proxy') - bytes_before == 3 * len(SEGMENT)
+
+def test_local_files_finish_their_request(proxy, wait_for, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'STORE_DIR', str(tmp_path))
+    (tmp_path / 'episode.mp4').write_bytes(SEGMENT)
+    route = '/local/<path:name>'
+    full_before = metrics.REQUESTS.value(route=route, status=200)
+    partial_before = metrics.REQUESTS.value(route=route, status=206)
+
+    resp = requests.get(f"{proxy}/local/episode.mp4")
+    assert resp.content == SEGMENT
+    resp = requests.get(f"{proxy}/local/episode.mp4", headers={'Range': 'bytes=100-199'})
+    assert resp.status_code == 206
+    assert resp.content == SEGMENT[100:200]
+
+    assert wait_for(lambda: metrics.REQUESTS.value(route=route, status=200) == full_before + 1)
+    assert wait_for(lambda: metrics.REQUESTS.value(route=route, status=206) == partial_before + 1)
+    assert metrics.ACTIVE_REQUESTS.value(route=route) == 0
@@ -0,0 +1,103 @@
+"""
+PlaylistRewriter against the per-line rewrite loop it replaced
+(benchmark.legacy_rewrite_playlist).
+"""
+import re
+
+import pytest
+
+from benchmark import legacy_rewrite_playlist
+from playlist import PlaylistRewriter, URI_ATTRIBUTE, URI_TAGS, resolve_uri
+
+REFERER = 'https://embed.example/e/123'
+
+PLAYLIST_URLS = [
+    'https://cdn.example/hls/show/ep1/index.m3u8',
+    'https://cdn.example/index.m3u8',
+    'https://cdn.example:8443/hls/show/index.m3u8?token=abc',
+    'http://cdn.example/hls/./show/../show/index.m3u8',
+]
+
+REFERENCES = [
+    'seg-1.ts',
+    'seg-1.ts?token=abc&n=1',
+    'sub/seg-1.ts',
+    '/abs/seg-1.ts',
+    'https://other.example/x/seg-1.ts',
+    '//other.example/x/seg-1.ts',
+    '../up/seg-1.ts',
+    './here/seg-1.ts',
+    'sub/../up/seg-1.ts',
+    'sub/./seg-1.ts',
+    'hls/show/ep1/seg-1.ts',      # repeats the playlist's own path
+    'a/b/a/b/seg-1.ts',           # a duplicated run of path parts
+    'hls/show//hls/show/seg-1.ts',
+    'seg%201.ts',
+]
+
+def legacy_with_tags(content, url, referer):
+    """
+    The old loop left URIs in tags alone; the rewriter resolves them like
+    URI lines.
+    """
+    lines = []
+    for line in content.splitlines():
+        if line.startswith(URI_TAGS):
+            line = URI_ATTRIBUTE.sub(
+                lambda m: f'URI="{legacy_rewrite_playlist(m.group(1), url, referer)}"', line)
+        else:
+            line = legacy_rewrite_playlist(line, url, referer) if line.strip() else line
+        lines.append(line)
+    return "\n".join(lines)
+
+def media_playlist(reference):
+    return "\n".join([
+        '#EXTM3U',
+        '#EXT-X-VERSION:7',
+        '#EXT-X-TARGETDURATION:10',
+        '',
+        '# a comment',
+        f'#EXT-X-KEY:METHOD=AES-128,URI="{re.sub("seg-1.ts", "key.bin", reference)}",IV=0x1',
+        f'#EXT-X-MAP:URI="{re.sub("seg-1.ts", "init.mp4", reference)}"',
+        '#EXTINF:10.0,',
+        reference,
+        '#EXT-X-DISCONTINUITY',
+        '#EXTINF:10.0,',
+        f'  {reference}  ',
+        '   ',
+        '#EXT-X-ENDLIST',
+    ])
+
+@pytest.mark.parametrize('reference', REFERENCES)
+@pytest.mark.parametrize('url', PLAYLIST_URLS)
+def test_matches_the_legacy_rewrite(url, reference):
+    content = media_playlist(reference)
+    rewriter = PlaylistRewriter(url, REFERER)
+
+    assert "".join(rewriter.rewrite(content)) == legacy_with_tags(content, url, REFERER)
+    assert rewriter.segments == [resolve_uri(url, reference)] * 2
+
+def test_master_playlist_matches_the_legacy_rewrite():
+    url = PLAYLIST_URLS[0]
+    content = "\n".join([
+        '#EXTM3U',
+        '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="ja",URI="audio/ja.m3u8"',
+        '#EXT-X-I-FRAME-STREAM-INF:BANDWIDTH=86000,URI="iframes.m3u8"',
+        '#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,AUDIO="aud"',
+        '360p/index.m3u8',
+        '#EXT-X-STREAM-INF:BANDWIDTH=2800000,RESOLUTION=1280x720,AUDIO="aud"',
+        'https://other.example/720p/index.m3u8',
+    ])
+    rewriter = PlaylistRewriter(url, REFERER)
+
+    assert "".join(rewriter.rewrite(content)) == legacy_with_tags(content, url, REFERER)
+    assert rewriter.segments == []
+
+def test_long_playlist_matches_across_blocks():
+    url = PLAYLIST_URLS[0]
+    content = "\n".join(['#EXTM3U'] + [f'#EXTINF:4.0,\nseg-{i}.ts' for i in range(5000)]
+                        + ['#EXT-X-ENDLIST', ''])
+    blocks = list(PlaylistRewriter(url, REFERER).rewrite(content))
+
+    assert len(blocks) > 1
+    assert "".join(blocks) == legacy_with_tags(content, url, REFERER)
@@ -0,0 +1,83 @@
+"""
+Preloads and batches share the scraper's background browser.
+"""
+import asyncio
+import threading
+
+import pytest
+
+from gogo_scraper import GogoScraper
+from preload import Preloader
+
+class FakeBrowser:
+    def __init__(self):
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    async def close(self):
+        self.connected = False
+
+@pytest.fixture
+def scraper(monkeypatch):
+    scraper = GogoScraper()
+    scraper.launched = []
+
+    async def launch():
+        scraper.launched.append(threading.current_thread().name)
+        return FakeBrowser()
+
+    async def extract(browser, episode_url, log=print):
+        assert browser.is_connected()
+        if 'unreachable' in episode_url:
+            # The real HTTP fast path, which fails and falls back.
+            await asyncio.to_thread(scraper._find_embed_url_http, episode_url, log)
+            raise RuntimeError("no master playlist")
+        return {'url': f"{episode_url}/master.m3u8", 'referer': episode_url, 'subs': []}
+
+    monkeypatch.setattr(scraper, '_launch_async_browser', launch)
+    monkeypatch.setattr(scraper, '_extract_in_context', extract)
+    yield scraper
+    scraper.close()
+
+def test_preloads_reuse_one_browser(scraper):
+    # No proxy to warm: the streams are still handed over.
+    preloader = Preloader(scraper, 'http://127.0.0.1:9')
+    for episode in (2, 3, 4):
+        preloader.start('series', episode, f"https://site.example/ep-{episode}")
+        assert preloader.take('series', episode, timeout=5)['url'] == f"https://site.example/ep-{episode}/master.m3u8"
+
+    assert all(scraper.get_stream_urls(['https://site.example/ep-5', 'https://site.example/ep-6']).values())
+    assert scraper.launched == ['stream-batch']
+
+def test_a_dead_browser_is_replaced(scraper):
+    assert all(scraper.get_stream_urls(['https://site.example/ep-1']).values())
+    browser = scraper._async_launch.result()
+    browser.connected = False
+
+    assert scraper.get_stream_urls(['https://site.example/ep-2'])['https://site.example/ep-2']
+    assert len(scraper.launched) == 2
+
+def test_close_closes_the_browser(scraper):
+    assert all(scraper.get_stream_urls(['https://site.example/ep-1']).values())
+    browser = scraper._async_launch.result()
+    scraper.close()
+
+    assert not browser.is_connected()
+    assert scraper._loop is None
+
+def test_preload_messages_stay_off_the_console(scraper, capsys):
+    messages = []
+    preloader = Preloader(scraper, 'http://127.0.0.1:9', on_message=messages.append)
+    preloader.start('series', 2, 'http://127.0.0.1:9/unreachable-episode-2')
+    # Waiting in take() is the main thread's own message; skip it.
+    assert preloader._current.done.wait(5)
+
+    assert preloader.take('series', 2, timeout=5) is None
+    assert capsys.readouterr().out == ''
+    assert messages[0].startswith("HTTP fetch failed")
+    assert messages[1] == ("Stream extraction failed for http://127.0.0.1:9/unreachable-episode-2: "
+                           "no master playlist")
+    assert preloader.message.startswith("[failed] http://127.0.0.1:9/unreachable-episode-2")
+    assert preloader.message in preloader.summary()
@@ -0,0 +1,35 @@
+"""
+GogoScraper bookkeeping that does not need the site or a browser.
+"""
+import sys
+import threading
+
+import pytest
+
+from gogo_scraper import GogoScraper
+
+@pytest.fixture
+def scraper():
+    scraper = GogoScraper()
+    yield scraper
+    scraper.close()
+
+def test_fast_path_stats_survive_concurrent_updates(scraper):
+    def record(used_http):
+        for _ in range(5000):
+            scraper._record_fast_path(used_http)
+
+    # Switch threads as often as possible, so unguarded updates would collide.
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=record, args=(i % 2 == 0,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert scraper.fast_path_stats == {'http': 20000, 'fallback': 20000}
+    assert scraper.fast_path_summary() == "HTTP fast path: 20000/40000 pages, browser fallback rate 50%"
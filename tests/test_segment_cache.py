@@ -0,0 +1,106 @@
+"""
+SegmentCache keys: one entry per distinct segment URL.
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+import requests
+
+import server
+from segment_cache import SegmentCache
+
+def body(n):
+    return bytes([n]) * 4096
+
+@pytest.fixture
+def cache(tmp_path):
+    return SegmentCache(str(tmp_path), max_mb=16)
+
+def test_query_distinct_urls_do_not_collide(cache):
+    cache.put('https://cdn.example/seg.php?n=1', body(1), 'proxy')
+    cache.put('https://cdn.example/seg.php?n=2', body(2), 'proxy')
+
+    assert cache.key('https://cdn.example/seg.php?n=1') != cache.key('https://cdn.example/seg.php?n=2')
+    assert cache.get('https://cdn.example/seg.php?n=1', 'download') == body(1)
+    assert cache.get('https://cdn.example/seg.php?n=2', 'download') == body(2)
+    assert cache.get('https://cdn.example/seg.php?n=3', 'download') is None
+
+def test_equivalent_urls_share_an_entry(cache):
+    cache.put('https://CDN.example:443//hls/seg-1.ts?n=1#t=0', body(1), 'proxy')
+
+    assert cache.get('https://cdn.example/hls/seg-1.ts?n=1', 'download') == body(1)
+
+class Origin(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        n = int(parse_qs(urlsplit(self.path).query)['n'][0])
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp2t')
+        self.send_header('Content-Length', str(len(body(n))))
+        self.end_headers()
+        self.wfile.write(body(n))
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def origin():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Origin)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+def test_proxy_serves_query_named_segments_separately(origin, proxy, cache, monkeypatch):
+    monkeypatch.setattr(server, 'segment_cache', cache)
+    for _ in range(2):  # the second round is served from the cache
+        for n in (1, 2, 3):
+            resp = requests.get(f"{proxy}/proxy", params={'url': f"{origin}/seg.php?n={n}"})
+            assert resp.content == body(n)
+    assert cache.stats()['consumers']['proxy']['hits'] == 3
+
+# Big enough for the cache, which skips tiny bodies.
+VTT = b"WEBVTT\n\n" + b"".join(b"%d\n00:%02d.000 --> 00:%02d.500\nHello\n\n" % (i, i, i) for i in range(60))
+
+class SubtitledOrigin(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    served = []
+
+    def do_GET(self):
+        if self.path == '/media.m3u8':
+            data, content_type = b"#EXTM3U\n#EXTINF:4.0,\nseg.ts\n#EXT-X-ENDLIST\n", 'application/vnd.apple.mpegurl'
+        elif self.path == '/subs.vtt':
+            data, content_type = VTT, 'text/vtt'
+        else:
+            data, content_type = body(1), 'video/mp2t'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.served.append(self.path)
+
+    def log_message(self, format, *args):
+        pass
+
+def test_warmed_subtitles_keep_their_content_type(proxy, cache, monkeypatch, wait_for):
+    monkeypatch.setattr(server, 'segment_cache', cache)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), SubtitledOrigin)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    origin = f"http://127.0.0.1:{httpd.server_address[1]}"
+    try:
+        resp = requests.post(f"{proxy}/warm", json={'url': f"{origin}/media.m3u8", 'subs': f"{origin}/subs.vtt"})
+        assert resp.status_code == 200
+        assert wait_for(lambda: '/subs.vtt' in SubtitledOrigin.served)
+
+        # The first request takes the prefetched copy, the second goes past it.
+        for _ in range(2):
+            resp = requests.get(f"{proxy}/proxy", params={'url': f"{origin}/subs.vtt"})
+            assert resp.content == VTT
+            assert resp.headers['Content-Type'].startswith('text/vtt')
+    finally:
+        httpd.shutdown()
@@ -0,0 +1,66 @@
+"""
+Coalesced /proxy requests, through a real server and a slow origin.
+"""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import metrics
+import server
+
+CHUNK = b'\x47' * 65536
+CHUNKS = 100
+CHUNK_DELAY = 0.05  # the whole segment takes 5 s
+
+class SlowOrigin(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'video/mp2t')
+        self.send_header('Content-Length', str(len(CHUNK) * CHUNKS))
+        self.end_headers()
+        try:
+            for _ in range(CHUNKS):
+                self.wfile.write(CHUNK)
+                time.sleep(CHUNK_DELAY)
+        except OSError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def origin():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), SlowOrigin)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+def test_follower_that_disconnects_leaves_the_flight(origin, proxy, wait_for):
+    params = {'url': f"{origin}/slow.ts"}
+    leader_body = []
+
+    def lead():
+        leader_body.append(requests.get(f"{proxy}/proxy", params=params).content)
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    assert wait_for(lambda: len(server.flights._flights) == 1)
+    flight = next(iter(server.flights._flights.values()))
+
+    follower = requests.get(f"{proxy}/proxy", params=params, stream=True)
+    assert follower.raw.read(len(CHUNK)) == CHUNK
+    assert len(flight._state.readers) == 2
+    follower.close()
+
+    # Released as soon as a write to the closed connection fails, long
+    # before the leader is done.
+    assert wait_for(lambda: len(flight._state.readers) == 1, timeout=2)
+    leader.join()
+    assert leader_body == [CHUNK * CHUNKS]
+    assert wait_for(lambda: metrics.ACTIVE_REQUESTS.value(route='/proxy') == 0)
@@ -0,0 +1,63 @@
+"""
+`import main` stays cheap: the heavy dependencies load on first use.
+"""
+import os
+import subprocess
+import sys
+
+import main
+from preload import Preloader
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only imported by the commands that need them.
+HEAVY = {'yt_dlp', 'playwright', 'aiohttp', 'bs4'}
+
+def import_main():
+    """
+    Returns ({module: cumulative us}, total us) from `python -X importtime -c "import main"`.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                            cwd=REPO, capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        fields = line[len('import time:'):].split('|')
+        if line.startswith('import time:') and len(fields) == 3 and fields[1].strip().isdigit():
+            modules[fields[2].strip()] = int(fields[1])
+    return modules, modules['main']
+
+def test_heavy_modules_are_not_imported():
+    modules, _ = import_main()
+    assert not {name for name in modules if name.split('.')[0] in HEAVY}
+
+def test_import_is_within_budget():
+    # Best of three, so one busy moment on the machine does not fail it.
+    total_ms = min(import_main()[1] for _ in range(3)) / 1000
+    assert total_ms < main.STARTUP_BUDGET_MS
+
+def test_replaying_a_download_does_not_build_the_scraper(tmp_path, monkeypatch):
+    import cache
+
+    monkeypatch.chdir(tmp_path)
+    series = {'title': 'Bleach', 'url': 'https://site.example/category/bleach'}
+    store = cache.CacheStore()
+    store.put('search', 'bleach', [series])
+    store.put('episodes', series['url'], 2)
+    store.close()
+    os.makedirs('downloads')
+    with open(os.path.join('downloads', 'Bleach - Episode 1.mp4'), 'wb') as f:
+        f.write(b"\x47" * 1024)
+
+    def make_scraper():
+        raise AssertionError("the scraper was built")
+
+    played = []
+    answers = iter(['bleach', '1', '1', 'q'])
+    monkeypatch.setattr('builtins.input', lambda prompt='': next(answers))
+    monkeypatch.setattr(main, 'make_scraper', make_scraper)
+    monkeypatch.setattr(main, 'start_streaming_server', lambda: None)
+    monkeypatch.setattr(main, 'open_local', played.append)
+    monkeypatch.setattr(main, 'Preloader', lambda scraper, server_url: Preloader(scraper, server_url, enabled=False))
+    main.main()
+
+    assert played == [os.path.join('downloads', 'Bleach - Episode 1.mp4')]
@@ -0,0 +1,118 @@
+"""
+UpstreamPool retries and the per-host circuit breaker.
+"""
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import upstream
+from upstream import CircuitOpen, HostHealth, UpstreamPool
+
+class Origin(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    status = 200
+
+    def do_GET(self):
+        self.send_response(self.status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+class FailingOrigin(Origin):
+    status = 503
+
+def serve(handler, port=0):
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+def unused_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(upstream, 'backoff', lambda attempt: 0)
+
+@pytest.fixture
+def health():
+    return HostHealth(failures=3, cooldown=0.3)
+
+@pytest.fixture
+def pool(health):
+    pool = UpstreamPool(retries=2, connect_timeout=1, read_timeout=1, health=health)
+    yield pool
+    pool.close()
+
+def breaker(health, host):
+    return health.stats()[host]['breaker']
+
+def test_breaker_counts_requests_not_attempts(pool, health):
+    port = unused_port()
+    url = f"http://127.0.0.1:{port}/seg.ts"
+    host = f"127.0.0.1:{port}"
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            pool.get(url)
+    # Six failed attempts, but only two failed requests.
+    assert health.stats()[host]['retries'] == 4
+    assert breaker(health, host) == 'closed'
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        pool.get(url)
+    assert breaker(health, host) == 'open'
+    assert health.stats()[host]['trips'] == 1
+
+    started = time.perf_counter()
+    with pytest.raises(CircuitOpen):
+        pool.get(url)
+    assert time.perf_counter() - started < 0.1
+
+def test_server_errors_do_not_trip_the_breaker(pool, health):
+    httpd = serve(FailingOrigin)
+    host = f"127.0.0.1:{httpd.server_address[1]}"
+    try:
+        for _ in range(5):
+            resp = pool.get(f"http://{host}/broken/seg.ts", stream=False)
+            assert resp.status_code == 503
+    finally:
+        httpd.shutdown()
+    assert health.stats()[host]['retries'] == 10
+    assert breaker(health, host) == 'closed'
+    assert health.stats()[host]['failures'] == 0
+
+def test_breaker_probes_after_the_cooldown(pool, health):
+    port = unused_port()
+    url = f"http://127.0.0.1:{port}/seg.ts"
+    host = f"127.0.0.1:{port}"
+    for _ in range(3):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            pool.get(url)
+    assert breaker(health, host) == 'open'
+
+    # A failed probe keeps the breaker open for another cooldown.
+    time.sleep(health.cooldown)
+    with pytest.raises(requests.exceptions.ConnectionError) as probe:
+        pool.get(url)
+    assert not isinstance(probe.value, CircuitOpen)
+    with pytest.raises(CircuitOpen):
+        pool.get(url)
+
+    # A successful one closes it.
+    httpd = serve(Origin, port)
+    try:
+        time.sleep(health.cooldown)
+        assert pool.get(url, stream=False).content == b'ok'
+        assert breaker(health, host) == 'closed'
+        assert pool.get(url, stream=False).status_code == 200
+    finally:
+        httpd.shutdown()
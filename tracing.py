@@ -0,0 +1,165 @@
+"""
+Timing spans for the episode pipeline, from search to the first segment.
+
+Each stage (search, episode page, embed, server start, playlist and
+segment fetches, downloads...) records a span with its start, duration and
+thread. The `stats` command summarizes the recent spans per stage;
+`main.py --trace` writes the session as a Chrome trace (open it in
+chrome://tracing or https://ui.perfetto.dev) and `--profile` runs it under
+cProfile.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Tunables, overridable from the environment.
+TRACE_SPANS = int(os.environ.get('ANIME_TRACE_SPANS', '20000'))  # spans kept for the trace file
+
+# Durations kept per stage for the summary.
+STAGE_SAMPLES = 200
+
+class Tracer:
+    """
+    Thread-safe. Stage names are "<component>.<stage>", e.g. "scraper.embed";
+    the component becomes the trace event's category.
+    """
+    def __init__(self, max_spans=TRACE_SPANS, samples=STAGE_SAMPLES):
+        self.samples = samples
+        self._origin = time.perf_counter()
+        self._started_at = time.time()
+        self._lock = threading.Lock()
+        self._spans = deque(maxlen=max_spans)
+        self._stages = {}   # name -> recent durations in seconds, in first-seen order
+        self._counts = {}
+        self._threads = {}  # thread ident -> name
+
+    @contextmanager
+    def span(self, name, **args):
+        """
+        Times the body of a with block. Yields a dict of arguments the block
+        can add to, e.g. `with tracer.span('cli.search') as info: info['results'] = 3`.
+        """
+        started = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.record(name, started, **args)
+
+    def record(self, name, started, ended=None, **args):
+        """
+        Records a span that began at `started` (time.perf_counter()) and
+        ends at `ended`, by default now.
+        """
+        ended = time.perf_counter() if ended is None else ended
+        thread = threading.current_thread()
+        with self._lock:
+            self._spans.append((name, started, ended - started, thread.ident, args))
+            self._threads[thread.ident] = thread.name
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = deque(maxlen=self.samples)
+            stage.append(ended - started)
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def stats(self):
+        """
+        Returns {stage: {'count', 'last_ms', 'p50_ms', 'p95_ms', 'max_ms'}}
+        over each stage's recent spans.
+        """
+        with self._lock:
+            stages = [(name, list(durations), self._counts[name]) for name, durations in self._stages.items()]
+        result = {}
+        for name, durations, count in stages:
+            ordered = sorted(durations)
+            result[name] = {
+                'count': count,
+                'last_ms': round(durations[-1] * 1000, 1),
+                'p50_ms': round(_percentile(ordered, 0.5) * 1000, 1),
+                'p95_ms': round(_percentile(ordered, 0.95) * 1000, 1),
+                'max_ms': round(ordered[-1] * 1000, 1),
+            }
+        return result
+
+    def summary(self):
+        """
+        Returns printable lines, one per stage in the order stages first ran.
+        """
+        stats = self.stats()
+        if not stats:
+            return ["No stages timed yet."]
+        width = max(len(name) for name in stats)
+        lines = [f"{'Stage':<{width}}  {'Count':>5}  {'Last':>9}  {'p50':>9}  {'p95':>9}  {'Max':>9}"]
+        for name, s in stats.items():
+            lines.append(f"{name:<{width}}  {s['count']:>5}  {s['last_ms']:>6.0f} ms  {s['p50_ms']:>6.0f} ms  "
+                         f"{s['p95_ms']:>6.0f} ms  {s['max_ms']:>6.0f} ms")
+        return lines
+
+    def write(self, path):
+        """
+        Writes the recorded spans in the Chrome trace event format.
+        """
+        with self._lock:
+            spans = list(self._spans)
+            threads = dict(self._threads)
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+                  for tid, name in threads.items()]
+        for name, started, duration, tid, args in spans:
+            events.append({
+                'name': name,
+                'cat': name.split('.', 1)[0],
+                'ph': 'X',
+                'ts': round((started - self._origin) * 1e6),
+                'dur': round(duration * 1e6),
+                'pid': pid,
+                'tid': tid,
+                'args': {key: _jsonable(value) for key, value in args.items()},
+            })
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                       'otherData': {'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self._started_at))}}, f)
+        return len(spans)
+
+def _percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def _jsonable(value):
+    return value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+
+# Shared by every module in the process.
+tracer = Tracer()
+span = tracer.span
+record = tracer.record
+
+def session_file(prefix, extension):
+    return os.path.join('traces', f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+@contextmanager
+def profiled(path, top=25):
+    """
+    Runs the body of a with block under cProfile, then saves the profile to
+    `path` (for snakeviz or pstats) and prints the costliest functions.
+    cProfile only sees the thread that entered the block; the server and
+    download threads show up in the trace instead.
+    """
+    import cProfile
+    import pstats
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield profile
+    finally:
+        profile.disable()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        profile.dump_stats(path)
+        print(f"\n--- Profile (main thread, by cumulative time; saved to {path}) ---")
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(top)
@@ -0,0 +1,301 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+# Defined in utils, so the CLI can build episode URLs without importing requests.
+from utils import BASE_URL
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+# Tunables, overridable from the environment.
+POOL_SIZE = int(os.environ.get('ANIME_POOL_SIZE', '16'))       # connections kept per host
+POOL_HOSTS = int(os.environ.get('ANIME_POOL_HOSTS', '8'))      # hosts kept in the pool
+CONNECT_TIMEOUT = float(os.environ.get('ANIME_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.environ.get('ANIME_READ_TIMEOUT', '30'))
+HEDGE_ENABLED = os.environ.get('ANIME_HEDGE', '1') != '0'
+HEDGE_MIN_MS = float(os.environ.get('ANIME_HEDGE_MIN_MS', '200'))  # never hedge sooner than this
+RETRIES = int(os.environ.get('ANIME_UPSTREAM_RETRIES', '2'))      # extra attempts per request
+BREAKER_FAILURES = int(os.environ.get('ANIME_BREAKER_FAILURES', '5'))
+BREAKER_COOLDOWN = float(os.environ.get('ANIME_BREAKER_COOLDOWN', '30'))
+
+# A duplicate request is sent once the first has waited longer than this
+# percentile of the host's recent time-to-first-byte.
+HEDGE_PERCENTILE = 0.95
+# Before a host has this many samples, hedge after HEDGE_DEFAULT_MS.
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_MS = 1000
+TTFB_WINDOW = 200
+# Base of the exponential retry backoff, in seconds.
+RETRY_BACKOFF = 0.25
+# Statuses worth retrying. They do not count against the host's breaker:
+# one failing path says little about the host.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+def normalize_url(url, keep_query=False):
+    """
+    Canonical form of an upstream URL for use as a key: lower-case scheme
+    and host, no default port, no repeated slashes, no fragment. The query
+    is only kept if asked for.
+    """
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(parts.scheme):
+        host += f":{parts.port}"
+    path = parts.path
+    while '//' in path:
+        path = path.replace('//', '/')
+    normalized = f"{parts.scheme.lower()}://{host}{path}"
+    if keep_query and parts.query:
+        normalized += '?' + parts.query
+    return normalized
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """
+    Raised instead of contacting a host whose circuit breaker is open.
+    """
+
+def backoff(attempt, base=RETRY_BACKOFF):
+    """
+    Seconds to wait before retry number `attempt` (0-based): exponential,
+    with full jitter so retries from many threads do not arrive together.
+    """
+    return random.uniform(0, base * (2 ** attempt))
+
+def host_of(url):
+    parts = urlsplit(url)
+    return (parts.netloc or '').lower()
+
+class _Host:
+    def __init__(self):
+        self.ttfb = deque(maxlen=TTFB_WINDOW)
+        self.failures = 0        # consecutive
+        self.opened_at = None    # breaker opened (or last probed) at, or None
+        self.counts = {'hedges': 0, 'hedges_won': 0, 'retries': 0, 'rejected': 0, 'trips': 0}
+
+class HostHealth:
+    """
+    Per-host time-to-first-byte percentiles and circuit breakers, shared by
+    every pool in the process and by the async server.
+
+    After BREAKER_FAILURES consecutive failed requests (connection errors
+    or timeouts on every attempt) a host's breaker opens and requests to it
+    fail at once with CircuitOpen. Every BREAKER_COOLDOWN seconds one
+    request is let through; the breaker closes if it succeeds and stays
+    open otherwise.
+    """
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def allow(self, host):
+        """
+        Raises CircuitOpen if requests to `host` should not be sent now.
+        Returns True if the request goes out as the probe of an open
+        breaker; a failed probe is not retried.
+        """
+        with self._lock:
+            state = self._host(host)
+            if state.opened_at is None:
+                return False
+            now = time.monotonic()
+            if now - state.opened_at >= self.cooldown:
+                # Let this one through as a probe; the rest wait another cooldown.
+                state.opened_at = now
+                return True
+            state.counts['rejected'] += 1
+        metrics.UPSTREAM_ERRORS.inc(status='circuit_open')
+        raise CircuitOpen(f"{host} is failing; requests to it are paused")
+
+    def success(self, host, ttfb=None):
+        with self._lock:
+            state = self._host(host)
+            state.failures = 0
+            state.opened_at = None
+            if ttfb is not None:
+                state.ttfb.append(ttfb)
+
+    def failure(self, host):
+        with self._lock:
+            state = self._host(host)
+            state.failures += 1
+            if state.opened_at is None and state.failures >= self.max_failures:
+                state.counts['trips'] += 1
+                state.opened_at = time.monotonic()
+                print(f"Upstream {host} failed {state.failures} times in a row; pausing requests to it.")
+
+    def hedge_after(self, host):
+        """
+        Seconds to wait for the first byte before sending a duplicate request.
+        """
+        with self._lock:
+            samples = sorted(self._host(host).ttfb)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_MS / 1000
+        percentile = samples[min(int(len(samples) * HEDGE_PERCENTILE), len(samples) - 1)]
+        return max(percentile, HEDGE_MIN_MS / 1000)
+
+    def count(self, host, event):
+        with self._lock:
+            self._host(host).counts[event] += 1
+
+    def stats(self):
+        hosts = {}
+        with self._lock:
+            items = list(self._hosts.items())
+        for host, state in items:
+            hosts[host] = dict(state.counts,
+                               breaker='open' if state.opened_at is not None else 'closed',
+                               failures=state.failures,
+                               samples=len(state.ttfb),
+                               hedge_after_ms=round(self.hedge_after(host) * 1000))
+        return hosts
+
+    def _host(self, host):
+        # Called with self._lock held.
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _Host()
+        return state
+
+# Shared by the proxy, the downloader and the async server.
+host_health = HostHealth()
+
+class UpstreamPool:
+    """
+    Keep-alive connections to upstream hosts, shared by every worker thread.
+    urllib3 keeps one connection pool per host, so consecutive segment
+    requests to the same CDN reuse an open TCP/TLS connection.
+    """
+    def __init__(self, pool_size=POOL_SIZE, pool_hosts=POOL_HOSTS,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 retries=RETRIES, health=host_health):
+        self.pool_size = pool_size
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.health = health
+        # Runs hedged requests, so the caller can wait on the first to answer.
+        self._hedger = ThreadPoolExecutor(max_workers=pool_size * 4, thread_name_prefix='upstream')
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+        self._session.headers['User-Agent'] = USER_AGENT
+
+    def get(self, url, headers=None, stream=True, timeout=None, hedge=False):
+        """
+        GET through the shared pool. Callers must close streamed responses
+        (or read them fully) so the connection goes back to the pool.
+
+        Connection errors, timeouts and 5xx answers are retried up to
+        `retries` times with jittered backoff; the request counts against
+        the host's breaker once, if it still had no answer at the end.
+        With hedge=True a duplicate request is sent when the first byte is
+        later than the host's usual (see HostHealth.hedge_after), and
+        whichever answers first is used.
+        Raises CircuitOpen without sending anything if the host is failing.
+        """
+        host = host_of(url)
+        timeout = timeout or self.timeout
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.health.count(host, 'retries')
+                time.sleep(backoff(attempt - 1))
+            probe = self.health.allow(host)
+            try:
+                if hedge and HEDGE_ENABLED:
+                    resp = self._hedged(host, url, headers, stream, timeout)
+                else:
+                    resp = self._session.get(url, headers=headers, stream=stream, timeout=timeout)
+            except requests.exceptions.RequestException as e:
+                if not isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+                    raise
+                if probe or attempt == self.retries:
+                    self.health.failure(host)
+                    raise
+                continue
+            if resp.status_code not in RETRY_STATUSES:
+                self.health.success(host, resp.elapsed.total_seconds())
+                return resp
+            if attempt == self.retries:
+                # The host answered, so it is up.
+                self.health.success(host)
+                return resp
+            resp.close()
+
+    def _hedged(self, host, url, headers, stream, timeout):
+        first = self._hedger.submit(self._session.get, url, headers=headers, stream=stream, timeout=timeout)
+        done, _ = wait([first], timeout=self.health.hedge_after(host))
+        if done:
+            return first.result()
+        self.health.count(host, 'hedges')
+        metrics.UPSTREAM_HEDGES.inc(result='sent')
+        second = self._hedger.submit(self._session.get, url, headers=headers, stream=stream, timeout=timeout)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winners = [future for future in done if future.exception() is None]
+            if not winners:
+                error = next(iter(done)).exception()
+                continue
+            winner = first if first in winners else second
+            if winner is second:
+                self.health.count(host, 'hedges_won')
+                metrics.UPSTREAM_HEDGES.inc(result='won')
+            for other in pending | done:
+                if other is not winner:
+                    other.add_done_callback(_close_response)
+            return winner.result()
+        raise error
+
+    def stats(self):
+        """
+        Returns connection reuse counters per host.
+        'new' connections paid for a TCP/TLS handshake, 'reused' ones did not.
+        """
+        hosts = {}
+        with self._lock:
+            pools = self._adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                name = f"{pool.scheme}://{pool.host}:{pool.port}"
+                new = pool.num_connections
+                total = pool.num_requests
+                hosts[name] = {
+                    'requests': total,
+                    'new': new,
+                    'reused': max(total - new, 0),
+                }
+        return {
+            'pool_size': self.pool_size,
+            'connect_timeout': self.timeout[0],
+            'read_timeout': self.timeout[1],
+            'requests': sum(h['requests'] for h in hosts.values()),
+            'new': sum(h['new'] for h in hosts.values()),
+            'reused': sum(h['reused'] for h in hosts.values()),
+            'hosts': hosts,
+            'health': self.health.stats(),
+        }
+
+    def close(self):
+        self._hedger.shutdown(wait=False)
+        self._session.close()
+
+def _close_response(future):
+    # The slower of two hedged requests.
+    if future.exception() is None:
+        future.result().close()
@@ -1,4 +1,9 @@
+import os
 import re
+import threading
+
+# Site the scraper talks to; point it at fake_origin.py for offline runs.
+BASE_URL = os.environ.get('ANIME_BASE_URL', 'https://anitaku.to').rstrip('/')
 
 def sanitize_filename(name):
     """
@@ -9,3 +14,32 @@ def sanitize_filename(name):
     # Replace spaces with underscores or keep as is? User might prefer spaces.
     # Let's keep spaces but trim.
     return name.strip()
+
+class Lazy:
+    """
+    Stands in for an object that is only built, by calling `factory`, when
+    one of its attributes is first used. Thread-safe.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._value is not None
+
+    def get(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+        return self._value
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    def close(self):
+        # Nothing to close if it was never built.
+        if self._value is not None and hasattr(self._value, 'close'):
+            self._value.close()
@@ -0,0 +1,186 @@
+"""
+Variant selection for HLS master playlists.
+
+The proxy can pin, cap or reorder the EXT-X-STREAM-INF entries it forwards
+to the player, based on configured ceilings and the upstream throughput it
+has measured. The downloader uses the same ceilings to pick its variant.
+"""
+import os
+import re
+import threading
+
+# Tunables, overridable from the environment.
+VARIANT_POLICY = os.environ.get('ANIME_VARIANT_POLICY', 'reorder')  # off, reorder, cap or pin
+MAX_HEIGHT = int(os.environ.get('ANIME_MAX_HEIGHT', '0'))  # streaming ceiling in lines, 0 = none
+MAX_BANDWIDTH_KBPS = int(os.environ.get('ANIME_MAX_BANDWIDTH_KBPS', '0'))  # streaming ceiling, 0 = none
+
+# Share of the measured throughput a variant's BANDWIDTH may use, leaving
+# room for the read-ahead, subtitles and a background download.
+HEADROOM = 0.7
+# Fetches smaller than this mostly measure latency, not throughput.
+MIN_SAMPLE_BYTES = 128 * 1024
+# Weight of the newest sample in the moving average.
+SAMPLE_WEIGHT = 0.3
+
+ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+
+def parse_attributes(line):
+    """
+    Parses the attribute list of a tag, e.g. '#EXT-X-KEY:METHOD=NONE,URI="k"'.
+    """
+    attrs = line.split(':', 1)[1] if ':' in line else ''
+    return {key: value.strip('"') for key, value in ATTRIBUTE.findall(attrs)}
+
+def parse_master_playlist(text):
+    """
+    Returns the variants of a master playlist as
+    [{'uri': str, 'bandwidth': int, 'resolution': str or None, 'height': int}],
+    or [] for a media playlist. 'height' is 0 when RESOLUTION is missing.
+    """
+    variants = []
+    pending = None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF'):
+            pending = (line, parse_attributes(line))
+        elif line and not line.startswith('#') and pending is not None:
+            tag, attrs = pending
+            resolution = attrs.get('RESOLUTION')
+            variants.append({
+                'uri': line,
+                'bandwidth': int(attrs.get('BANDWIDTH', 0) or 0),
+                'resolution': resolution,
+                'height': _height(resolution),
+                'tag': tag,
+            })
+            pending = None
+    return variants
+
+def _height(resolution):
+    try:
+        return int(resolution.lower().split('x', 1)[1])
+    except (AttributeError, IndexError, ValueError):
+        return 0
+
+def describe(variant):
+    if variant['height']:
+        return f"{variant['height']}p"
+    return f"{variant['bandwidth'] // 1000}kbps"
+
+def within(variant, max_height=0, max_bandwidth=0):
+    """
+    True if the variant fits the ceilings (0 = no ceiling). Variants that
+    do not state a resolution or bandwidth are not held back by it.
+    """
+    if max_height and variant['height'] > max_height:
+        return False
+    if max_bandwidth and variant['bandwidth'] > max_bandwidth:
+        return False
+    return True
+
+def choose_variant(variants, max_height=0, max_bandwidth=0, throughput=None):
+    """
+    Returns the highest-bandwidth variant that fits the ceilings and, if
+    given, HEADROOM of the throughput (bits per second). Falls back to the
+    lowest-bandwidth variant when none fits.
+    """
+    if not variants:
+        return None
+    limit = max_bandwidth
+    if throughput:
+        budget = int(throughput * HEADROOM)
+        limit = min(limit, budget) if limit else budget
+    fitting = [v for v in variants if within(v, max_height, limit)]
+    if fitting:
+        return max(fitting, key=lambda v: v['bandwidth'])
+    return min(variants, key=lambda v: v['bandwidth'])
+
+def select_variants(content, policy=VARIANT_POLICY, max_height=MAX_HEIGHT,
+                    max_bandwidth=MAX_BANDWIDTH_KBPS * 1000, throughput=None):
+    """
+    Applies a policy to a master playlist and returns (content, chosen variant).
+    The chosen variant is listed first, which is where hls.js starts:
+
+        off      the playlist is returned unchanged
+        reorder  every variant is kept
+        cap      variants above the ceilings or the throughput are dropped
+        pin      only the chosen variant is kept
+
+    Media playlists, and master playlists under 'off' (or 'reorder' before
+    anything is measured or configured), come back unchanged with None.
+    """
+    if policy == 'off' or '#EXT-X-STREAM-INF' not in content:
+        return content, None
+    if policy == 'reorder' and not (throughput or max_height or max_bandwidth):
+        # Nothing measured or configured yet: keep the site's own order.
+        return content, None
+    variants = parse_master_playlist(content)
+    chosen = choose_variant(variants, max_height, max_bandwidth, throughput)
+    if chosen is None:
+        return content, None
+
+    if policy == 'pin':
+        keep = [chosen]
+    elif policy == 'cap':
+        keep = [chosen] + [v for v in variants if v is not chosen
+                           and v['bandwidth'] <= chosen['bandwidth']]
+    else:
+        keep = [chosen] + [v for v in variants if v is not chosen]
+
+    # Other tags (EXT-X-MEDIA, I-frame playlists...) stay in place; the
+    # variant entries are written where the first one was.
+    lines = []
+    pending = False
+    inserted = False
+    for line in content.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('#EXT-X-STREAM-INF'):
+            pending = True
+            if not inserted:
+                for v in keep:
+                    lines += [v['tag'], v['uri']]
+                inserted = True
+            continue
+        if pending and stripped and not stripped.startswith('#'):
+            pending = False
+            continue
+        lines.append(line)
+    return "\n".join(lines) + "\n", chosen
+
+class ThroughputMeter:
+    """
+    Moving average of upstream transfer rates, fed with segment fetches.
+    Each sample is one connection's rate, which is what a player fetching
+    one segment at a time gets.
+    """
+    def __init__(self, min_bytes=MIN_SAMPLE_BYTES, weight=SAMPLE_WEIGHT):
+        self.min_bytes = min_bytes
+        self.weight = weight
+        self._rate = None
+        self._samples = 0
+        self._lock = threading.Lock()
+
+    def record(self, num_bytes, seconds):
+        if num_bytes < self.min_bytes or seconds <= 0:
+            return
+        rate = num_bytes * 8 / seconds
+        with self._lock:
+            if self._rate is None:
+                self._rate = rate
+            else:
+                self._rate += self.weight * (rate - self._rate)
+            self._samples += 1
+
+    def estimate(self):
+        """
+        Returns the average rate in bits per second, or None before any sample.
+        """
+        with self._lock:
+            return self._rate
+
+    def stats(self):
+        rate = self.estimate()
+        return {
+            'samples': self._samples,
+            'kbps': round(rate / 1000) if rate is not None else None,
+        }